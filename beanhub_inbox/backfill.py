@@ -0,0 +1,112 @@
+import contextlib
+import csv
+import os
+import pathlib
+import uuid
+
+from .data_types import OutputColumn
+from .pre_classify import parse_valid_value
+from .utils import file_lock
+
+
+def find_backfill_columns(
+    columns: list[OutputColumn], row: dict[str, str]
+) -> list[OutputColumn]:
+    if parse_valid_value(row.get("valid")) is False:
+        # other columns were not extracted on purpose for invalid emails
+        return []
+    return [
+        column
+        for column in columns
+        if column.name not in row or (column.required and not row[column.name])
+    ]
+
+
+class CSVBackfill:
+    # Collects updated and new rows in memory, and rewrites the output CSV file with
+    # the new header in one streaming pass when flushing
+    def __init__(
+        self, output_csv: pathlib.Path, fieldnames: list[str], lock: bool = False
+    ):
+        self.output_csv = output_csv
+        self.fieldnames = fieldnames
+        # lock the file when rewriting it, for multiple workers sharing it
+        self.lock = lock
+        self.existing_fieldnames: list[str] | None = None
+        self.rows: dict[str, tuple[int, dict[str, str]]] = {}
+        self.updates: dict[str, dict] = {}
+        self.new_rows: list[dict] = []
+        if output_csv.exists():
+            with output_csv.open("rt") as fo:
+                reader = csv.DictReader(fo)
+                if reader.fieldnames is None:
+                    # created by another worker which has not written the header yet
+                    return
+                if "id" not in reader.fieldnames:
+                    raise ValueError(
+                        f"No id column found in the existing output csv file at {output_csv}"
+                    )
+                self.existing_fieldnames = list(reader.fieldnames)
+                for index, row in enumerate(reader):
+                    self.rows[row["id"]] = (index + 1 + 1, row)
+
+    def find_row(self, email_id: str) -> tuple[int, dict[str, str]] | None:
+        return self.rows.get(email_id)
+
+    def update_row(self, email_id: str, values: dict):
+        self.updates.setdefault(email_id, {}).update(values)
+
+    def add_row(self, row: dict):
+        self.new_rows.append(row)
+
+    @property
+    def has_pending_rows(self) -> bool:
+        return bool(self.updates or self.new_rows)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(
+            self.updates
+            or self.new_rows
+            or (
+                self.existing_fieldnames is not None
+                and not set(self.fieldnames).issubset(self.existing_fieldnames)
+            )
+        )
+
+    def flush(self):
+        if not self.dirty:
+            return
+        self.output_csv.parent.mkdir(parents=True, exist_ok=True)
+        tmp_csv = self.output_csv.with_name(
+            f".{self.output_csv.name}.{uuid.uuid4().hex}.backfill"
+        )
+        with file_lock(self.output_csv) if self.lock else contextlib.nullcontext():
+            # other workers could have written the file since it was loaded, so read
+            # it again under the lock
+            with contextlib.ExitStack() as stack:
+                reader = None
+                if self.output_csv.exists():
+                    reader = csv.DictReader(
+                        stack.enter_context(self.output_csv.open("rt"))
+                    )
+                fieldnames = list(self.fieldnames)
+                if reader is not None and reader.fieldnames is not None:
+                    # keep columns no longer in the schema instead of dropping the data
+                    fieldnames.extend(
+                        name for name in reader.fieldnames if name not in fieldnames
+                    )
+                with tmp_csv.open("wt", newline="") as dst:
+                    writer = csv.DictWriter(dst, fieldnames=fieldnames)
+                    writer.writeheader()
+                    if reader is not None:
+                        for row in reader:
+                            update = self.updates.get(row["id"])
+                            if update is not None:
+                                row |= update
+                            writer.writerow(row)
+                    writer.writerows(self.new_rows)
+            os.replace(tmp_csv, self.output_csv)
+        self.existing_fieldnames = fieldnames
+        self.updates = {}
+        self.new_rows = []
@@ -0,0 +1,457 @@
+import argparse
+import collections
+import cProfile
+import logging
+import pathlib
+import pstats
+import tempfile
+import threading
+import time
+import typing
+
+import yaml
+
+from .concurrency import AdaptiveLimiter
+from .data_types import InboxDoc
+from .event_log import EventLogFormat
+from .event_log import EventSink
+from .event_log import tee_events
+from .metrics import PipelineMetrics
+from .metrics import start_http_server
+from .metrics import start_textfile_writer
+from .processor import process_imports
+from .processor import ProcessImportEvent
+from .profiling import collapse_pstats
+from .profiling import find_import_time
+from .profiling import load_replay
+from .profiling import measure_import_time
+from .profiling import StackSampler
+from .profiling import StubLLM
+from .profiling import use_stub_llm
+from .profiling import write_collapsed
+from .tracing import JSONLinesSpanExporter
+from .tracing import Tracer
+from .work_queue import populate_queue
+from .work_queue import run_queue_threads
+from .work_queue import WorkQueue
+
+logger = logging.getLogger(__name__)
+DEFAULT_CONFIG = pathlib.Path(".beanhub") / "inbox.yaml"
+DEFAULT_INPUT_DIR = pathlib.Path(".beanhub") / "emails"
+STAGES = ["parse", "text", "think", "extract", "write"]
+SORT_KEYS = ["cumulative", "tottime", "calls", "ncalls", "name", "filename"]
+
+
+def load_inbox_doc(config: pathlib.Path) -> InboxDoc:
+    with config.open("rb") as fo:
+        return InboxDoc.model_validate(yaml.safe_load(fo))
+
+
+def count_events(
+    events: typing.Iterable[ProcessImportEvent],
+) -> collections.Counter[str]:
+    counts = collections.Counter()
+    for event in events:
+        counts[type(event).__name__] += 1
+    return counts
+
+
+def format_counts(counts: collections.Counter[str]) -> str:
+    return (
+        f"{counts['StartProcessingEmail']} emails, "
+        f"{counts['MatchImportRule']} matched, "
+        f"{counts['FinishExtractingRow']} rows extracted"
+    )
+
+
+def make_stub(args: argparse.Namespace) -> StubLLM:
+    replay = None
+    if args.replay is not None:
+        replay = load_replay(args.replay)
+    return StubLLM(
+        thinking_chars=args.thinking_chars,
+        token_delay=args.token_delay,
+        replay=replay,
+    )
+
+
+def run_stub_imports(
+    args: argparse.Namespace,
+    inbox_doc: InboxDoc,
+    metrics: PipelineMetrics | None = None,
+) -> collections.Counter[str]:
+    # outputs are written to a temporary workdir, so that all the emails are
+    # processed instead of skipped for existing rows
+    with tempfile.TemporaryDirectory() as workdir:
+        return count_events(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=args.input_dir,
+                llm_model=args.model,
+                workdir_path=pathlib.Path(workdir),
+                parse_workers=args.parse_workers,
+                max_part_size=args.max_part_size,
+                metrics=metrics,
+            )
+        )
+
+
+def run_threaded_imports(
+    args: argparse.Namespace,
+    inbox_doc: InboxDoc,
+    metrics: PipelineMetrics | None = None,
+    tracer: Tracer | None = None,
+) -> typing.Generator[ProcessImportEvent, None, None]:
+    # emails are dispatched to the threads through a work queue in a temporary
+    # folder, while the limiter adapts the number of in-flight LLM requests to the
+    # server up to the number of threads
+    with tempfile.TemporaryDirectory() as queue_dir:
+        database = pathlib.Path(queue_dir) / "queue.sqlite"
+        work_queue = WorkQueue(database)
+        try:
+            populate_queue(work_queue, args.input_dir)
+        finally:
+            work_queue.close()
+        yield from run_queue_threads(
+            database=database,
+            threads=args.threads,
+            inbox_doc=inbox_doc,
+            input_dir=args.input_dir,
+            llm_model=args.model,
+            workdir_path=args.workdir,
+            poll_interval=0.1,
+            llm_limiter=AdaptiveLimiter(max_limit=args.threads),
+            metrics=metrics,
+            tracer=tracer,
+            max_part_size=args.max_part_size,
+        )
+
+
+def cmd_import(args: argparse.Namespace) -> int:
+    inbox_doc = load_inbox_doc(args.config)
+    metrics = None
+    server = None
+    stop_event = None
+    textfile_thread = None
+    if args.metrics_port is not None or args.metrics_textfile is not None:
+        metrics = PipelineMetrics()
+    if args.metrics_port is not None:
+        server = start_http_server(metrics.registry, port=args.metrics_port)
+    if args.metrics_textfile is not None:
+        stop_event = threading.Event()
+        textfile_thread = start_textfile_writer(
+            metrics.registry, args.metrics_textfile, stop_event=stop_event
+        )
+    tracer = None
+    if args.trace_file is not None:
+        tracer = Tracer(JSONLinesSpanExporter(args.trace_file))
+    sink = None
+    if args.event_log is not None:
+        sink = EventSink(args.event_log, log_format=args.event_log_format)
+    try:
+        if args.threads is not None:
+            events = run_threaded_imports(
+                args, inbox_doc, metrics=metrics, tracer=tracer
+            )
+        else:
+            events = process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=args.input_dir,
+                llm_model=args.model,
+                workdir_path=args.workdir,
+                parse_workers=args.parse_workers,
+                max_part_size=args.max_part_size,
+                metrics=metrics,
+                tracer=tracer,
+            )
+        if sink is not None:
+            events = tee_events(events, sink)
+        counts = count_events(events)
+    finally:
+        if sink is not None:
+            sink.close()
+        if tracer is not None:
+            tracer.close()
+        if textfile_thread is not None:
+            stop_event.set()
+            textfile_thread.join()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    print(f"Processed {format_counts(counts)}")
+    return 0
+
+
+def cmd_bench(args: argparse.Namespace) -> int:
+    inbox_doc = load_inbox_doc(args.config)
+    metrics = PipelineMetrics()
+    stub = make_stub(args)
+    with use_stub_llm(stub):
+        for index in range(args.repeat):
+            started_at = time.perf_counter()
+            counts = run_stub_imports(args, inbox_doc, metrics=metrics)
+            elapsed = time.perf_counter() - started_at
+            emails = counts["StartProcessingEmail"]
+            print(
+                f"Run {index + 1}: {format_counts(counts)} in {elapsed:.3f}s "
+                f"({emails / elapsed if elapsed else 0:.1f} emails/s)"
+            )
+    print()
+    print("Stage\tCount\tTotal (s)\tMean (ms)")
+    for stage in STAGES:
+        count = metrics.stage_duration.get_count(stage=stage)
+        total = metrics.stage_duration.get_sum(stage=stage)
+        mean = total / count * 1000 if count else 0.0
+        print(f"{stage}\t{count}\t{total:.3f}\t{mean:.3f}")
+    print(f"\nLLM calls: {stub.calls} ({stub.replayed_calls} replayed)")
+    return 0
+
+
+def cmd_profile(args: argparse.Namespace) -> int:
+    inbox_doc = load_inbox_doc(args.config)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    stub = make_stub(args)
+    stats_path = args.output_dir / "profile.txt"
+    collapsed_path = args.output_dir / "profile.collapsed"
+    with use_stub_llm(stub):
+        if args.profiler == "sampling":
+            with StackSampler(interval=args.interval) as sampler:
+                counts = run_stub_imports(args, inbox_doc)
+            stats_path.write_text(sampler.format_stats(limit=args.limit))
+            write_collapsed(sampler.collapsed(), collapsed_path)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                counts = run_stub_imports(args, inbox_doc)
+            finally:
+                profiler.disable()
+            profiler.dump_stats(args.output_dir / "profile.prof")
+            with stats_path.open("wt") as fo:
+                stats = pstats.Stats(profiler, stream=fo)
+                stats.sort_stats(args.sort).print_stats(args.limit)
+            # microseconds as integer counts
+            write_collapsed(collapse_pstats(stats), collapsed_path, scale=1_000_000)
+    print(stats_path.read_text())
+    print(f"Processed {format_counts(counts)}")
+    print(
+        f"Stats written to {stats_path}, collapsed stacks written to {collapsed_path}"
+    )
+    return 0
+
+
+def cmd_import_time(args: argparse.Namespace) -> int:
+    # the fastest run is the least affected by noise like disk cache misses
+    runs = [measure_import_time(args.module) for _ in range(args.repeat)]
+    times = [find_import_time(entries, args.module).cumulative_us for entries in runs]
+    best_us = min(times)
+    entries = runs[times.index(best_us)]
+    print("Module\tSelf (ms)\tCumulative (ms)")
+    for entry in sorted(entries, key=lambda entry: entry.self_us, reverse=True)[
+        : args.limit
+    ]:
+        print(
+            f"{entry.module}\t{entry.self_us / 1000:.1f}\t{entry.cumulative_us / 1000:.1f}"
+        )
+    print(
+        f"\nImported {args.module} in {best_us / 1000:.1f}ms "
+        f"(best of {args.repeat} runs)"
+    )
+    if args.budget is not None and best_us > args.budget * 1000:
+        print(f"Import time exceeds the budget of {args.budget:.1f}ms")
+        return 1
+    return 0
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=pathlib.Path,
+        default=DEFAULT_CONFIG,
+        help="inbox config file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-i",
+        "--input-dir",
+        type=pathlib.Path,
+        default=DEFAULT_INPUT_DIR,
+        help="folder of the email files (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        help="parse emails in this number of worker processes",
+    )
+    parser.add_argument(
+        "--max-part-size",
+        type=int,
+        help="skip attachments larger than this number of bytes when parsing",
+    )
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-m", "--model", default="stub", help="model name passed to the stub LLM"
+    )
+    parser.add_argument(
+        "--replay",
+        type=pathlib.Path,
+        help="event log to replay LLM responses from, stub responses are used for prompts not in it",
+    )
+    parser.add_argument(
+        "--thinking-chars",
+        type=int,
+        default=512,
+        help="length of stub thinking output (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--token-delay",
+        type=float,
+        default=0.0,
+        help="seconds to wait for each stub output chunk (default: %(default)s)",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m beanhub_inbox",
+        description="Process emails with the inbox config",
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="log at debug level"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser(
+        "import", help="extract data from emails with LLM"
+    )
+    add_common_arguments(import_parser)
+    import_parser.add_argument("-m", "--model", required=True, help="LLM model name")
+    import_parser.add_argument(
+        "-w",
+        "--workdir",
+        type=pathlib.Path,
+        default=pathlib.Path("."),
+        help="folder output files are relative to (default: %(default)s)",
+    )
+    import_parser.add_argument(
+        "--event-log", type=pathlib.Path, help="write processing events to this file"
+    )
+    import_parser.add_argument(
+        "--event-log-format",
+        type=EventLogFormat,
+        choices=list(EventLogFormat),
+        default=EventLogFormat.jsonl,
+    )
+    import_parser.add_argument(
+        "--trace-file",
+        type=pathlib.Path,
+        help="write OTLP/JSON tracing spans to this file",
+    )
+    import_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on this local port",
+    )
+    import_parser.add_argument(
+        "--metrics-textfile",
+        type=pathlib.Path,
+        help="write Prometheus metrics to this file periodically",
+    )
+    import_parser.add_argument(
+        "--threads",
+        type=int,
+        help="extract this number of emails at the same time, the number of in-flight LLM requests adapts to the server latency",
+    )
+    import_parser.set_defaults(func=cmd_import)
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="measure throughput of processing emails with a stub LLM"
+    )
+    add_common_arguments(bench_parser)
+    add_stub_arguments(bench_parser)
+    bench_parser.add_argument(
+        "-n", "--repeat", type=int, default=1, help="number of runs (default: 1)"
+    )
+    bench_parser.set_defaults(func=cmd_bench)
+
+    profile_parser = subparsers.add_parser(
+        "profile", help="profile processing emails with a stub LLM"
+    )
+    add_common_arguments(profile_parser)
+    add_stub_arguments(profile_parser)
+    profile_parser.add_argument(
+        "--profiler",
+        choices=["cprofile", "sampling"],
+        default="cprofile",
+        help="cProfile records every call, sampling has lower overhead (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--sort",
+        choices=SORT_KEYS,
+        default="cumulative",
+        help="sort key of cProfile stats (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--limit",
+        type=int,
+        default=30,
+        help="number of functions in the stats (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.005,
+        help="seconds between samples of the sampling profiler (default: %(default)s)",
+    )
+    profile_parser.add_argument(
+        "-o",
+        "--output-dir",
+        type=pathlib.Path,
+        default=pathlib.Path("profile"),
+        help="folder for the stats and collapsed stacks (default: %(default)s)",
+    )
+    profile_parser.set_defaults(func=cmd_profile)
+
+    import_time_parser = subparsers.add_parser(
+        "import-time", help="measure time of importing a module in a new interpreter"
+    )
+    import_time_parser.add_argument(
+        "--module",
+        default="beanhub_inbox.processor",
+        help="module to import (default: %(default)s)",
+    )
+    import_time_parser.add_argument(
+        "-n", "--repeat", type=int, default=5, help="number of runs (default: 5)"
+    )
+    import_time_parser.add_argument(
+        "--limit",
+        type=int,
+        default=15,
+        help="number of slowest modules to list (default: %(default)s)",
+    )
+    import_time_parser.add_argument(
+        "--budget",
+        type=float,
+        help="exit with non-zero status when the import takes longer than this number of milliseconds",
+    )
+    import_time_parser.set_defaults(func=cmd_import_time)
+    return parser
+
+
+def main(argv: typing.Sequence[str] | None = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, "threads", None) is not None:
+        if args.threads < 1:
+            parser.error("--threads should be at least 1")
+        if args.parse_workers is not None:
+            # queue workers need the emails parsed one at a time in the order they
+            # are claimed
+            parser.error("--threads cannot be used with --parse-workers")
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    return args.func(args)
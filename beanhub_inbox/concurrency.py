@@ -0,0 +1,146 @@
+import contextlib
+import dataclasses
+import math
+import threading
+import time
+import typing
+
+
+@dataclasses.dataclass(frozen=True)
+class LimiterSample:
+    # seconds spent waiting for a free slot
+    queue_latency: float
+    # seconds from sending the request to receiving the first token
+    time_to_first_token: float | None
+    # limit after this sample was applied
+    limit: float
+
+
+class LimiterSlot:
+    def __init__(self, queue_latency: float, clock: typing.Callable[[], float]):
+        self.queue_latency = queue_latency
+        self.clock = clock
+        self.started_at = clock()
+        self.time_to_first_token: float | None = None
+
+    def first_token(self):
+        if self.time_to_first_token is None:
+            self.time_to_first_token = self.clock() - self.started_at
+
+
+class AdaptiveLimiter:
+    # AIMD limiter of in-flight LLM requests. The limit grows by one for every
+    # window of requests served without congestion, and shrinks by backoff_ratio when
+    # the time to first token goes beyond latency_tolerance times the baseline or the
+    # request fails, as the server is queueing the requests instead of running them.
+    # The baseline is an exponentially weighted moving average of the recent times to
+    # first token, so that it follows prompt sizes changing over time instead of
+    # sticking to one fast response
+    def __init__(
+        self,
+        initial_limit: int = 1,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        latency_tolerance: float = 2.0,
+        backoff_ratio: float = 0.75,
+        # weight of each new sample in the baseline latency
+        latency_smoothing: float = 0.1,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        if not (1 <= min_limit <= initial_limit <= max_limit):
+            raise ValueError(
+                f"Expected 1 <= min_limit ({min_limit}) <= initial_limit ({initial_limit}) <= max_limit ({max_limit})"
+            )
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_ratio = backoff_ratio
+        self.latency_smoothing = latency_smoothing
+        self.clock = clock
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._baseline_latency: float | None = None
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    @property
+    def limit(self) -> int:
+        return math.floor(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def last_sample(self) -> LimiterSample | None:
+        # last sample recorded by the current thread
+        return getattr(self._local, "sample", None)
+
+    def acquire(self) -> float:
+        waiting_since = self.clock()
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        return self.clock() - waiting_since
+
+    def release(
+        self,
+        queue_latency: float,
+        time_to_first_token: float | None,
+        failed: bool = False,
+    ):
+        with self._condition:
+            saturated = self._in_flight >= self.limit
+            self._in_flight -= 1
+            if failed:
+                self._decrease()
+            elif time_to_first_token is not None:
+                if self._baseline_latency is None:
+                    self._baseline_latency = time_to_first_token
+                congested = (
+                    time_to_first_token
+                    > self._baseline_latency * self.latency_tolerance
+                )
+                self._baseline_latency += self.latency_smoothing * (
+                    time_to_first_token - self._baseline_latency
+                )
+                if congested:
+                    self._decrease()
+                elif saturated:
+                    # only grow when the limit was actually reached, otherwise the
+                    # limit could grow forever without being tested
+                    self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+            self._local.sample = LimiterSample(
+                queue_latency=queue_latency,
+                time_to_first_token=time_to_first_token,
+                limit=self._limit,
+            )
+            self._condition.notify_all()
+
+    def _decrease(self):
+        self._limit = max(self._limit * self.backoff_ratio, self.min_limit)
+
+    @contextlib.contextmanager
+    def slot(self) -> typing.Generator[LimiterSlot, None, None]:
+        slot = LimiterSlot(queue_latency=self.acquire(), clock=self.clock)
+        try:
+            yield slot
+        except Exception:
+            self.release(
+                queue_latency=slot.queue_latency, time_to_first_token=None, failed=True
+            )
+            raise
+        except BaseException:
+            # interrupted by the caller, not a signal from the server
+            self.release(
+                queue_latency=slot.queue_latency,
+                time_to_first_token=slot.time_to_first_token,
+            )
+            raise
+        # the whole response arrives at once for non-streaming requests
+        slot.first_token()
+        self.release(
+            queue_latency=slot.queue_latency,
+            time_to_first_token=slot.time_to_first_token,
+        )
@@ -18,7 +18,9 @@ class ImportActionType(str, enum.Enum):
 
 
 class InboxBaseModel(BaseModel):
-    pass
+    # validators are built on first use instead of import, as most processes only
+    # use a few of the models
+    model_config = pydantic.ConfigDict(defer_build=True)
 
 
 class InboxMatch(InboxBaseModel):
@@ -75,6 +77,15 @@ class StrContainsMatch(InboxBaseModel):
 
 SimpleFileMatch = str | StrExactMatch | StrRegexMatch
 
+StrMatch = (
+    str
+    | StrPrefixMatch
+    | StrSuffixMatch
+    | StrExactMatch
+    | StrContainsMatch
+    | StrOneOfMatch
+)
+
 
 class InputConfig(InboxBaseModel):
     match: SimpleFileMatch
@@ -91,17 +102,147 @@ class OutputColumnType(enum.Enum):
     datetime = "datetime"
 
 
+class ColumnExtractor(InboxBaseModel):
+    # Regular expression searched in the email text
+    regex: str | None = None
+    # Name of the header to read the value from, such as "Subject"
+    header: str | None = None
+    # Pattern the header value needs to match
+    match: StrMatch | None = None
+    # Use this value instead of the captured one when the extractor matches
+    value: str | None = None
+
+    @pydantic.model_validator(mode="after")
+    def check_source(self) -> "ColumnExtractor":
+        if (self.regex is None) == (self.header is None):
+            raise ValueError("Column extractor needs exactly one of regex or header")
+        return self
+
+
 class OutputColumn(InboxBaseModel):
     name: str
     type: OutputColumnType
     description: str
     pattern: str | None = None
     required: bool = True
+    # Deterministic extractors to try before asking LLM, the first match wins
+    extractors: list[ColumnExtractor] | None = None
+
+
+class PreClassifyConfig(InboxBaseModel):
+    # Sender addresses known for not sending any transaction emails
+    skip_from_addresses: list[StrMatch] | None = None
+    # Case-insensitive keywords in subject for non-transaction emails, such as "newsletter"
+    skip_subject_keywords: list[str] | None = None
+    # Treat emails without any currency amount in the content as non-transaction
+    require_amount: bool = False
+    # Treat emails from a sender as non-transaction once this many of the previous emails
+    # from the same sender were extracted as not valid without any valid one
+    sender_history_threshold: int | None = None
+
+
+class TemplateCacheConfig(InboxBaseModel):
+    # Path to the JSON file for storing learned templates, relative to the workdir
+    cache_file: str
+    # Number of agreeing LLM extractions needed before using a learned column extractor
+    min_samples: int = 2
+    # Run LLM extraction anyway for every N-th hit to detect template drift
+    spot_check_interval: int | None = 20
+
+
+class DedupConfig(InboxBaseModel):
+    # Treat emails with the same Message-ID header as duplicates
+    message_id: bool = True
+    # Treat emails with the same normalized body text as duplicates
+    body_hash: bool = True
+    # Treat emails with body SimHash values within this Hamming distance as near-duplicates
+    simhash_distance: int | None = None
+    # Write the row extracted from the first email for duplicates instead of skipping them
+    reuse_row: bool = True
+
+
+class SQLiteOutputConfig(InboxBaseModel):
+    # Path to the SQLite database file relative to the workdir
+    database: str
+    table: str = "rows"
+    # Number of rows to write in one transaction. Rows are committed as soon as they
+    # are extracted by default, with a larger batch up to batch_size - 1 extracted rows
+    # are only kept in memory and lost if the process is killed, unless the journal is
+    # enabled for replaying them
+    batch_size: int = 1
+    # Export all rows to the output CSV file at the end for compatibility
+    export_csv: bool = True
+
+
+class ParquetOutputConfig(InboxBaseModel):
+    # Path to the Parquet dataset directory relative to the workdir
+    path: str
+    # Number of rows in one row group
+    row_group_size: int = 1000
+
+
+class LatencyConfig(InboxBaseModel):
+    # Seconds to wait for each thinking or structured output LLM call
+    call_timeout: float | None = None
+    # Seconds to spend on all the columns of an email, after which the remaining
+    # columns are extracted with structured output only
+    email_timeout: float | None = None
+    # Max number of tokens to generate for thinking
+    think_num_predict: int | None = None
+    # Ollama host to send the same request to when the first one is slow
+    hedge_host: str | None = None
+    # Send hedged request after this percentile of the observed time to first token
+    hedge_percentile: float = 0.95
+    # Seconds to wait before sending hedged request at least
+    hedge_min_delay: float = 1.0
+
+
+@enum.unique
+class ThinkingUpdateMode(str, enum.Enum):
+    # one UpdateThinking event for each streamed chunk
+    token = "token"
+    # chunks are joined into one UpdateThinking event per interval or max_chars
+    coalesced = "coalesced"
+    # no UpdateThinking events
+    disabled = "disabled"
+
+
+class ThinkingUpdateConfig(InboxBaseModel):
+    mode: ThinkingUpdateMode = ThinkingUpdateMode.token
+    # Seconds to coalesce chunks for
+    interval: float | None = 0.5
+    # Max number of characters to coalesce
+    max_chars: int | None = 1024
+
+
+class TokenBudgetConfig(InboxBaseModel):
+    # Max tokens for an email, after which the remaining columns are extracted with
+    # structured output only without thinking
+    email_tokens: int | None = None
+    # Max tokens for a run, after which the processing stops and the remaining
+    # emails are left for the next run
+    run_tokens: int | None = None
 
 
 class ExtractConfig(InboxBaseModel):
     output_csv: str
     template: str | None = None
+    columns: list[OutputColumn] | None = None
+    pre_classify: PreClassifyConfig | None = None
+    template_cache: TemplateCacheConfig | None = None
+    dedup: DedupConfig | None = None
+    # Extract only the missing or empty required columns for rows already in the
+    # output CSV, and rewrite the CSV file with the current columns at the end
+    backfill: bool = False
+    # Path to the JSONL journal file relative to the workdir for recording extracted
+    # column values, so that they can be replayed after the process is interrupted
+    journal: str | None = None
+    # Write rows into SQLite database instead of appending to the output CSV file
+    output_sqlite: SQLiteOutputConfig | None = None
+    # Also write rows with typed columns into Parquet files, requires pyarrow
+    output_parquet: ParquetOutputConfig | None = None
+    latency: LatencyConfig | None = None
+    token_budget: TokenBudgetConfig | None = None
 
 
 class ExtractImportAction(InboxBaseModel):
@@ -118,16 +259,6 @@ class IgnoreImportAction(InboxBaseModel):
 ImportAction = ExtractImportAction | IgnoreImportAction
 
 
-StrMatch = (
-    str
-    | StrPrefixMatch
-    | StrSuffixMatch
-    | StrExactMatch
-    | StrContainsMatch
-    | StrOneOfMatch
-)
-
-
 class EmailFileMatchRule(InboxBaseModel):
     filepath: StrMatch | None = None
     subject: StrMatch | None = None
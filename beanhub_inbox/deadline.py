@@ -0,0 +1,207 @@
+import collections
+import dataclasses
+import enum
+import logging
+import math
+import queue
+import threading
+import time
+import typing
+
+if typing.TYPE_CHECKING:
+    import ollama
+
+logger = logging.getLogger(__name__)
+T = typing.TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+@enum.unique
+class DeadlineStage(str, enum.Enum):
+    think = "think"
+    extract = "extract"
+    # the email deadline expired before thinking
+    email = "email"
+
+
+class Deadline:
+    def __init__(
+        self,
+        timeout: float | None,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.clock = clock
+        self.expires_at = clock() + timeout if timeout is not None else None
+
+    @classmethod
+    def earliest(cls, *deadlines: "Deadline | None") -> "Deadline | None":
+        candidates = [
+            deadline
+            for deadline in deadlines
+            if deadline is not None and deadline.expires_at is not None
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda deadline: deadline.expires_at)
+
+    def remaining(self) -> float | None:
+        if self.expires_at is None:
+            return None
+        return max(self.expires_at - self.clock(), 0.0)
+
+    @property
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+
+class LatencyTracker:
+    # Keeps recent latencies in a sliding window to find the percentile threshold
+    # for sending hedged requests
+    def __init__(
+        self, percentile: float = 0.95, window: int = 200, min_samples: int = 20
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples: collections.deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float):
+        with self._lock:
+            self._samples.append(latency)
+
+    def threshold(self) -> float | None:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(math.ceil(self.percentile * len(samples)) - 1, len(samples) - 1)
+        return samples[max(index, 0)]
+
+
+@dataclasses.dataclass
+class Hedge:
+    # client of the second host to send the same request to
+    client: "ollama.Client"
+    tracker: LatencyTracker = dataclasses.field(default_factory=LatencyTracker)
+    # delay before sending the hedged request, until there are enough samples for
+    # the percentile, and also the lower bound of it
+    min_delay: float = 1.0
+
+    def delay(self) -> float:
+        threshold = self.tracker.threshold()
+        if threshold is None:
+            return self.min_delay
+        return max(threshold, self.min_delay)
+
+
+_ITEM = "item"
+_DONE = "done"
+_ERROR = "error"
+
+
+def _run_stream(
+    index: int,
+    factory: typing.Callable[[], typing.Iterable[T]],
+    output: queue.Queue,
+    cancelled: threading.Event,
+):
+    try:
+        iterator = iter(factory())
+        try:
+            for item in iterator:
+                if cancelled.is_set():
+                    break
+                output.put((index, _ITEM, item))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+        output.put((index, _DONE, None))
+    except Exception as exc:
+        output.put((index, _ERROR, exc))
+
+
+def stream_with_deadline(
+    factories: list[typing.Callable[[], typing.Iterable[T]]],
+    deadline: Deadline | None = None,
+    hedge_after: float | None = None,
+) -> typing.Generator[T, None, None]:
+    # Iterates the stream from the first factory in a background thread, so that we
+    # can stop waiting when the deadline expires even if the server is stuck. If no
+    # item arrives after hedge_after seconds, the same request is sent with the
+    # next factory, and the stream with the first item wins
+    output: queue.Queue = queue.Queue()
+    cancelled = [threading.Event() for _ in factories]
+    started = 0
+    errors: dict[int, Exception] = {}
+    winner = None
+    clock = deadline.clock if deadline is not None else time.monotonic
+    started_at = clock()
+
+    def start_next():
+        nonlocal started
+        thread = threading.Thread(
+            target=_run_stream,
+            args=(started, factories[started], output, cancelled[started]),
+            daemon=True,
+        )
+        thread.start()
+        started += 1
+
+    start_next()
+    try:
+        while True:
+            timeout = deadline.remaining() if deadline is not None else None
+            can_hedge = winner is None and started < len(factories)
+            if can_hedge and hedge_after is not None:
+                hedge_timeout = max(started_at + hedge_after - clock(), 0)
+                if timeout is None or hedge_timeout < timeout:
+                    timeout = hedge_timeout
+            try:
+                index, kind, value = output.get(timeout=timeout)
+            except queue.Empty:
+                if deadline is not None and deadline.expired:
+                    raise DeadlineExceeded("Deadline exceeded while waiting for LLM")
+                if (
+                    winner is None
+                    and started < len(factories)
+                    and hedge_after is not None
+                    and clock() >= started_at + hedge_after
+                ):
+                    logger.info(
+                        "No response after %s seconds, send hedged request",
+                        hedge_after,
+                    )
+                    start_next()
+                continue
+            if winner is not None and index != winner:
+                continue
+            if kind == _ITEM:
+                if winner is None:
+                    winner = index
+                    for other, event in enumerate(cancelled):
+                        if other != index:
+                            event.set()
+                yield value
+            elif kind == _DONE:
+                if winner is None:
+                    # an empty stream wins too
+                    winner = index
+                return
+            else:
+                if winner is not None:
+                    raise value
+                errors[index] = value
+                if len(errors) == started:
+                    if started < len(factories):
+                        # fail over to the next host right away
+                        start_next()
+                        continue
+                    raise value
+    finally:
+        for event in cancelled:
+            event.set()
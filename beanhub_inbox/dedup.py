@@ -0,0 +1,283 @@
+import dataclasses
+import enum
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import typing
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+WORD_REGEX = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+
+@enum.unique
+class DuplicateSignal(str, enum.Enum):
+    message_id = "message_id"
+    body_hash = "body_hash"
+    simhash = "simhash"
+
+
+@dataclasses.dataclass(frozen=True)
+class DuplicateMatch:
+    signal: DuplicateSignal
+    email_id: str
+
+
+@dataclasses.dataclass(frozen=True)
+class EmailSignature:
+    message_id: str | None = None
+    body_hash: str | None = None
+    simhash: int | None = None
+
+
+def normalize_body_text(text: str) -> str:
+    lines = []
+    for line in text.splitlines():
+        # forwarded or replied emails quote the original content with ">"
+        line = line.lstrip("> \t").strip().lower()
+        if not line:
+            continue
+        lines.append(" ".join(line.split()))
+    return "\n".join(lines)
+
+
+def body_hash(text: str) -> str:
+    return hashlib.sha256(normalize_body_text(text).encode("utf8")).hexdigest()
+
+
+def _hash_token(token: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(token.encode("utf8"), digest_size=SIMHASH_BITS // 8).digest(),
+        "big",
+    )
+
+
+def simhash(text: str) -> int:
+    words = WORD_REGEX.findall(normalize_body_text(text))
+    if len(words) < SHINGLE_SIZE:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [
+            " ".join(words[i : i + SHINGLE_SIZE])
+            for i in range(len(words) - SHINGLE_SIZE + 1)
+        ]
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        token_hash = _hash_token(shingle)
+        for bit in range(SIMHASH_BITS):
+            if token_hash & (1 << bit):
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+    value = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            value |= 1 << bit
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class DuplicateDetector:
+    def __init__(
+        self,
+        message_id: bool = True,
+        body_hash: bool = True,
+        simhash_distance: int | None = None,
+        # Append-only JSONL file of the signatures seen, so that emails processed by
+        # previous runs don't need to be parsed again for their signatures. Lines
+        # appended by other workers sharing the file are read before each check
+        signatures_file: pathlib.Path | None = None,
+    ):
+        self.check_message_id = message_id
+        self.check_body_hash = body_hash
+        self.simhash_distance = simhash_distance
+        self.signatures_file = signatures_file
+        self._message_ids: dict[str, str] = {}
+        self._body_hashes: dict[str, str] = {}
+        # By pigeonhole principle, two hashes within distance d must have at least one
+        # identical band out of d + 1 bands, so we only compare against candidates
+        # sharing a band instead of scanning all the seen hashes
+        self._band_count = (simhash_distance or 0) + 1
+        self._band_bits = SIMHASH_BITS // self._band_count
+        self._simhash_bands: dict[tuple[int, int], list[tuple[int, str]]] = {}
+        self._signatures: dict[str, EmailSignature] = {}
+        self._rows: dict[str, dict] = {}
+        self._fo: typing.TextIO | None = None
+        self._reader: typing.BinaryIO | None = None
+        self._read_offset = 0
+        self._read_lineno = 0
+        self.read_signatures()
+
+    def read_signatures(self):
+        # Reads the signatures appended to the file since the last time
+        if self.signatures_file is None:
+            return
+        if self._reader is None:
+            if not self.signatures_file.exists():
+                return
+            self._reader = self.signatures_file.open("rb")
+        self._reader.seek(self._read_offset)
+        for line in self._reader:
+            if not line.endswith(b"\n"):
+                # the line is still being written by another worker
+                break
+            self._read_offset += len(line)
+            self._read_lineno += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the line could be partially written when the process died
+                logger.warning(
+                    "Ignored broken line %s in signatures file %s",
+                    self._read_lineno,
+                    self.signatures_file,
+                )
+                continue
+            self._remember(
+                record["email_id"],
+                EmailSignature(
+                    message_id=record.get("message_id"),
+                    body_hash=record.get("body_hash"),
+                    simhash=record.get("simhash"),
+                ),
+                duplicate=record.get("duplicate", False),
+            )
+
+    def _iter_bands(self, value: int):
+        mask = (1 << self._band_bits) - 1
+        for index in range(self._band_count):
+            yield index, (value >> (index * self._band_bits)) & mask
+
+    def make_signature(self, message_id: str | None, text: str) -> EmailSignature:
+        message_id = message_id.strip() if message_id else None
+        return EmailSignature(
+            message_id=message_id or None,
+            body_hash=body_hash(text) if self.check_body_hash else None,
+            simhash=simhash(text) if self.simhash_distance is not None else None,
+        )
+
+    def has_signature(self, email_id: str) -> bool:
+        # Whether the email has been seen with all the signals enabled now, so that
+        # there's no need to extract its text again
+        self.read_signatures()
+        signature = self._signatures.get(email_id)
+        if signature is None:
+            return False
+        if self.check_body_hash and signature.body_hash is None:
+            return False
+        if self.simhash_distance is not None and signature.simhash is None:
+            return False
+        return True
+
+    def check(
+        self, email_id: str, message_id: str | None, text: str
+    ) -> DuplicateMatch | None:
+        # Returns the first seen email this one duplicates, otherwise remember it.
+        # Checking and recording are not atomic across workers, two workers checking
+        # duplicates at the same time could both see their emails as the first
+        signature = self.make_signature(message_id=message_id, text=text)
+        self.read_signatures()
+        match = self._find_duplicate(email_id, signature)
+        if self._signatures.get(email_id) != signature:
+            # signatures of duplicates are kept too, so that they don't need to be
+            # extracted again, but they are never the first seen email of a signal
+            self._remember(email_id, signature, duplicate=match is not None)
+            self._write_signature(email_id, signature, duplicate=match is not None)
+        return match
+
+    def _find_duplicate(
+        self, email_id: str, signature: EmailSignature
+    ) -> DuplicateMatch | None:
+        if self.check_message_id and signature.message_id is not None:
+            first_email_id = self._message_ids.get(signature.message_id)
+            if first_email_id is not None and first_email_id != email_id:
+                return DuplicateMatch(
+                    signal=DuplicateSignal.message_id, email_id=first_email_id
+                )
+        if signature.body_hash is not None:
+            first_email_id = self._body_hashes.get(signature.body_hash)
+            if first_email_id is not None and first_email_id != email_id:
+                return DuplicateMatch(
+                    signal=DuplicateSignal.body_hash, email_id=first_email_id
+                )
+        if signature.simhash is not None:
+            for band in self._iter_bands(signature.simhash):
+                for candidate, first_email_id in self._simhash_bands.get(band, []):
+                    if first_email_id == email_id:
+                        continue
+                    if (
+                        hamming_distance(candidate, signature.simhash)
+                        <= self.simhash_distance
+                    ):
+                        return DuplicateMatch(
+                            signal=DuplicateSignal.simhash, email_id=first_email_id
+                        )
+        return None
+
+    def _remember(self, email_id: str, signature: EmailSignature, duplicate: bool):
+        if self._signatures.get(email_id) == signature:
+            # such as our own lines read back from the file
+            return
+        self._signatures[email_id] = signature
+        if duplicate:
+            return
+        if signature.message_id is not None:
+            self._message_ids.setdefault(signature.message_id, email_id)
+        if signature.body_hash is not None:
+            self._body_hashes.setdefault(signature.body_hash, email_id)
+        if signature.simhash is not None:
+            for band in self._iter_bands(signature.simhash):
+                self._simhash_bands.setdefault(band, []).append(
+                    (signature.simhash, email_id)
+                )
+
+    def _write_signature(
+        self, email_id: str, signature: EmailSignature, duplicate: bool
+    ):
+        if self.signatures_file is None:
+            return
+        if self._fo is None:
+            self.signatures_file.parent.mkdir(parents=True, exist_ok=True)
+            self._fo = self.signatures_file.open("at")
+            if self._fo.tell() > 0 and not self._ends_with_newline():
+                # terminate the partially written line left by a dead process
+                self._fo.write("\n")
+        # no fsync, losing the last signatures only means parsing those emails again
+        self._fo.write(
+            json.dumps(
+                dict(
+                    email_id=email_id,
+                    duplicate=duplicate,
+                    **dataclasses.asdict(signature),
+                )
+            )
+            + "\n"
+        )
+        self._fo.flush()
+
+    def _ends_with_newline(self) -> bool:
+        with self.signatures_file.open("rb") as fo:
+            fo.seek(-1, os.SEEK_END)
+            return fo.read(1) == b"\n"
+
+    def close(self):
+        if self._fo is not None:
+            self._fo.close()
+            self._fo = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def set_row(self, email_id: str, row: dict):
+        self._rows[email_id] = row
+
+    def get_row(self, email_id: str) -> dict | None:
+        return self._rows.get(email_id)
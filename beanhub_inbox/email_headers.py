@@ -0,0 +1,77 @@
+import email.message
+import email.policy
+import typing
+
+
+class EmailHeaders(typing.Mapping[str, str]):
+    # Read-only and case-insensitive view of email headers keeping the raw values,
+    # which are only decoded on first access. Repeated headers such as Received are
+    # all kept and available with get_all, while the mapping interface returns the
+    # first one like email.message.Message does
+    __slots__ = ("_raw_items", "_policy", "_index", "_decoded")
+
+    def __init__(
+        self,
+        raw_items: typing.Iterable[tuple[str, typing.Any]],
+        policy: email.policy.Policy = email.policy.default,
+    ):
+        self._raw_items = tuple(raw_items)
+        self._policy = policy
+        self._index: dict[str, list[int]] | None = None
+        self._decoded: dict[int, str] = {}
+
+    @classmethod
+    def from_message(cls, msg: email.message.Message) -> "EmailHeaders":
+        return cls(msg.raw_items(), policy=msg.policy)
+
+    def _get_index(self) -> dict[str, list[int]]:
+        if self._index is None:
+            index = {}
+            for position, (name, _) in enumerate(self._raw_items):
+                index.setdefault(name.lower(), []).append(position)
+            self._index = index
+        return self._index
+
+    def _decode(self, position: int) -> str:
+        value = self._decoded.get(position)
+        if value is None:
+            value = self._policy.header_fetch_parse(*self._raw_items[position])
+            self._decoded[position] = value
+        return value
+
+    def get_all(self, name: str) -> list[str]:
+        return [
+            self._decode(position)
+            for position in self._get_index().get(name.lower(), [])
+        ]
+
+    def __getitem__(self, name: str) -> str:
+        positions = self._get_index().get(name.lower())
+        if not positions:
+            raise KeyError(name)
+        return self._decode(positions[0])
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and name.lower() in self._get_index()
+
+    def __iter__(self) -> typing.Iterator[str]:
+        seen = set()
+        for name, _ in self._raw_items:
+            lower_name = name.lower()
+            if lower_name in seen:
+                continue
+            seen.add(lower_name)
+            yield name
+
+    def __len__(self) -> int:
+        return len(self._get_index())
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({[name for name, _ in self._raw_items]!r})"
+
+    def __reduce__(self):
+        # only the raw values are sent to other processes, values set by code are
+        # header objects, which are converted back to str
+        return type(self), (
+            tuple((name, str(value)) for name, value in self._raw_items),
+        )
@@ -0,0 +1,214 @@
+import dataclasses
+import datetime
+import decimal
+import enum
+import json
+import logging
+import pathlib
+import queue
+import struct
+import threading
+import time
+import typing
+
+import pydantic
+
+from .data_types import ImportConfig
+from .data_types import OutputColumn
+from .processor import EmailFile
+from .processor import ProcessImportEvent
+from .processor import StartProcessingEmail
+
+logger = logging.getLogger(__name__)
+BINARY_MAGIC = b"BHEVLOG1"
+RECORD_LENGTH = struct.Struct(">I")
+_STOP = object()
+
+
+@enum.unique
+class EventLogFormat(str, enum.Enum):
+    # one JSON object per line
+    jsonl = "jsonl"
+    # records of JSON prefixed by their length, so that readers can skip records
+    # without scanning for line breaks
+    binary = "binary"
+
+
+_fields_cache: dict[type, tuple[str, ...]] = {}
+
+
+def _field_names(cls: type) -> tuple[str, ...]:
+    names = _fields_cache.get(cls)
+    if names is None:
+        names = tuple(field.name for field in dataclasses.fields(cls))
+        _fields_cache[cls] = names
+    return names
+
+
+def to_json_value(value: typing.Any) -> typing.Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    elif isinstance(value, enum.Enum):
+        return value.value
+    elif isinstance(value, str):
+        return str(value)
+    elif isinstance(value, OutputColumn):
+        # columns are in the config already, the name is enough to refer to it
+        return value.name
+    elif isinstance(value, ImportConfig):
+        return dict(name=value.name)
+    elif isinstance(value, EmailFile):
+        # headers are left out as they could be large
+        return dict(
+            id=value.id,
+            filepath=value.filepath,
+            subject=value.subject,
+            from_addresses=list(value.from_addresses),
+            recipients=list(value.recipients),
+            tags=value.tags,
+        )
+    elif isinstance(value, pydantic.BaseModel):
+        return value.model_dump(mode="json")
+    elif dataclasses.is_dataclass(value):
+        return {
+            name: to_json_value(getattr(value, name))
+            for name in _field_names(type(value))
+        }
+    elif isinstance(value, typing.Mapping):
+        return {str(key): to_json_value(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return [to_json_value(item) for item in value]
+    elif isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, (pathlib.PurePath, decimal.Decimal)):
+        return str(value)
+    return str(value)
+
+
+def serialize_event(event: ProcessImportEvent, timestamp: float) -> dict:
+    record = dict(
+        type=type(event).__name__,
+        ts=timestamp,
+        email_id=event.email_file.id,
+    )
+    if isinstance(event, StartProcessingEmail):
+        # other events refer to the email by id only
+        record["email_file"] = to_json_value(event.email_file)
+    for name in _field_names(type(event)):
+        if name == "email_file":
+            continue
+        record[name] = to_json_value(getattr(event, name))
+    return record
+
+
+def encode_record(record: dict, log_format: EventLogFormat) -> bytes:
+    payload = json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode(
+        "utf8"
+    )
+    if log_format == EventLogFormat.jsonl:
+        return payload + b"\n"
+    elif log_format == EventLogFormat.binary:
+        return RECORD_LENGTH.pack(len(payload)) + payload
+    else:
+        raise ValueError(f"Unexpected event log format {log_format}")
+
+
+class EventSink:
+    # Writes events to a log file in a background thread, so that serializing them
+    # doesn't slow down the processing. Events are only timestamped when written
+    # into the queue
+    def __init__(
+        self,
+        path: pathlib.Path,
+        log_format: EventLogFormat = EventLogFormat.jsonl,
+        max_queue_size: int = 10000,
+        clock: typing.Callable[[], float] = time.time,
+    ):
+        self.path = path
+        self.log_format = log_format
+        self.clock = clock
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._error: BaseException | None = None
+        self._closed = False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = not path.exists() or path.stat().st_size == 0
+        self._fo = path.open("ab")
+        if log_format == EventLogFormat.binary and new_file:
+            self._fo.write(BINARY_MAGIC)
+        self._thread = threading.Thread(
+            target=self._run, name="event-sink", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                event, timestamp = item
+                self._fo.write(
+                    encode_record(serialize_event(event, timestamp), self.log_format)
+                )
+                if self._queue.empty():
+                    self._fo.flush()
+        except BaseException as exc:
+            logger.exception("Failed to write event log %s", self.path)
+            self._error = exc
+            # keep draining, so that the producers are not blocked forever
+            while self._queue.get() is not _STOP:
+                pass
+        finally:
+            self._fo.close()
+
+    def write(self, event: ProcessImportEvent):
+        if self._closed:
+            raise ValueError("Event sink is closed already")
+        self._queue.put((event, self.clock()))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "EventSink":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def tee_events(
+    events: typing.Iterable[ProcessImportEvent], sink: EventSink
+) -> typing.Generator[ProcessImportEvent, None, None]:
+    for event in events:
+        sink.write(event)
+        yield event
+
+
+def read_events(path: pathlib.Path) -> typing.Generator[dict, None, None]:
+    # the format is detected by the magic bytes of binary logs
+    with path.open("rb") as fo:
+        magic = fo.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            fo.seek(0)
+            for line in fo:
+                if not line.strip():
+                    continue
+                yield json.loads(line)
+            return
+        while True:
+            header = fo.read(RECORD_LENGTH.size)
+            if not header:
+                return
+            if len(header) < RECORD_LENGTH.size:
+                raise ValueError(f"Truncated record length in event log {path}")
+            (length,) = RECORD_LENGTH.unpack(header)
+            payload = fo.read(length)
+            if len(payload) < length:
+                raise ValueError(f"Truncated record in event log {path}")
+            yield json.loads(payload)
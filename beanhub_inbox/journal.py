@@ -0,0 +1,93 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import typing
+
+from .data_types import OutputColumn
+
+logger = logging.getLogger(__name__)
+
+
+def make_column_config_hash(llm_model: str, template: str, column: OutputColumn) -> str:
+    payload = json.dumps(
+        dict(
+            llm_model=llm_model,
+            template=template,
+            column=column.model_dump(mode="json"),
+        ),
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf8")).hexdigest()
+
+
+class ExtractJournal:
+    # Append-only JSONL journal of extracted column values, so that an interrupted
+    # run can pick up the columns already extracted instead of asking LLM again
+    def __init__(self, journal_file: pathlib.Path):
+        self.journal_file = journal_file
+        self._values: dict[tuple[str, str, str], typing.Any] = {}
+        self._fo: typing.TextIO | None = None
+        if journal_file.exists():
+            with journal_file.open("rt") as fo:
+                for lineno, line in enumerate(fo):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line could be partially written when the process
+                        # died, just ignore it
+                        logger.warning(
+                            "Ignored broken line %s in journal file %s",
+                            lineno + 1,
+                            journal_file,
+                        )
+                        continue
+                    key = (record["email_id"], record["column"], record["config_hash"])
+                    self._values[key] = record["value"]
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def get(
+        self, email_id: str, column: str, config_hash: str
+    ) -> tuple[bool, typing.Any]:
+        key = (email_id, column, config_hash)
+        if key not in self._values:
+            return False, None
+        return True, self._values[key]
+
+    def record(self, email_id: str, column: str, config_hash: str, value: typing.Any):
+        if self._fo is None:
+            self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+            self._fo = self.journal_file.open("at")
+            if self._fo.tell() > 0 and not self._ends_with_newline():
+                # terminate the partially written line left by the crash
+                self._fo.write("\n")
+        line = json.dumps(
+            dict(
+                email_id=email_id,
+                column=column,
+                config_hash=config_hash,
+                value=value,
+            )
+        )
+        self._fo.write(line + "\n")
+        self._fo.flush()
+        os.fsync(self._fo.fileno())
+        self._values[(email_id, column, config_hash)] = value
+
+    def _ends_with_newline(self) -> bool:
+        with self.journal_file.open("rb") as fo:
+            fo.seek(-1, os.SEEK_END)
+            return fo.read(1) == b"\n"
+
+    def close(self):
+        if self._fo is not None:
+            self._fo.close()
+            self._fo = None
+
+    def remove(self):
+        self.close()
+        self._values = {}
+        self.journal_file.unlink(missing_ok=True)
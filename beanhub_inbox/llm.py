@@ -1,11 +1,22 @@
+import contextlib
 import datetime
+import enum
+import time
 import typing
 
-import ollama
 import pydantic
 
+from .concurrency import AdaptiveLimiter
+from .concurrency import LimiterSlot
 from .data_types import OutputColumn
 from .data_types import OutputColumnType
+from .deadline import Deadline
+from .deadline import Hedge
+from .deadline import stream_with_deadline
+from .token_usage import TokenUsage
+
+if typing.TYPE_CHECKING:
+    import ollama
 
 
 DECIMAL_REGEX = "^-?(0|[1-9][0-9]*)(\\.[0-9]+)?$"
@@ -55,6 +66,12 @@ DEFAULT_COLUMNS: list[OutputColumn] = [
 ]
 
 
+@enum.unique
+class LLMCall(str, enum.Enum):
+    think = "think"
+    extract = "extract"
+
+
 class LLMResponseBaseModel(pydantic.BaseModel):
     pass
 
@@ -95,38 +112,128 @@ def build_row_model(
     return pydantic.create_model("Row", **dict(fields), __base__=LLMResponseBaseModel)
 
 
+def _limiter_slot(
+    limiter: AdaptiveLimiter | None,
+) -> typing.ContextManager[LimiterSlot | None]:
+    if limiter is None:
+        return contextlib.nullcontext()
+    return limiter.slot()
+
+
+def _chat_stream(
+    deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    **kwargs,
+) -> "typing.Iterable[ollama.ChatResponse]":
+    import ollama
+
+    if deadline is None and hedge is None:
+        return ollama.chat(stream=True, **kwargs)
+    return _guarded_chat_stream(deadline=deadline, hedge=hedge, **kwargs)
+
+
+def _guarded_chat_stream(
+    deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    **kwargs,
+) -> "typing.Generator[ollama.ChatResponse, None, None]":
+    import ollama
+
+    factories = [lambda: ollama.chat(stream=True, **kwargs)]
+    hedge_after = None
+    if hedge is not None:
+        factories.append(lambda: hedge.client.chat(stream=True, **kwargs))
+        hedge_after = hedge.delay()
+    started_at = time.monotonic()
+    first = True
+    for part in stream_with_deadline(
+        factories, deadline=deadline, hedge_after=hedge_after
+    ):
+        if first and hedge is not None:
+            hedge.tracker.record(time.monotonic() - started_at)
+        first = False
+        yield part
+
+
 def _stream_think(
     model: str,
-    messages: list[ollama.Message],
+    messages: "list[ollama.Message]",
     end_token: str | None = None,
     options: dict | None = None,
-) -> typing.Generator[ollama.ChatResponse, None, ollama.Message]:
+    limiter: AdaptiveLimiter | None = None,
+    deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    usage: TokenUsage | None = None,
+) -> "typing.Generator[ollama.ChatResponse, None, ollama.Message]":
+    import ollama
+
     chunks: list[str] = []
-    for part in ollama.chat(
-        model=model, messages=messages, options=options, stream=True
-    ):
-        msg_content = part["message"]["content"]
-        yield part
-        chunks.append(msg_content)
-        if end_token is not None and msg_content == end_token:
-            break
+    with _limiter_slot(limiter) as slot:
+        for part in _chat_stream(
+            deadline=deadline,
+            hedge=hedge,
+            model=model,
+            messages=messages,
+            options=options,
+        ):
+            if slot is not None:
+                slot.first_token()
+            if usage is not None:
+                usage.add_response(part)
+            msg_content = part["message"]["content"]
+            yield part
+            chunks.append(msg_content)
+            if end_token is not None and msg_content == end_token:
+                break
     return ollama.Message(role="assistant", content="".join(chunks))
 
 
 def think(
     model: str,
-    messages: list[ollama.Message],
+    messages: "list[ollama.Message]",
     end_token: str | None = None,
     options: dict | None = None,
     stream: bool = False,
-) -> typing.Generator[ollama.ChatResponse, None, ollama.Message] | ollama.Message:
+    limiter: AdaptiveLimiter | None = None,
+    deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    usage: TokenUsage | None = None,
+) -> "typing.Generator[ollama.ChatResponse, None, ollama.Message] | ollama.Message":
+    import ollama
+
     if options is None:
         options = LLM_DEFAULT_OPTIONS
     if stream:
         return _stream_think(
-            model=model, messages=messages, options=options, end_token=end_token
+            model=model,
+            messages=messages,
+            options=options,
+            end_token=end_token,
+            limiter=limiter,
+            deadline=deadline,
+            hedge=hedge,
+            usage=usage,
         )
-    resp = ollama.chat(model=model, messages=messages, options=options)
+    with _limiter_slot(limiter):
+        if deadline is None and hedge is None:
+            resp = ollama.chat(model=model, messages=messages, options=options)
+            if usage is not None:
+                usage.add_response(resp)
+        else:
+            chunks = []
+            for part in _chat_stream(
+                deadline=deadline,
+                hedge=hedge,
+                model=model,
+                messages=messages,
+                options=options,
+            ):
+                if usage is not None:
+                    usage.add_response(part)
+                chunks.append(part.message.content)
+            resp = ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content="".join(chunks))
+            )
     if end_token is not None:
         resp.message.content = resp.message.content.split(end_token, 1)[0] + end_token
     return resp.message
@@ -137,23 +244,32 @@ T = typing.TypeVar("T", bound=LLMResponseBaseModel)
 
 def extract(
     model: str,
-    messages: list[ollama.Message],
+    messages: "list[ollama.Message]",
     response_model_cls: typing.Type[T],
     options: dict | None = None,
+    limiter: AdaptiveLimiter | None = None,
+    deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    usage: TokenUsage | None = None,
 ) -> T:
     if options is None:
         options = LLM_DEFAULT_OPTIONS
-    response = ollama.chat(
-        model=model,
-        messages=messages,
-        options=options,
-        format=response_model_cls.model_json_schema(),
-        stream=True,
-    )
-
     chunks = []
-    for part in response:
-        msg_content = part.message.content
-        chunks.append(msg_content)
+    with _limiter_slot(limiter) as slot:
+        response = _chat_stream(
+            deadline=deadline,
+            hedge=hedge,
+            model=model,
+            messages=messages,
+            options=options,
+            format=response_model_cls.model_json_schema(),
+        )
+        for part in response:
+            if slot is not None:
+                slot.first_token()
+            if usage is not None:
+                usage.add_response(part)
+            msg_content = part.message.content
+            chunks.append(msg_content)
 
     return response_model_cls.model_validate_json("".join(chunks))
@@ -0,0 +1,45 @@
+import re
+import typing
+
+from .data_types import StrContainsMatch
+from .data_types import StrExactMatch
+from .data_types import StrMatch
+from .data_types import StrOneOfMatch
+from .data_types import StrPrefixMatch
+from .data_types import StrSuffixMatch
+
+
+def match_str(pattern: StrMatch, value: str | None) -> typing.Tuple[bool, dict | None]:
+    if value is None:
+        return False, {}
+    if isinstance(pattern, str):
+        match = re.match(pattern, value)
+        if match is None:
+            return False, {}
+        return True, match.groupdict()
+    elif isinstance(pattern, StrExactMatch):
+        return value == pattern.equals, {}
+    elif isinstance(pattern, StrPrefixMatch):
+        return value.startswith(pattern.prefix), {}
+    elif isinstance(pattern, StrSuffixMatch):
+        return value.endswith(pattern.suffix), {}
+    elif isinstance(pattern, StrContainsMatch):
+        return pattern.contains in value, {}
+    elif isinstance(pattern, StrOneOfMatch):
+        if not pattern.regex:
+            if not pattern.ignore_case:
+                return value in pattern.one_of, {}
+            else:
+                return value.lower() in frozenset(
+                    item.lower() for item in pattern.one_of
+                ), {}
+        else:
+            for item in pattern.one_of:
+                match = re.match(
+                    item, value, flags=re.IGNORECASE if pattern.ignore_case else 0
+                )
+                if match is not None:
+                    return True, match.groupdict()
+            return False, {}
+    else:
+        raise ValueError(f"Unexpected str match type {type(pattern)}")
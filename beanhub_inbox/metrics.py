@@ -0,0 +1,439 @@
+import bisect
+import http.server
+import logging
+import math
+import os
+import pathlib
+import threading
+import typing
+
+from .processor import BackfillColumns
+from .processor import CSVRowExists
+from .processor import DuplicateEmail
+from .processor import FinishExtractingRow
+from .processor import IgnoreEmail
+from .processor import LLMConcurrency
+from .processor import LLMDeadlineExceeded
+from .processor import LLMTokenUsage
+from .processor import MatchImportRule
+from .processor import NoMatch
+from .processor import PreClassifyNotTransaction
+from .processor import ProcessImportEvent
+from .processor import ReplayJournalColumn
+from .processor import SQLiteRowExists
+from .processor import StartProcessingEmail
+from .processor import TemplateCacheHit
+
+logger = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: typing.Iterable[tuple[str, str]]) -> str:
+    items = [f'{name}="{escape_label_value(value)}"' for name, value in labels]
+    if not items:
+        return ""
+    return "{" + ",".join(items) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type: str = ""
+
+    def __init__(self, name: str, help: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, typing.Any]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"Expected labels {self.labelnames} for metric {self.name}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @property
+    def family_name(self) -> str:
+        return self.name
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.family_name} {self.help}",
+            f"# TYPE {self.family_name} {self.type}",
+            *self._render_samples(),
+        ]
+
+    def _render_samples(self) -> list[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    @property
+    def family_name(self) -> str:
+        # text format 0.0.4 expects the metadata under the sample name, like
+        # prometheus_client does
+        return f"{self.name}_total"
+
+    def inc(self, amount: float = 1.0, **labels):
+        if amount < 0:
+            raise ValueError("Counter can only be increased")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0.0)
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.family_name}{format_labels(zip(self.labelnames, key))} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels) -> float | None:
+        return self._values.get(self._label_values(labels))
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}{format_labels(zip(self.labelnames, key))} {format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # bucket counts, sum and count for each label values
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = ([0] * (len(self.buckets) + 1), [0.0, 0.0])
+                self._values[key] = state
+            counts, totals = state
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def get_count(self, **labels) -> int:
+        state = self._values.get(self._label_values(labels))
+        if state is None:
+            return 0
+        return int(state[1][1])
+
+    def get_sum(self, **labels) -> float:
+        state = self._values.get(self._label_values(labels))
+        if state is None:
+            return 0.0
+        return state[1][0]
+
+    def _render_samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), list(totals)))
+                for key, (counts, totals) in self._values.items()
+            )
+        lines = []
+        for key, (counts, (total, count)) in values:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{format_labels([*labels, ('le', format_value(bound))])} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_sum{format_labels(labels)} {format_value(total)}"
+            )
+            lines.append(f"{self.name}_count{format_labels(labels)} {int(count)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or (
+                    existing.labelnames != metric.labelnames
+                ):
+                    raise ValueError(
+                        f"Metric {metric.name} is registered already with a different type or labels"
+                    )
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(
+        self, name: str, help: str, labelnames: typing.Sequence[str] = ()
+    ) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(
+        self, name: str, help: str, labelnames: typing.Sequence[str] = ()
+    ) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class PipelineMetrics:
+    # Metrics of the processing pipeline, fed with the events and the stage timings
+    # reported by the processor
+    def __init__(self, registry: MetricsRegistry | None = None):
+        if registry is None:
+            registry = MetricsRegistry()
+        self.registry = registry
+        self.emails = registry.counter(
+            "beanhub_inbox_emails", "Number of emails processed"
+        )
+        self.rule_matches = registry.counter(
+            "beanhub_inbox_rule_matches",
+            "Number of emails matched by each import rule",
+            ["rule"],
+        )
+        self.no_matches = registry.counter(
+            "beanhub_inbox_no_matches", "Number of emails matched no import rule"
+        )
+        self.skipped_emails = registry.counter(
+            "beanhub_inbox_skipped_emails",
+            "Number of emails skipped without extracting with LLM",
+            ["reason"],
+        )
+        self.cache_hits = registry.counter(
+            "beanhub_inbox_cache_hits",
+            "Number of values taken from caches instead of LLM",
+            ["cache"],
+        )
+        self.rows = registry.counter(
+            "beanhub_inbox_rows",
+            "Number of rows extracted, either new rows or existing rows backfilled",
+            ["kind"],
+        )
+        # emails being backfilled, so that their finished rows are counted as
+        # backfill instead of new rows
+        self._backfill_email_ids: set[str] = set()
+        self.llm_tokens = registry.counter(
+            "beanhub_inbox_llm_tokens",
+            "Number of tokens reported by the LLM server",
+            ["call", "kind"],
+        )
+        self.llm_deadline_exceeded = registry.counter(
+            "beanhub_inbox_llm_deadline_exceeded",
+            "Number of LLM calls stopped by deadlines",
+            ["stage"],
+        )
+        self.llm_queue_latency = registry.histogram(
+            "beanhub_inbox_llm_queue_latency_seconds",
+            "Seconds spent waiting for a free LLM concurrency slot",
+        )
+        self.llm_time_to_first_token = registry.histogram(
+            "beanhub_inbox_llm_time_to_first_token_seconds",
+            "Seconds from sending a thinking request to receiving the first token",
+        )
+        self.llm_concurrency_limit = registry.gauge(
+            "beanhub_inbox_llm_concurrency_limit",
+            "Current limit of in-flight LLM requests",
+        )
+        self.stage_duration = registry.histogram(
+            "beanhub_inbox_stage_duration_seconds",
+            "Seconds spent on each stage of the pipeline",
+            ["stage"],
+        )
+
+    def observe_event(self, event: ProcessImportEvent):
+        if isinstance(event, StartProcessingEmail):
+            self.emails.inc()
+        elif isinstance(event, MatchImportRule):
+            rule = event.import_config.name
+            if rule is None:
+                rule = str(event.import_rule_index)
+            self.rule_matches.inc(rule=rule)
+        elif isinstance(event, NoMatch):
+            self.no_matches.inc()
+        elif isinstance(event, IgnoreEmail):
+            self.skipped_emails.inc(reason="ignored")
+        elif isinstance(event, (CSVRowExists, SQLiteRowExists)):
+            self.skipped_emails.inc(reason="row_exists")
+        elif isinstance(event, DuplicateEmail):
+            self.skipped_emails.inc(reason="duplicate")
+        elif isinstance(event, PreClassifyNotTransaction):
+            self.skipped_emails.inc(reason="pre_classified")
+        elif isinstance(event, TemplateCacheHit):
+            self.cache_hits.inc(cache="template")
+        elif isinstance(event, ReplayJournalColumn):
+            self.cache_hits.inc(cache="journal")
+        elif isinstance(event, BackfillColumns):
+            self._backfill_email_ids.add(event.email_file.id)
+        elif isinstance(event, FinishExtractingRow):
+            if event.email_file.id in self._backfill_email_ids:
+                self._backfill_email_ids.discard(event.email_file.id)
+                self.rows.inc(kind="backfill")
+            else:
+                self.rows.inc(kind="row")
+        elif isinstance(event, LLMTokenUsage):
+            self.llm_tokens.inc(
+                event.usage.prompt_tokens, call=event.call.value, kind="prompt"
+            )
+            self.llm_tokens.inc(
+                event.usage.completion_tokens, call=event.call.value, kind="completion"
+            )
+        elif isinstance(event, LLMDeadlineExceeded):
+            self.llm_deadline_exceeded.inc(stage=event.stage.value)
+        elif isinstance(event, LLMConcurrency):
+            self.llm_queue_latency.observe(event.queue_latency)
+            self.llm_concurrency_limit.set(event.limit)
+
+    def observe_events(
+        self, events: typing.Iterable[ProcessImportEvent]
+    ) -> typing.Generator[ProcessImportEvent, None, None]:
+        for event in events:
+            self.observe_event(event)
+            yield event
+
+    def observe_stage(self, stage: str, seconds: float):
+        self.stage_duration.observe(seconds, stage=stage)
+
+    def observe_time_to_first_token(self, seconds: float):
+        self.llm_time_to_first_token.observe(seconds)
+
+
+def write_textfile(registry: MetricsRegistry, path: pathlib.Path):
+    # node_exporter could read a partially written file, write to a temp file and
+    # rename instead
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(registry.render())
+    os.replace(tmp_path, path)
+
+
+def start_textfile_writer(
+    registry: MetricsRegistry,
+    path: pathlib.Path,
+    interval: float = 15.0,
+    stop_event: threading.Event | None = None,
+) -> threading.Thread:
+    if stop_event is None:
+        stop_event = threading.Event()
+
+    def run():
+        while True:
+            try:
+                write_textfile(registry, path)
+            except OSError:
+                logger.exception("Failed to write metrics textfile %s", path)
+            if stop_event.wait(interval):
+                break
+        # write the final values before exiting
+        write_textfile(registry, path)
+
+    thread = threading.Thread(target=run, name="metrics-textfile", daemon=True)
+    thread.start()
+    return thread
+
+
+def start_http_server(
+    registry: MetricsRegistry, port: int, host: str = "127.0.0.1"
+) -> http.server.ThreadingHTTPServer:
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args):
+            logger.debug(format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    )
+    thread.start()
+    return server
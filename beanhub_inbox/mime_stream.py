@@ -0,0 +1,156 @@
+import contextlib
+import dataclasses
+import email.message
+import email.parser
+import email.policy
+import io
+import mmap
+import os
+import pathlib
+import typing
+
+Buffer = bytes | mmap.mmap
+
+
+@dataclasses.dataclass(frozen=True)
+class SkippedPart:
+    content_type: str
+    filename: str | None
+    # size of the encoded payload in bytes
+    size: int
+
+
+@contextlib.contextmanager
+def map_file(filepath: pathlib.Path) -> typing.Generator[Buffer, None, None]:
+    with filepath.open("rb") as fo:
+        if os.fstat(fo.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            yield b""
+            return
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+
+def find_line_end(buffer: Buffer, start: int) -> int:
+    index = buffer.find(b"\n", start)
+    if index == -1:
+        return len(buffer)
+    return index + 1
+
+
+def find_header_end(buffer: Buffer, start: int = 0) -> int:
+    # headers end with the first empty line, which is included
+    if buffer[start : start + 1] == b"\n":
+        return start + 1
+    elif buffer[start : start + 2] == b"\r\n":
+        return start + 2
+    index = buffer.find(b"\n\n", start)
+    # only search before the LF one, to avoid scanning through the whole file
+    crlf_index = buffer.find(b"\n\r\n", start, index if index != -1 else len(buffer))
+    if crlf_index != -1:
+        index = crlf_index
+    if index == -1:
+        return len(buffer)
+    return find_line_end(buffer, index + 1)
+
+
+def parse_part_headers(header_bytes: bytes) -> email.message.Message:
+    return email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(
+        header_bytes
+    )
+
+
+def is_body_part(part: email.message.Message) -> bool:
+    return (
+        part.get_content_maintype() == "text"
+        and part.get_content_disposition() != "attachment"
+    )
+
+
+def strip_large_parts(
+    buffer: Buffer,
+    max_part_size: int,
+) -> tuple[bytes, list[SkippedPart]]:
+    # Scans the MIME structure of an email in the buffer, and returns the email with
+    # payloads of non-body parts larger than max_part_size removed, so that parsing it
+    # only takes memory for the headers and bodies no matter how large the
+    # attachments are. With a memory mapped buffer, only the headers and kept bodies
+    # are copied out of it
+    output = io.BytesIO()
+    skipped: list[SkippedPart] = []
+    boundaries: list[bytes] = []
+
+    def match_boundary(line: bytes) -> tuple[int, bool] | None:
+        stripped = line.rstrip()
+        # the innermost one first, outer ones for parts missing the closing boundary
+        for index in range(len(boundaries) - 1, -1, -1):
+            marker = b"--" + boundaries[index]
+            if stripped == marker:
+                return index, False
+            elif stripped == marker + b"--":
+                return index, True
+        return None
+
+    def find_boundary(start: int) -> tuple[int, int, tuple[int, bool]] | None:
+        # returns the start and end of the next boundary line
+        if not boundaries:
+            return None
+        line_start = start
+        while line_start < len(buffer):
+            if buffer[line_start : line_start + 2] == b"--":
+                line_end = find_line_end(buffer, line_start)
+                matched = match_boundary(buffer[line_start:line_end])
+                if matched is not None:
+                    return line_start, line_end, matched
+            index = buffer.find(b"\n--", line_start)
+            if index == -1:
+                return None
+            line_start = index + 1
+        return None
+
+    def write_body(part: email.message.Message, start: int, end: int):
+        size = end - start
+        if is_body_part(part) or size <= max_part_size:
+            output.write(buffer[start:end])
+            return
+        skipped.append(
+            SkippedPart(
+                content_type=part.get_content_type(),
+                filename=part.get_filename(),
+                size=size,
+            )
+        )
+
+    pos = 0
+    header_end = find_header_end(buffer, pos)
+    header_bytes = buffer[pos:header_end]
+    output.write(header_bytes)
+    # None for preamble and epilogue of multipart parts, which are dropped
+    part: email.message.Message | None = parse_part_headers(header_bytes)
+    pos = header_end
+    while True:
+        if part is not None and part.get_content_maintype() == "multipart":
+            boundary = part.get_boundary()
+            if boundary is not None:
+                boundaries.append(boundary.encode("ascii", "surrogateescape"))
+                part = None
+        found = find_boundary(pos)
+        body_end = found[0] if found is not None else len(buffer)
+        if part is not None:
+            write_body(part, pos, body_end)
+        if found is None:
+            break
+        line_start, line_end, (index, closing) = found
+        output.write(buffer[line_start:line_end])
+        pos = line_end
+        del boundaries[index + 1 :]
+        if closing:
+            boundaries.pop()
+            part = None
+            continue
+        header_end = find_header_end(buffer, pos)
+        header_bytes = buffer[pos:header_end]
+        output.write(header_bytes)
+        part = parse_part_headers(header_bytes)
+        pos = header_end
+    return output.getvalue(), skipped
@@ -0,0 +1,178 @@
+import datetime
+import decimal
+import logging
+import os
+import pathlib
+import typing
+import uuid
+
+import pyarrow.parquet
+
+from .data_types import OutputColumn
+from .data_types import OutputColumnType
+from .pre_classify import parse_valid_value
+
+logger = logging.getLogger(__name__)
+DECIMAL_PRECISION = 38
+DECIMAL_SCALE = 10
+PART_FILE_PATTERN = "part-*.parquet"
+
+
+def make_arrow_type(column_type: OutputColumnType) -> pyarrow.DataType:
+    if column_type == OutputColumnType.str:
+        return pyarrow.string()
+    elif column_type == OutputColumnType.int:
+        return pyarrow.int64()
+    elif column_type == OutputColumnType.decimal:
+        return pyarrow.decimal128(DECIMAL_PRECISION, DECIMAL_SCALE)
+    elif column_type == OutputColumnType.bool:
+        return pyarrow.bool_()
+    elif column_type == OutputColumnType.date:
+        return pyarrow.date32()
+    elif column_type == OutputColumnType.datetime:
+        return pyarrow.timestamp("us", tz="UTC")
+    else:
+        raise ValueError(f"Unexpected type {column_type}")
+
+
+def make_schema(columns: list[OutputColumn]) -> pyarrow.Schema:
+    return pyarrow.schema(
+        [
+            pyarrow.field("id", pyarrow.string(), nullable=False),
+            *(
+                pyarrow.field(column.name, make_arrow_type(column.type))
+                for column in columns
+            ),
+        ]
+    )
+
+
+def to_arrow_value(column_type: OutputColumnType, value: typing.Any) -> typing.Any:
+    # Values could come from LLM, rules, journal or existing CSV rows, so they are
+    # either already typed or in their string form
+    if value is None or value == "":
+        return None
+    if column_type == OutputColumnType.str:
+        return str(value)
+    elif column_type == OutputColumnType.int:
+        value = int(value)
+        if not -(2**63) <= value < 2**63:
+            raise ValueError(f"Value {value} is out of int64 range")
+        return value
+    elif column_type == OutputColumnType.decimal:
+        return decimal.Decimal(str(value)).quantize(
+            decimal.Decimal(1).scaleb(-DECIMAL_SCALE)
+        )
+    elif column_type == OutputColumnType.bool:
+        return parse_valid_value(value)
+    elif column_type == OutputColumnType.date:
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.date.fromisoformat(value)
+    elif column_type == OutputColumnType.datetime:
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.fromisoformat(value)
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+    else:
+        raise ValueError(f"Unexpected type {column_type}")
+
+
+def coerce_arrow_value(
+    column: OutputColumn, email_id: str, value: typing.Any
+) -> typing.Any:
+    # Values from thinking output and existing CSV rows are not validated, write
+    # null for the invalid ones instead of failing the whole part file
+    try:
+        return to_arrow_value(column.type, value)
+    except (ValueError, TypeError, ArithmeticError):
+        logger.warning(
+            "Invalid %s value %r of column %s for email %s, write null instead",
+            column.type.value,
+            value,
+            column.name,
+            email_id,
+        )
+        return None
+
+
+def read_ids(path: pathlib.Path) -> set[str]:
+    ids = set()
+    for part_file in sorted(path.glob(PART_FILE_PATTERN)):
+        # only the id column is read thanks to the columnar layout
+        table = pyarrow.parquet.read_table(part_file, columns=["id"])
+        ids.update(table.column("id").to_pylist())
+    return ids
+
+
+class ParquetOutput:
+    # Appends typed rows to a new part file in the Parquet dataset directory for each
+    # run, one row group per row_group_size rows. Parquet files cannot be modified, so
+    # rows already in the dataset are never written again
+    def __init__(
+        self,
+        path: pathlib.Path,
+        columns: list[OutputColumn],
+        row_group_size: int = 1000,
+    ):
+        self.path = path
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.schema = make_schema(columns)
+        self.ids = read_ids(path) if path.exists() else set()
+        self._pending_rows: list[dict] = []
+        self._part_file: pathlib.Path | None = None
+        self._tmp_part_file: pathlib.Path | None = None
+        self._writer: pyarrow.parquet.ParquetWriter | None = None
+
+    def has_row(self, email_id: str) -> bool:
+        return email_id in self.ids
+
+    def add_row(self, row: dict):
+        if row["id"] in self.ids:
+            return
+        self._pending_rows.append(row)
+        self.ids.add(row["id"])
+        if len(self._pending_rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_rows:
+            return
+        if self._writer is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            name = f"part-{datetime.datetime.now(datetime.timezone.utc):%Y%m%d%H%M%S}-{uuid.uuid4().hex}.parquet"
+            self._part_file = self.path / name
+            # write to a hidden file first, so that readers never see a part file
+            # without footer
+            self._tmp_part_file = self.path / f".{name}.tmp"
+            self._writer = pyarrow.parquet.ParquetWriter(
+                self._tmp_part_file, self.schema
+            )
+        arrays = [
+            pyarrow.array([row["id"] for row in self._pending_rows], pyarrow.string()),
+            *(
+                pyarrow.array(
+                    [
+                        coerce_arrow_value(column, row["id"], row.get(column.name))
+                        for row in self._pending_rows
+                    ],
+                    make_arrow_type(column.type),
+                )
+                for column in self.columns
+            ),
+        ]
+        self._writer.write_table(
+            pyarrow.Table.from_arrays(arrays, schema=self.schema),
+            row_group_size=self.row_group_size,
+        )
+        self._pending_rows = []
+
+    def close(self):
+        self.flush()
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._tmp_part_file, self._part_file)
+        self._writer = None
@@ -0,0 +1,342 @@
+import csv
+import dataclasses
+import logging
+import math
+import pathlib
+import sqlite3
+import time
+import typing
+import uuid
+
+from jinja2 import Template
+
+from .backfill import find_backfill_columns
+from .data_types import ExtractImportAction
+from .data_types import IgnoreImportAction
+from .data_types import InboxDoc
+from .data_types import OutputColumn
+from .llm import build_row_model
+from .llm import DEFAULT_COLUMNS
+from .processor import build_email_file
+from .processor import DEFAULT_PROMPT_TEMPLATE
+from .processor import expand_input_loops
+from .processor import extract_email_text
+from .processor import match_import_config
+from .processor import match_input_config
+from .processor import parse_email_file
+from .processor import resolve_workdir_path
+from .processor import walk_dir_files
+from .rule_extract import extract_columns_by_rules
+from .sharding import Shard
+from .sqlite_output import quote_identifier
+from .templates import make_environment
+
+logger = logging.getLogger(__name__)
+# rough average for English text with common tokenizers
+DEFAULT_CHARS_PER_TOKEN = 4.0
+DEFAULT_THINK_TOKENS = 512
+DEFAULT_PROMPT_TOKENS_PER_SECOND = 500.0
+DEFAULT_COMPLETION_TOKENS_PER_SECOND = 20.0
+
+
+@dataclasses.dataclass
+class ImportRulePlan:
+    import_rule_index: int
+    name: str | None
+    emails: int = 0
+    ignored: int = 0
+    # emails with a row in the output already
+    existing: int = 0
+    backfill: int = 0
+    extract: int = 0
+    # emails failed to be parsed for extraction
+    failed: int = 0
+    rule_columns: int = 0
+    llm_columns: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+@dataclasses.dataclass
+class ImportPlan:
+    files: int = 0
+    matched_files: int = 0
+    no_match: int = 0
+    rules: dict[int, ImportRulePlan] = dataclasses.field(default_factory=dict)
+    # seconds spent on planning
+    elapsed: float = 0.0
+
+    @property
+    def extract(self) -> int:
+        return sum(rule.extract + rule.backfill for rule in self.rules.values())
+
+    @property
+    def existing(self) -> int:
+        return sum(rule.existing for rule in self.rules.values())
+
+    @property
+    def llm_columns(self) -> int:
+        return sum(rule.llm_columns for rule in self.rules.values())
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(rule.prompt_tokens for rule in self.rules.values())
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(rule.completion_tokens for rule in self.rules.values())
+
+    def estimate_seconds(
+        self,
+        prompt_tokens_per_second: float = DEFAULT_PROMPT_TOKENS_PER_SECOND,
+        completion_tokens_per_second: float = DEFAULT_COMPLETION_TOKENS_PER_SECOND,
+        concurrency: int = 1,
+    ) -> float:
+        return (
+            self.prompt_tokens / prompt_tokens_per_second
+            + self.completion_tokens / completion_tokens_per_second
+        ) / concurrency
+
+
+def estimate_tokens(text: str, chars_per_token: float = DEFAULT_CHARS_PER_TOKEN) -> int:
+    return math.ceil(len(text) / chars_per_token)
+
+
+def read_csv_rows(output_csv: pathlib.Path) -> dict[str, dict[str, str]]:
+    if not output_csv.exists():
+        return {}
+    with output_csv.open("rt") as fo:
+        reader = csv.DictReader(fo)
+        if "id" not in reader.fieldnames:
+            raise ValueError(
+                f"No id column found in the existing output csv file at {output_csv}"
+            )
+        return {row["id"]: row for row in reader}
+
+
+def read_sqlite_rows(database: pathlib.Path, table: str) -> dict[str, dict[str, str]]:
+    if not database.exists():
+        return {}
+    # read-only, planning should never create or change the database
+    conn = sqlite3.connect(f"{database.as_uri()}?mode=ro", uri=True)
+    try:
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.execute(f"SELECT * FROM {quote_identifier(table)}")
+        except sqlite3.OperationalError:
+            # no table yet
+            return {}
+        return {row["id"]: dict(row) for row in cursor}
+    finally:
+        conn.close()
+
+
+def plan_imports(
+    inbox_doc: InboxDoc,
+    input_dir: pathlib.Path,
+    workdir_path: pathlib.Path,
+    filepaths: typing.Iterable[pathlib.Path] | None = None,
+    shard: Shard | None = None,
+    chars_per_token: float = DEFAULT_CHARS_PER_TOKEN,
+    think_tokens: int = DEFAULT_THINK_TOKENS,
+) -> ImportPlan:
+    # Goes through the same file discovery, matching and output row lookup as
+    # process_imports without calling the LLM, and estimates the tokens of the
+    # prompts to be sent. It assumes one thinking call per column producing
+    # think_tokens, and all the columns to be extracted, so it's an upper bound for
+    # emails turning out to be not valid
+    started_at = time.monotonic()
+    template_env = make_environment()
+    workdir_path = workdir_path.resolve().absolute()
+    expanded_input_configs = list(
+        expand_input_loops(
+            template_env=template_env,
+            inputs=inbox_doc.inputs,
+            omit_token=uuid.uuid4().hex,
+        )
+    )
+    output_rows: dict[tuple, dict[str, dict[str, str]]] = {}
+    templates: dict[str, Template] = {}
+    # keyed by id as the columns live in inbox_doc for the whole planning
+    json_schemas: dict[int, dict] = {}
+
+    def get_output_rows(action: ExtractImportAction) -> dict[str, dict[str, str]]:
+        output_csv = resolve_workdir_path(workdir_path, action.extract.output_csv)
+        sqlite_config = action.extract.output_sqlite
+        if sqlite_config is not None:
+            database = resolve_workdir_path(workdir_path, sqlite_config.database)
+            if shard is not None:
+                database = shard.output_path(database)
+            key = ("sqlite", database, sqlite_config.table)
+            if key not in output_rows:
+                rows = read_sqlite_rows(database, sqlite_config.table)
+                if not rows:
+                    # rows are migrated from the CSV file on the first run
+                    rows = read_csv_rows(
+                        shard.output_path(output_csv)
+                        if shard is not None
+                        else output_csv
+                    )
+                if shard is not None:
+                    # rows extracted by previous runs could be merged already
+                    rows = read_csv_rows(output_csv) | rows
+                output_rows[key] = rows
+            return output_rows[key]
+        key = ("csv", output_csv)
+        if key not in output_rows:
+            if shard is not None:
+                # rows extracted by previous runs could be merged already
+                rows = read_csv_rows(output_csv) | read_csv_rows(
+                    shard.output_path(output_csv)
+                )
+            else:
+                rows = read_csv_rows(output_csv)
+            output_rows[key] = rows
+        return output_rows[key]
+
+    def estimate_prompt_tokens(template: str, column: OutputColumn, text: str) -> int:
+        compiled_template = templates.get(template)
+        if compiled_template is None:
+            compiled_template = template_env.from_string(template)
+            templates[template] = compiled_template
+        json_schema = json_schemas.get(id(column))
+        if json_schema is None:
+            json_schema = build_row_model(output_columns=[column]).model_json_schema()
+            json_schemas[id(column)] = json_schema
+        prompt = compiled_template.render(
+            json_schema=json_schema,
+            content=text,
+            column=column,
+        )
+        return estimate_tokens(prompt, chars_per_token=chars_per_token)
+
+    plan = ImportPlan()
+    if filepaths is None:
+        filepaths = walk_dir_files(input_dir)
+    for filepath in sorted(filepaths):
+        if shard is not None and not shard.contains(filepath.relative_to(input_dir)):
+            continue
+        if not filepath.is_file():
+            continue
+        plan.files += 1
+        if match_input_config(expanded_input_configs, filepath) is None:
+            continue
+        plan.matched_files += 1
+        # headers are enough for matching and finding existing rows, the body is
+        # only parsed for emails to be extracted
+        email_file = build_email_file(
+            filepath=filepath.relative_to(input_dir),
+            parsed_email=parse_email_file(filepath, headers_only=True),
+        )
+        import_match = match_import_config(inbox_doc.imports, email_file)
+        if import_match is None:
+            plan.no_match += 1
+            continue
+        import_rule_index, import_config, match_vars = import_match
+        rule_plan = plan.rules.get(import_rule_index)
+        if rule_plan is None:
+            rule_plan = ImportRulePlan(
+                import_rule_index=import_rule_index, name=import_config.name
+            )
+            plan.rules[import_rule_index] = rule_plan
+        rule_plan.emails += 1
+
+        for action in import_config.actions:
+            if isinstance(action, IgnoreImportAction):
+                rule_plan.ignored += 1
+                continue
+            elif not isinstance(action, ExtractImportAction):
+                raise ValueError(f"Unexpected action type {type(action)}")
+            columns = DEFAULT_COLUMNS
+            if action.extract.columns is not None:
+                columns = action.extract.columns
+            existing_row = get_output_rows(action).get(email_file.id)
+            if existing_row is not None:
+                extract_columns = []
+                if action.extract.backfill:
+                    extract_columns = find_backfill_columns(columns, existing_row)
+                if not extract_columns:
+                    rule_plan.existing += 1
+                    continue
+                rule_plan.backfill += 1
+            else:
+                extract_columns = columns
+                rule_plan.extract += 1
+
+            try:
+                parsed_email = parse_email_file(filepath)
+                text = extract_email_text(
+                    email_file=email_file, parsed_email=parsed_email
+                )
+            except ValueError:
+                logger.warning(
+                    "Failed to extract text from email %s", email_file.id, exc_info=True
+                )
+                rule_plan.failed += 1
+                continue
+            rule_values = extract_columns_by_rules(
+                columns=extract_columns,
+                text=text,
+                headers=email_file.headers,
+                match_vars=match_vars,
+            )
+            template = action.extract.template
+            if template is None:
+                template = DEFAULT_PROMPT_TEMPLATE
+            for column in extract_columns:
+                if column.name in rule_values:
+                    rule_plan.rule_columns += 1
+                    continue
+                rule_plan.llm_columns += 1
+                rule_plan.prompt_tokens += estimate_prompt_tokens(
+                    template, column, text
+                )
+                rule_plan.completion_tokens += think_tokens
+    plan.elapsed = time.monotonic() - started_at
+    return plan
+
+
+def format_plan(
+    plan: ImportPlan,
+    prompt_tokens_per_second: float = DEFAULT_PROMPT_TOKENS_PER_SECOND,
+    completion_tokens_per_second: float = DEFAULT_COMPLETION_TOKENS_PER_SECOND,
+    concurrency: int = 1,
+) -> str:
+    estimated_seconds = plan.estimate_seconds(
+        prompt_tokens_per_second=prompt_tokens_per_second,
+        completion_tokens_per_second=completion_tokens_per_second,
+        concurrency=concurrency,
+    )
+    lines = [
+        f"Files: {plan.files} ({plan.matched_files} matched inputs, {plan.no_match} matched no import rule)",
+        f"Emails to extract: {plan.extract} ({plan.existing} exist in outputs already)",
+        f"LLM columns: {plan.llm_columns}",
+        f"Estimated tokens: {plan.prompt_tokens} prompt, {plan.completion_tokens} completion",
+        f"Estimated duration: {estimated_seconds:.0f}s with concurrency {concurrency}",
+        f"Planned in {plan.elapsed:.2f}s",
+        "",
+        "Rule\tEmails\tIgnored\tExisting\tBackfill\tExtract\tFailed\tRule columns\tLLM columns\tPrompt tokens\tCompletion tokens",
+    ]
+    for index, rule in sorted(plan.rules.items()):
+        name = rule.name if rule.name is not None else str(index)
+        lines.append(
+            "\t".join(
+                map(
+                    str,
+                    [
+                        name,
+                        rule.emails,
+                        rule.ignored,
+                        rule.existing,
+                        rule.backfill,
+                        rule.extract,
+                        rule.failed,
+                        rule.rule_columns,
+                        rule.llm_columns,
+                        rule.prompt_tokens,
+                        rule.completion_tokens,
+                    ],
+                )
+            )
+        )
+    return "\n".join(lines)
@@ -0,0 +1,128 @@
+import collections
+import dataclasses
+import email.utils
+import enum
+import re
+import typing
+
+from .data_types import PreClassifyConfig
+from .matchers import match_str
+
+CURRENCY_SYMBOLS = "$€£¥₹₩"
+CURRENCY_CODES = (
+    "USD",
+    "EUR",
+    "GBP",
+    "JPY",
+    "CNY",
+    "TWD",
+    "HKD",
+    "CAD",
+    "AUD",
+    "NZD",
+    "SGD",
+    "INR",
+    "KRW",
+    "CHF",
+)
+_CURRENCY = f"(?:[{CURRENCY_SYMBOLS}]|\\b(?:{'|'.join(CURRENCY_CODES)})\\b)"
+_NUMBER = r"-?[0-9][0-9,]*(?:\.[0-9]+)?"
+AMOUNT_REGEX = re.compile(
+    f"{_CURRENCY}\\s?{_NUMBER}|{_NUMBER}\\s?{_CURRENCY}", flags=re.IGNORECASE
+)
+
+
+@enum.unique
+class PreClassifySignal(str, enum.Enum):
+    from_address = "from_address"
+    subject_keyword = "subject_keyword"
+    no_amount = "no_amount"
+    sender_history = "sender_history"
+
+
+@dataclasses.dataclass(frozen=True)
+class PreClassifyResult:
+    signal: PreClassifySignal
+    detail: str
+
+
+def normalize_address(address: str) -> str:
+    _, addr = email.utils.parseaddr(address)
+    if not addr:
+        addr = address
+    return addr.strip().lower()
+
+
+class SenderHistory:
+    def __init__(self):
+        self._valid_counts: collections.Counter[str] = collections.Counter()
+        self._invalid_counts: collections.Counter[str] = collections.Counter()
+
+    def record(self, from_addresses: list[str], valid: bool):
+        counts = self._valid_counts if valid else self._invalid_counts
+        for address in from_addresses:
+            counts[normalize_address(address)] += 1
+
+    def invalid_count(self, address: str) -> int:
+        address = normalize_address(address)
+        if self._valid_counts[address]:
+            return 0
+        return self._invalid_counts[address]
+
+
+def contains_amount(text: str) -> bool:
+    return AMOUNT_REGEX.search(text) is not None
+
+
+def pre_classify(
+    config: PreClassifyConfig,
+    subject: str | None,
+    from_addresses: list[str],
+    text: str,
+    sender_history: SenderHistory | None = None,
+) -> PreClassifyResult | None:
+    # Only tell whether the email is definitely not a transaction, None means not sure
+    if config.skip_from_addresses is not None:
+        for address in from_addresses:
+            normalized_address = normalize_address(address)
+            for pattern in config.skip_from_addresses:
+                matched, _ = match_str(pattern, normalized_address)
+                if matched:
+                    return PreClassifyResult(
+                        signal=PreClassifySignal.from_address,
+                        detail=normalized_address,
+                    )
+    if config.skip_subject_keywords is not None and subject is not None:
+        lower_subject = subject.lower()
+        for keyword in config.skip_subject_keywords:
+            if keyword.lower() in lower_subject:
+                return PreClassifyResult(
+                    signal=PreClassifySignal.subject_keyword,
+                    detail=keyword,
+                )
+    if config.sender_history_threshold is not None and sender_history is not None:
+        for address in from_addresses:
+            invalid_count = sender_history.invalid_count(address)
+            if invalid_count >= config.sender_history_threshold:
+                return PreClassifyResult(
+                    signal=PreClassifySignal.sender_history,
+                    detail=f"{normalize_address(address)} sent {invalid_count} non-transaction emails",
+                )
+    # scanning the content is the most expensive check, so do it last
+    if config.require_amount and not contains_amount(text):
+        return PreClassifyResult(
+            signal=PreClassifySignal.no_amount,
+            detail="No currency amount found in the content",
+        )
+    return None
+
+
+def parse_valid_value(value: typing.Any) -> bool | None:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if value.lower() == "true":
+            return True
+        elif value.lower() == "false":
+            return False
+    return None
@@ -1,19 +1,23 @@
+import collections
+import concurrent.futures
+import contextlib
 import csv
 import dataclasses
 import email.message
+import email.parser
 import email.policy
 import json
 import logging
 import os
 import pathlib
 import re
+import time
 import typing
 import uuid
 
-import ollama
-from jinja2.sandbox import SandboxedEnvironment
-from lxml import etree
-
+from .backfill import CSVBackfill
+from .backfill import find_backfill_columns
+from .concurrency import AdaptiveLimiter
 from .data_types import ArchiveInboxAction
 from .data_types import EmailFileMatchRule
 from .data_types import ExtractImportAction
@@ -27,23 +31,66 @@ from .data_types import InboxDoc
 from .data_types import InboxEmail
 from .data_types import InboxMatch
 from .data_types import InputConfig
+from .data_types import LatencyConfig
 from .data_types import OutputColumn
 from .data_types import SimpleFileMatch
-from .data_types import StrContainsMatch
 from .data_types import StrExactMatch
-from .data_types import StrMatch
-from .data_types import StrOneOfMatch
-from .data_types import StrPrefixMatch
 from .data_types import StrRegexMatch
-from .data_types import StrSuffixMatch
+from .data_types import ThinkingUpdateConfig
+from .data_types import ThinkingUpdateMode
+from .deadline import Deadline
+from .deadline import DeadlineExceeded
+from .deadline import DeadlineStage
+from .deadline import Hedge
+from .deadline import LatencyTracker
+from .dedup import DuplicateDetector
+from .dedup import DuplicateSignal
+from .email_headers import EmailHeaders
+from .journal import ExtractJournal
+from .journal import make_column_config_hash
 from .llm import build_row_model
 from .llm import DEFAULT_COLUMNS
 from .llm import extract
+from .llm import LLM_DEFAULT_OPTIONS
+from .llm import LLMCall
 from .llm import think
+from .matchers import match_str
+from .mime_stream import find_header_end
+from .mime_stream import map_file
+from .mime_stream import strip_large_parts
+from .pre_classify import parse_valid_value
+from .pre_classify import pre_classify
+from .pre_classify import PreClassifySignal
+from .pre_classify import SenderHistory
+from .rule_extract import extract_columns_by_rules
+from .sharding import Shard
+from .sqlite_output import SQLiteOutput
+from .template_cache import html_fingerprint
+from .template_cache import make_template_key
+from .template_cache import TemplateCache
 from .templates import make_environment
+from .token_usage import TokenAccounting
+from .token_usage import TokenBudgetScope
+from .token_usage import TokenUsage
+from .tracing import child_span
+from .tracing import Span
+from .tracing import SpanKind
+from .tracing import start_child_span
+from .tracing import Tracer
+from .tracing import tracer_span
+from .utils import file_lock
 from .utils import GeneratorResult
+from .utils import get_header
 from .utils import parse_tags
 
+# ollama, lxml, email_validator and jinja2 are only imported on first use, so that
+# importing this module stays fast for short-lived processes routing inbox emails
+if typing.TYPE_CHECKING:
+    from jinja2.sandbox import SandboxedEnvironment
+
+    from .metrics import PipelineMetrics
+    from .parquet_output import ParquetOutput
+
 logger = logging.getLogger(__name__)
 BEANHUB_INBOX_DOMAINS = frozenset(
     ["inbox.beanhub.io", "stage-inbox.beanhub.io", "dev-inbox.beanhub.io"]
@@ -77,17 +124,28 @@ class RenderedInputConfig:
     input_config: InputConfig
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class EmailFile:
     id: str
     filepath: str
     subject: str
     from_addresses: list[str]
     recipients: list[str]
-    headers: dict[str, str]
+    # EmailHeaders decoding the values on first access for parsed emails
+    headers: typing.Mapping[str, str]
     tags: list[str]
 
 
+@dataclasses.dataclass(frozen=True)
+class EmailBody:
+    # Text and HTML of an email extracted by a parse worker, so that only these are
+    # sent back to the main process instead of the whole parsed email
+    text: str | None = None
+    html: str | None = None
+    # raised when the text is needed, as the email could be skipped before that
+    error: str | None = None
+
+
 @dataclasses.dataclass(frozen=True)
 class ProcessImportEvent:
     email_file: EmailFile
@@ -120,6 +178,49 @@ class CSVRowExists(ProcessImportEvent):
     lineno: int
 
 
+@dataclasses.dataclass(frozen=True)
+class DuplicateEmail(ProcessImportEvent):
+    duplicate_of: str
+    signal: DuplicateSignal
+
+
+@dataclasses.dataclass(frozen=True)
+class DuplicateRowNotFound(ProcessImportEvent):
+    duplicate_of: str
+
+
+@dataclasses.dataclass(frozen=True)
+class PreClassifyNotTransaction(ProcessImportEvent):
+    signal: PreClassifySignal
+    detail: str
+
+
+@dataclasses.dataclass(frozen=True)
+class TemplateCacheHit(ProcessImportEvent):
+    template_key: str
+    columns: list[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class TemplateCacheDrift(ProcessImportEvent):
+    template_key: str
+    columns: list[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class SQLiteRowExists(ProcessImportEvent):
+    database: pathlib.Path
+    table: str
+
+
+@dataclasses.dataclass(frozen=True)
+class BackfillColumns(ProcessImportEvent):
+    output_csv: pathlib.Path
+    # None for rows in SQLite database
+    lineno: int | None
+    columns: list[str]
+
+
 @dataclasses.dataclass(frozen=True)
 class StartExtractingColumn(ProcessImportEvent):
     column: OutputColumn
@@ -143,6 +244,42 @@ class FinishThinking(ProcessImportEvent):
     thinking: str
 
 
+@dataclasses.dataclass(frozen=True)
+class ReplayJournalColumn(ProcessImportEvent):
+    column: OutputColumn
+    journal_file: pathlib.Path
+
+
+@dataclasses.dataclass(frozen=True)
+class LLMConcurrency(ProcessImportEvent):
+    column: OutputColumn
+    # current max number of in-flight LLM requests found by the adaptive limiter
+    limit: int
+    in_flight: int
+    queue_latency: float
+    time_to_first_token: float | None
+
+
+@dataclasses.dataclass(frozen=True)
+class LLMDeadlineExceeded(ProcessImportEvent):
+    column: OutputColumn
+    stage: DeadlineStage
+
+
+@dataclasses.dataclass(frozen=True)
+class LLMTokenUsage(ProcessImportEvent):
+    column: OutputColumn
+    call: LLMCall
+    usage: TokenUsage
+
+
+@dataclasses.dataclass(frozen=True)
+class TokenBudgetExceeded(ProcessImportEvent):
+    scope: TokenBudgetScope
+    usage: TokenUsage
+    budget: int
+
+
 @dataclasses.dataclass(frozen=True)
 class FinishExtractingColumn(ProcessImportEvent):
     column: OutputColumn
@@ -154,42 +291,6 @@ class FinishExtractingRow(ProcessImportEvent):
     row: dict
 
 
-def match_str(pattern: StrMatch, value: str | None) -> typing.Tuple[bool, dict | None]:
-    if value is None:
-        return False, {}
-    if isinstance(pattern, str):
-        match = re.match(pattern, value)
-        if match is None:
-            return False, {}
-        return True, match.groupdict()
-    elif isinstance(pattern, StrExactMatch):
-        return value == pattern.equals, {}
-    elif isinstance(pattern, StrPrefixMatch):
-        return value.startswith(pattern.prefix), {}
-    elif isinstance(pattern, StrSuffixMatch):
-        return value.endswith(pattern.suffix), {}
-    elif isinstance(pattern, StrContainsMatch):
-        return pattern.contains in value, {}
-    elif isinstance(pattern, StrOneOfMatch):
-        if not pattern.regex:
-            if not pattern.ignore_case:
-                return value in pattern.one_of, {}
-            else:
-                return value.lower() in frozenset(
-                    item.lower() for item in pattern.one_of
-                ), {}
-        else:
-            for item in pattern.one_of:
-                match = re.match(
-                    item, value, flags=re.IGNORECASE if pattern.ignore_case else 0
-                )
-                if match is not None:
-                    return True, match.groupdict()
-            return False, {}
-    else:
-        raise ValueError(f"Unexpected str match type {type(pattern)}")
-
-
 def match_inbox_email(inbox_email: InboxEmail, match: InboxMatch) -> bool:
     if match.tags is not None:
         if inbox_email.tags is None:
@@ -218,7 +319,7 @@ def match_inbox_email(inbox_email: InboxEmail, match: InboxMatch) -> bool:
 
 
 def process_inbox_email(
-    template_env: SandboxedEnvironment,
+    template_env: "SandboxedEnvironment",
     inbox_email: InboxEmail,
     inbox_configs: list[InboxConfig],
 ) -> InboxAction | None:
@@ -260,7 +361,7 @@ def render_input_config_match(
 
 
 def expand_input_loops(
-    template_env: SandboxedEnvironment,
+    template_env: "SandboxedEnvironment",
     inputs: list[InputConfig],
     omit_token: str,
 ) -> typing.Generator[RenderedInputConfig, None, None]:
@@ -300,7 +401,20 @@ def match_file(
         raise ValueError(f"Unexpected file match type {type(pattern)}")
 
 
+def match_input_config(
+    expanded_input_configs: list[RenderedInputConfig], filepath: pathlib.Path
+) -> InputConfig | None:
+    for input_config_index, rendered_input_config in enumerate(expanded_input_configs):
+        input_config = rendered_input_config.input_config
+        if match_file(input_config.match, filepath):
+            logger.info("Matched input config %s", input_config_index)
+            return input_config
+    return None
+
+
 def extract_html_text(html: str) -> str:
+    from lxml import etree
+
     parser = etree.HTMLParser()
     tree = etree.fromstring(html, parser)
     # remove unwanted tags such as style
@@ -326,20 +440,22 @@ def build_email_file(
     filepath: pathlib.Path,
     parsed_email: email.message.EmailMessage,
 ) -> EmailFile:
-    received = parsed_email.get("Received")
+    headers = EmailHeaders.from_message(parsed_email)
+    received = headers.get("Received")
     tags = None
     if received is not None:
         email_address = extract_received_for_email(received)
         # TODO: make it possible for tags to work for email collected outside of BeanHub
         tags = parse_tags(email_address, domains=BEANHUB_INBOX_DOMAINS)
-    from_addresses = split_emails(parsed_email["From"])
-    recipients = split_emails(parsed_email["To"])
-    subject = parsed_email["Subject"]
+    from_addresses = split_emails(headers["From"])
+    recipients = split_emails(headers["To"])
+    subject = headers.get("Subject")
     return EmailFile(
         id=filepath.stem,
         filepath=str(filepath),
-        subject=subject,
-        headers=dict(parsed_email),
+        # plain str instead of the parsed header object
+        subject=str(subject) if subject is not None else None,
+        headers=headers,
         from_addresses=from_addresses,
         recipients=recipients,
         tags=tags,
@@ -368,6 +484,50 @@ def match_email_file(
     return True, match_vars
 
 
+def match_import_config(
+    imports: list[ImportConfig], email_file: EmailFile
+) -> tuple[int, ImportConfig, dict] | None:
+    for index, import_config in enumerate(imports):
+        if import_config.match is None:
+            return index, import_config, {}
+        else:
+            email_matched, match_vars = match_email_file(
+                email_file=email_file,
+                rule=import_config.match,
+            )
+            if email_matched:
+                return index, import_config, match_vars
+            break
+    return None
+
+
+def parse_email_file(
+    filepath: pathlib.Path,
+    headers_only: bool = False,
+    max_part_size: int | None = None,
+) -> email.message.EmailMessage:
+    parser = email.parser.BytesParser(policy=email.policy.EmailPolicy())
+    if not headers_only and max_part_size is None:
+        with filepath.open("rb") as fo:
+            return parser.parse(fo)
+    # work on the mapped file, so that only the needed bytes are copied out of it
+    with map_file(filepath) as buffer:
+        if headers_only:
+            return parser.parsebytes(
+                buffer[: find_header_end(buffer)], headersonly=True
+            )
+        content, skipped_parts = strip_large_parts(buffer, max_part_size=max_part_size)
+    for skipped_part in skipped_parts:
+        logger.info(
+            "Skipped %s part %s of %s bytes in email %s",
+            skipped_part.content_type,
+            skipped_part.filename,
+            skipped_part.size,
+            filepath,
+        )
+    return parser.parsebytes(content)
+
+
 def extract_json_block(text: str) -> typing.Generator[dict, None, None]:
     for match in re.finditer("```(json\n)?([^`]*)```", text, flags=re.IGNORECASE):
         try:
@@ -376,124 +536,1014 @@ def extract_json_block(text: str) -> typing.Generator[dict, None, None]:
             continue
 
 
+def extract_email_text(
+    email_file: EmailFile, parsed_email: email.message.EmailMessage
+) -> str:
+    body = parsed_email.get_body()
+    if body.get_content_type() == "text/html":
+        return extract_html_text(body.get_content())
+    elif body.get_content_type() == "text/text":
+        return body.get_content()
+    elif body.get_content_type() == "multipart/related":
+        raise ValueError("Email content with embedded image is not supported yet")
+    else:
+        raise ValueError(
+            f"The email {email_file.id} has no no content available for processing"
+        )
+
+
+def extract_email_html(parsed_email: email.message.EmailMessage) -> str | None:
+    body = parsed_email.get_body(preferencelist=("html",))
+    if body is None:
+        return None
+    return body.get_content()
+
+
+def get_email_text(
+    email_file: EmailFile, parsed_email: email.message.EmailMessage | EmailBody
+) -> str:
+    if isinstance(parsed_email, EmailBody):
+        if parsed_email.error is not None:
+            raise ValueError(parsed_email.error)
+        return parsed_email.text
+    return extract_email_text(email_file=email_file, parsed_email=parsed_email)
+
+
+def get_email_html(parsed_email: email.message.EmailMessage | EmailBody) -> str | None:
+    if isinstance(parsed_email, EmailBody):
+        return parsed_email.html
+    return extract_email_html(parsed_email)
+
+
+def parse_email_body(
+    filepath: pathlib.Path,
+    input_dir: pathlib.Path,
+    max_part_size: int | None = None,
+) -> tuple[EmailFile, EmailBody]:
+    # Runs in parse worker processes, only the raw header values are pickled to keep
+    # the result compact
+    parsed_email = parse_email_file(filepath, max_part_size=max_part_size)
+    email_file = build_email_file(
+        filepath=filepath.relative_to(input_dir), parsed_email=parsed_email
+    )
+    html = extract_email_html(parsed_email)
+    try:
+        text = extract_email_text(email_file=email_file, parsed_email=parsed_email)
+    except ValueError as exc:
+        return email_file, EmailBody(html=html, error=str(exc))
+    return email_file, EmailBody(text=text, html=html)
+
+
+def parse_emails(
+    filepaths: typing.Iterable[pathlib.Path],
+    input_dir: pathlib.Path,
+    max_part_size: int | None = None,
+) -> typing.Generator[tuple[EmailFile, email.message.EmailMessage], None, None]:
+    for filepath in filepaths:
+        parsed_email = parse_email_file(filepath, max_part_size=max_part_size)
+        email_file = build_email_file(
+            filepath=filepath.relative_to(input_dir), parsed_email=parsed_email
+        )
+        yield email_file, parsed_email
+
+
+def parse_emails_in_pool(
+    filepaths: typing.Iterable[pathlib.Path],
+    input_dir: pathlib.Path,
+    workers: int,
+    prefetch: int | None = None,
+    max_part_size: int | None = None,
+) -> typing.Generator[tuple[EmailFile, EmailBody], None, None]:
+    # Parses emails in worker processes ahead of the consumer, up to prefetch emails
+    # are in flight to bound the memory usage. Results are yielded in the order of
+    # the given filepaths
+    if prefetch is None:
+        prefetch = workers * 4
+    pending: collections.deque[concurrent.futures.Future] = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        try:
+            for filepath in filepaths:
+                pending.append(
+                    executor.submit(
+                        parse_email_body, filepath, input_dir, max_part_size
+                    )
+                )
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def resolve_workdir_path(workdir_path: pathlib.Path, path: str) -> pathlib.Path:
+    workdir_path = workdir_path.resolve().absolute()
+    resolved_path = (workdir_path / path).resolve().absolute()
+    if not resolved_path.is_relative_to(workdir_path):
+        raise ValueError(f"File {resolved_path} escapes workdir {workdir_path}")
+    return resolved_path
+
+
+def find_csv_row(
+    output_csv: pathlib.Path, email_id: str
+) -> tuple[int, dict[str, str]] | None:
+    if not output_csv.exists():
+        return None
+    with output_csv.open("rt") as fo:
+        reader = csv.DictReader(fo)
+        if reader.fieldnames is None:
+            # created by another worker which has not written the header yet
+            return None
+        if "id" not in reader.fieldnames:
+            raise ValueError(
+                f"No id column found in the existing output csv file at {output_csv}"
+            )
+        for index, row in enumerate(reader):
+            if row["id"] == email_id:
+                # line number with the header line
+                return index + 1 + 1, row
+    return None
+
+
+def write_csv_row(
+    output_csv: pathlib.Path, fieldnames: list[str], row: dict, lock: bool = False
+):
+    # lock is needed when multiple workers are writing to the same output CSV file
+    with file_lock(output_csv) if lock else contextlib.nullcontext():
+        if output_csv.exists():
+            with output_csv.open("at+", newline="") as fo:
+                writer = csv.DictWriter(fo, fieldnames=fieldnames)
+                # TODO: sort by id column?
+                writer.writerow(row)
+        else:
+            output_csv.parent.mkdir(parents=True, exist_ok=True)
+            with output_csv.open("wt", newline="") as fo:
+                writer = csv.DictWriter(fo, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerow(row)
+
+
+class ThinkingUpdateBuffer:
+    def __init__(
+        self,
+        config: ThinkingUpdateConfig,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self.config = config
+        self.clock = clock
+        self.pieces: list[str] = []
+        self.chars = 0
+        self.started_at: float | None = None
+
+    def add(self, piece: str) -> str | None:
+        # returns the piece to emit if any
+        if self.config.mode == ThinkingUpdateMode.token:
+            return piece
+        elif self.config.mode == ThinkingUpdateMode.disabled:
+            return None
+        if self.started_at is None:
+            self.started_at = self.clock()
+        self.pieces.append(piece)
+        self.chars += len(piece)
+        if (
+            self.config.max_chars is not None and self.chars >= self.config.max_chars
+        ) or (
+            self.config.interval is not None
+            and self.clock() - self.started_at >= self.config.interval
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> str | None:
+        if not self.pieces:
+            return None
+        piece = "".join(self.pieces)
+        self.pieces.clear()
+        self.chars = 0
+        self.started_at = None
+        return piece
+
+
+@contextlib.contextmanager
+def stage_timer(
+    metrics: "PipelineMetrics | None", stage: str
+) -> typing.Generator[None, None, None]:
+    if metrics is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe_stage(stage, time.perf_counter() - started_at)
+
+
+def extract_column_value(
+    template_env: "SandboxedEnvironment",
+    email_file: EmailFile,
+    column: OutputColumn,
+    template: str,
+    text: str,
+    llm_model: str,
+    llm_limiter: AdaptiveLimiter | None = None,
+    latency_config: LatencyConfig | None = None,
+    email_deadline: Deadline | None = None,
+    hedge: Hedge | None = None,
+    token_accounting: TokenAccounting | None = None,
+    skip_thinking: bool = False,
+    thinking_updates: ThinkingUpdateConfig | None = None,
+    metrics: "PipelineMetrics | None" = None,
+    trace_span: Span | None = None,
+) -> typing.Generator[ProcessImportEvent, None, typing.Any]:
+    def llm_span_attributes(usage: TokenUsage | None = None) -> dict:
+        if usage is None:
+            return {
+                "gen_ai.operation.name": "chat",
+                "gen_ai.request.model": llm_model,
+                "beanhub_inbox.prompt_length": len(prompt),
+            }
+        # the server could not report token counts
+        return {
+            "gen_ai.usage.input_tokens": usage.prompt_tokens or None,
+            "gen_ai.usage.output_tokens": usage.completion_tokens or None,
+        }
+
+    def record_usage(call: LLMCall, usage: TokenUsage) -> LLMTokenUsage | None:
+        if token_accounting is not None:
+            token_accounting.record(
+                email_id=email_file.id, column=column.name, usage=usage
+            )
+        if not usage.total_tokens:
+            # the server didn't report token counts
+            return None
+        return LLMTokenUsage(
+            email_file=email_file, column=column, call=call, usage=usage
+        )
+
+    def make_concurrency_event() -> LLMConcurrency:
+        sample = llm_limiter.last_sample
+        return LLMConcurrency(
+            email_file=email_file,
+            column=column,
+            limit=llm_limiter.limit,
+            in_flight=llm_limiter.in_flight,
+            queue_latency=sample.queue_latency,
+            time_to_first_token=sample.time_to_first_token,
+        )
+
+    response_model_cls = build_row_model(
+        output_columns=[column],
+    )
+
+    prompt = template_env.from_string(template).render(
+        json_schema=response_model_cls.model_json_schema(),
+        content=text,
+        column=column,
+    )
+    logger.debug(
+        "Thinking about extracting data for email %s with prompt:\n%s",
+        email_file.id,
+        prompt,
+    )
+    import ollama
+
+    messages = [ollama.Message(role="user", content=prompt)]
+    call_timeout = None
+    think_options = None
+    if latency_config is not None:
+        call_timeout = latency_config.call_timeout
+        if latency_config.think_num_predict is not None:
+            think_options = LLM_DEFAULT_OPTIONS | dict(
+                num_predict=latency_config.think_num_predict
+            )
+
+    extracted_value = None
+    if email_deadline is not None and email_deadline.expired:
+        logger.warning(
+            "Email %s deadline exceeded, extract %s with structured output only",
+            email_file.id,
+            column.name,
+        )
+        yield LLMDeadlineExceeded(
+            email_file=email_file, column=column, stage=DeadlineStage.email
+        )
+    elif skip_thinking:
+        logger.info(
+            "Skip thinking for email %s column %s, extract with structured output only",
+            email_file.id,
+            column.name,
+        )
+    else:
+        think_usage = TokenUsage()
+        yield StartThinking(email_file=email_file, column=column, prompt=prompt)
+        think_started_at = time.perf_counter()
+        first_token = True
+        think_span = start_child_span(
+            trace_span, "llm.think", llm_span_attributes(), kind=SpanKind.client
+        )
+        think_generator = GeneratorResult(
+            think(
+                model=llm_model,
+                messages=messages,
+                options=think_options,
+                stream=True,
+                limiter=llm_limiter,
+                deadline=Deadline.earliest(Deadline(call_timeout), email_deadline),
+                hedge=hedge,
+                usage=think_usage,
+            )
+        )
+        update_buffer = ThinkingUpdateBuffer(
+            thinking_updates if thinking_updates is not None else ThinkingUpdateConfig()
+        )
+
+        def make_update_event(piece: str | None) -> UpdateThinking | None:
+            if piece is None:
+                return None
+            return UpdateThinking(email_file=email_file, column=column, piece=piece)
+
+        try:
+            for part in think_generator:
+                if first_token:
+                    time_to_first_token = time.perf_counter() - think_started_at
+                    if metrics is not None:
+                        metrics.observe_time_to_first_token(time_to_first_token)
+                    if think_span is not None:
+                        think_span.add_event("first_token")
+                        think_span.set_attribute(
+                            "beanhub_inbox.time_to_first_token", time_to_first_token
+                        )
+                first_token = False
+                update_event = make_update_event(
+                    update_buffer.add(part.message.content)
+                )
+                if update_event is not None:
+                    yield update_event
+        except DeadlineExceeded:
+            if think_span is not None:
+                think_span.set_attribute("beanhub_inbox.deadline_exceeded", True)
+                think_span.end()
+            update_event = make_update_event(update_buffer.flush())
+            if update_event is not None:
+                yield update_event
+            logger.warning(
+                "Thinking deadline exceeded for email %s column %s, fallback to structured output",
+                email_file.id,
+                column.name,
+            )
+            yield LLMDeadlineExceeded(
+                email_file=email_file, column=column, stage=DeadlineStage.think
+            )
+        except BaseException as exc:
+            if think_span is not None:
+                # the consumer stopped iterating the events, not an error of the span
+                if not isinstance(exc, GeneratorExit):
+                    think_span.set_error(exc)
+                think_span.end()
+            raise
+        else:
+            if metrics is not None:
+                metrics.observe_stage("think", time.perf_counter() - think_started_at)
+            if think_span is not None:
+                think_span.set_attributes(llm_span_attributes(think_usage))
+                think_span.set_attribute(
+                    "beanhub_inbox.thinking_length",
+                    len(think_generator.value.content),
+                )
+                think_span.end()
+            update_event = make_update_event(update_buffer.flush())
+            if update_event is not None:
+                yield update_event
+            yield FinishThinking(
+                email_file=email_file,
+                column=column,
+                thinking=think_generator.value.content,
+            )
+            if llm_limiter is not None:
+                yield make_concurrency_event()
+            usage_event = record_usage(LLMCall.think, think_usage)
+            if usage_event is not None:
+                yield usage_event
+
+            code_block_json_objs = list(
+                extract_json_block(think_generator.value.content)
+            )
+            for block_json_obj in code_block_json_objs[::-1]:
+                if column.name in block_json_obj:
+                    extracted_value = block_json_obj[column.name]
+                    logger.info(
+                        'Extracted "%s" value %r from thinking output',
+                        column.name,
+                        extracted_value,
+                    )
+                    break
+
+    if extracted_value is None:
+        extract_usage = TokenUsage()
+        try:
+            # not bounded by the email deadline, so that we still get the value
+            with (
+                stage_timer(metrics, "extract"),
+                child_span(
+                    trace_span,
+                    "llm.extract",
+                    llm_span_attributes(),
+                    kind=SpanKind.client,
+                ) as extract_span,
+            ):
+                result = extract(
+                    model=llm_model,
+                    messages=messages,
+                    response_model_cls=response_model_cls,
+                    limiter=llm_limiter,
+                    deadline=Deadline(call_timeout)
+                    if call_timeout is not None
+                    else None,
+                    hedge=hedge,
+                    usage=extract_usage,
+                )
+                if extract_span is not None:
+                    extract_span.set_attributes(llm_span_attributes(extract_usage))
+        except DeadlineExceeded:
+            logger.warning(
+                "Structured output deadline exceeded for email %s column %s, leave it empty",
+                email_file.id,
+                column.name,
+            )
+            yield LLMDeadlineExceeded(
+                email_file=email_file, column=column, stage=DeadlineStage.extract
+            )
+            return None
+        if llm_limiter is not None:
+            yield make_concurrency_event()
+        usage_event = record_usage(LLMCall.extract, extract_usage)
+        if usage_event is not None:
+            yield usage_event
+
+        json_obj = result.model_dump(mode="json")
+        extracted_value = json_obj.get(column.name)
+        logger.info(
+            'Extracted "%s" value %r with structured output',
+            column.name,
+            extracted_value,
+        )
+    return extracted_value
+
+
 def perform_extract_action(
-    template_env: SandboxedEnvironment,
+    template_env: "SandboxedEnvironment",
     email_file: EmailFile,
-    parsed_email: email.message.EmailMessage,
+    parsed_email: email.message.EmailMessage | EmailBody,
     action: ExtractImportAction,
     llm_model: str,
     workdir_path: pathlib.Path,
+    sender_history: SenderHistory | None = None,
+    template_caches: dict[pathlib.Path, TemplateCache] | None = None,
+    match_vars: dict | None = None,
+    duplicate_detectors: dict[pathlib.Path, DuplicateDetector] | None = None,
+    csv_backfills: dict[pathlib.Path, CSVBackfill] | None = None,
+    sqlite_outputs: dict[tuple[pathlib.Path, str], SQLiteOutput] | None = None,
+    journals: dict[pathlib.Path, ExtractJournal] | None = None,
+    parquet_outputs: dict[pathlib.Path, "ParquetOutput"] | None = None,
+    shard: Shard | None = None,
+    llm_limiter: AdaptiveLimiter | None = None,
+    hedges: dict[str, Hedge] | None = None,
+    token_accounting: TokenAccounting | None = None,
+    thinking_updates: ThinkingUpdateConfig | None = None,
+    metrics: "PipelineMetrics | None" = None,
+    trace_span: Span | None = None,
+    lock_outputs: bool = False,
 ) -> typing.Generator[ProcessImportEvent, None, None]:
+    latency_config = action.extract.latency
+    email_deadline = None
+    hedge = None
+    if latency_config is not None:
+        email_deadline = Deadline(latency_config.email_timeout)
+        if latency_config.hedge_host is not None:
+            if hedges is None:
+                hedges = {}
+            hedge = hedges.get(latency_config.hedge_host)
+            if hedge is None:
+                import ollama
+
+                hedge = Hedge(
+                    client=ollama.Client(host=latency_config.hedge_host),
+                    tracker=LatencyTracker(percentile=latency_config.hedge_percentile),
+                    min_delay=latency_config.hedge_min_delay,
+                )
+                hedges[latency_config.hedge_host] = hedge
     workdir_path = workdir_path.resolve().absolute()
     output_csv = workdir_path / action.extract.output_csv
     output_csv = output_csv.resolve().absolute()
     if not output_csv.is_relative_to(workdir_path):
         raise ValueError(f"Output CSV file {output_csv} escapes workdir {workdir_path}")
-    if output_csv.exists():
-        # TODO: extract this
-        with output_csv.open("rt") as fo:
-            reader = csv.DictReader(fo)
-            if "id" not in reader.fieldnames:
+    merged_output_csv = output_csv
+    if shard is not None:
+        # each shard writes its own files, they are merged later with merge_shard_csvs
+        output_csv = shard.output_path(output_csv)
+    dedup_config = action.extract.dedup
+    duplicate_detector = None
+    if dedup_config is not None:
+        if duplicate_detectors is None:
+            duplicate_detectors = {}
+        duplicate_detector = duplicate_detectors.get(output_csv)
+        if duplicate_detector is None:
+            duplicate_detector = DuplicateDetector(
+                message_id=dedup_config.message_id,
+                body_hash=dedup_config.body_hash,
+                simhash_distance=dedup_config.simhash_distance,
+                signatures_file=output_csv.parent
+                / f".{output_csv.name}.signatures.jsonl",
+            )
+            duplicate_detectors[output_csv] = duplicate_detector
+    columns = DEFAULT_COLUMNS
+    if action.extract.columns is not None:
+        columns = action.extract.columns
+    fieldnames = ["id", *(column.name for column in columns)]
+    sqlite_output = None
+    sqlite_config = action.extract.output_sqlite
+    if sqlite_config is not None:
+        if sqlite_outputs is None:
+            sqlite_outputs = {}
+        database = resolve_workdir_path(workdir_path, sqlite_config.database)
+        if shard is not None:
+            database = shard.output_path(database)
+        sqlite_output = sqlite_outputs.get((database, sqlite_config.table))
+        if sqlite_output is None:
+            sqlite_output = SQLiteOutput(
+                database=database,
+                table=sqlite_config.table,
+                fieldnames=fieldnames,
+                batch_size=sqlite_config.batch_size,
+            )
+            if sqlite_output.is_empty() and output_csv.exists():
+                # migrate rows extracted before switching to SQLite
+                sqlite_output.import_csv(output_csv)
+            sqlite_outputs[(database, sqlite_config.table)] = sqlite_output
+        if sqlite_config.export_csv:
+            sqlite_output.export_csv_files.add(output_csv)
+    csv_backfill = None
+    if action.extract.backfill and sqlite_output is None:
+        if csv_backfills is None:
+            csv_backfills = {}
+        csv_backfill = csv_backfills.get(output_csv)
+        if csv_backfill is None:
+            csv_backfill = CSVBackfill(
+                output_csv=output_csv, fieldnames=fieldnames, lock=lock_outputs
+            )
+            csv_backfills[output_csv] = csv_backfill
+    parquet_output = None
+    parquet_config = action.extract.output_parquet
+    if parquet_config is not None:
+        if parquet_outputs is None:
+            parquet_outputs = {}
+        parquet_path = resolve_workdir_path(workdir_path, parquet_config.path)
+        parquet_output = parquet_outputs.get(parquet_path)
+        if parquet_output is None:
+            try:
+                from .parquet_output import ParquetOutput
+            except ImportError as exc:
                 raise ValueError(
-                    f"No id column found in the existing output csv file at {output_csv}"
-                )
-            for index, row in enumerate(reader):
-                email_id = row["id"]
-                if email_id == email_file.id:
-                    logger.info(
-                        "Found email %s row %s in output CSV file %s, skip",
+                    "pyarrow is required for Parquet output, please install beanhub-inbox[parquet]"
+                ) from exc
+            parquet_output = ParquetOutput(
+                path=parquet_path,
+                columns=columns,
+                row_group_size=parquet_config.row_group_size,
+            )
+            parquet_outputs[parquet_path] = parquet_output
+
+    def extract_text() -> str:
+        with (
+            stage_timer(metrics, "text"),
+            child_span(trace_span, "extract_text") as text_span,
+        ):
+            text = get_email_text(email_file=email_file, parsed_email=parsed_email)
+            if text_span is not None:
+                text_span.set_attribute("beanhub_inbox.content_length", len(text))
+            return text
+
+    def save_row(row: dict):
+        with stage_timer(metrics, "write"), child_span(trace_span, "write_row"):
+            write_row(row)
+
+    def write_row(row: dict):
+        if parquet_output is not None:
+            parquet_output.add_row(dict(id=email_file.id) | row)
+        if sqlite_output is not None:
+            sqlite_output.upsert_row(dict(id=email_file.id) | row)
+        elif csv_backfill is not None:
+            csv_backfill.add_row(dict(id=email_file.id) | row)
+        else:
+            write_csv_row(
+                output_csv=output_csv,
+                fieldnames=fieldnames,
+                row=dict(id=email_file.id) | row,
+                lock=lock_outputs,
+            )
+
+    def find_existing_row(
+        email_id: str,
+    ) -> tuple[pathlib.Path, tuple[int | None, dict[str, str]]] | None:
+        if sqlite_output is not None:
+            sqlite_row = sqlite_output.find_row(email_id)
+            row = (None, sqlite_row) if sqlite_row is not None else None
+        elif csv_backfill is not None:
+            row = csv_backfill.find_row(email_id)
+        else:
+            row = find_csv_row(output_csv=output_csv, email_id=email_id)
+        if row is not None:
+            return output_csv, row
+        if shard is not None:
+            # rows extracted by previous runs could be merged already
+            row = find_csv_row(output_csv=merged_output_csv, email_id=email_id)
+            if row is not None:
+                return merged_output_csv, row
+        return None
+
+    existing_csv = output_csv
+    existing_row = None
+    found = find_existing_row(email_file.id)
+    if found is not None:
+        existing_csv, existing_row = found
+
+    text = None
+    backfill_columns = []
+    existing_values = {}
+    if existing_row is not None:
+        lineno, existing_values = existing_row
+        existing_values = {
+            key: value for key, value in existing_values.items() if key != "id"
+        }
+        valid = parse_valid_value(existing_values.get("valid"))
+        if sender_history is not None and valid is not None:
+            sender_history.record(email_file.from_addresses, valid=valid)
+        if duplicate_detector is not None:
+            # remember existing emails, so that their duplicates can be found in
+            # following emails. Signatures are usually loaded from previous runs
+            # already, only emails extracted before enabling dedup are parsed here
+            if not duplicate_detector.has_signature(email_file.id):
+                try:
+                    text = extract_text()
+                except ValueError as exc:
+                    logger.warning(
+                        "Cannot get text of existing email %s for dedup: %s",
                         email_file.id,
-                        index + 1,
-                        output_csv,
+                        exc,
                     )
-                    yield CSVRowExists(
-                        email_file=email_file,
-                        output_csv=output_csv,
-                        lineno=index + 1 + 1,
+                else:
+                    duplicate_detector.check(
+                        email_id=email_file.id,
+                        message_id=get_header(email_file.headers, "Message-ID"),
+                        text=text,
                     )
-                    return
+            duplicate_detector.set_row(email_file.id, existing_values)
+        if action.extract.backfill:
+            backfill_columns = find_backfill_columns(columns, existing_values)
+        if not backfill_columns and parquet_output is not None:
+            # rows extracted before enabling Parquet output
+            parquet_output.add_row(dict(id=email_file.id) | existing_values)
+        if not backfill_columns and sqlite_output is not None:
+            logger.info(
+                "Found email %s row in SQLite database %s table %s, skip",
+                email_file.id,
+                sqlite_output.database,
+                sqlite_output.table,
+            )
+            yield SQLiteRowExists(
+                email_file=email_file,
+                database=sqlite_output.database,
+                table=sqlite_output.table,
+            )
+            return
+        elif not backfill_columns:
+            logger.info(
+                "Found email %s row %s in output CSV file %s, skip",
+                email_file.id,
+                lineno - 1,
+                existing_csv,
+            )
+            yield CSVRowExists(
+                email_file=email_file,
+                output_csv=existing_csv,
+                lineno=lineno,
+            )
+            return
+        logger.info(
+            "Backfill columns %s of email %s",
+            [column.name for column in backfill_columns],
+            email_file.id,
+        )
+        yield BackfillColumns(
+            email_file=email_file,
+            output_csv=existing_csv,
+            lineno=lineno,
+            columns=[column.name for column in backfill_columns],
+        )
 
-    body = parsed_email.get_body()
-    if body.get_content_type() == "text/html":
-        text = extract_html_text(body.get_content())
-    elif body.get_content_type() == "text/text":
-        text = body.get_content()
-    elif body.get_content_type() == "multipart/related":
-        raise ValueError("Email content with embedded image is not supported yet")
-    else:
-        raise ValueError(
-            f"The email {email_file.id} has no no content available for processing"
+    if text is None:
+        text = extract_text()
+
+    if duplicate_detector is not None and not backfill_columns:
+        duplicate = duplicate_detector.check(
+            email_id=email_file.id,
+            message_id=get_header(email_file.headers, "Message-ID"),
+            text=text,
+        )
+        if duplicate is not None:
+            logger.info(
+                "Email %s is a duplicate of email %s by %s signal",
+                email_file.id,
+                duplicate.email_id,
+                duplicate.signal.value,
+            )
+            yield DuplicateEmail(
+                email_file=email_file,
+                duplicate_of=duplicate.email_id,
+                signal=duplicate.signal,
+            )
+            if not dedup_config.reuse_row:
+                return
+            row = duplicate_detector.get_row(duplicate.email_id)
+            if row is None:
+                # the first email could be extracted by a previous run or another
+                # worker, so its row is only in the output
+                found = find_existing_row(duplicate.email_id)
+                if found is not None:
+                    _, (_, found_values) = found
+                    row = {
+                        key: value for key, value in found_values.items() if key != "id"
+                    }
+                    duplicate_detector.set_row(duplicate.email_id, row)
+            if row is None:
+                logger.warning(
+                    "Row of email %s is not found for its duplicate %s, skip",
+                    duplicate.email_id,
+                    email_file.id,
+                )
+                yield DuplicateRowNotFound(
+                    email_file=email_file,
+                    duplicate_of=duplicate.email_id,
+                )
+                return
+            yield FinishExtractingRow(
+                email_file=email_file,
+                row=row,
+            )
+            save_row(row)
+            return
+
+    if action.extract.pre_classify is not None and not backfill_columns:
+        pre_classify_result = pre_classify(
+            config=action.extract.pre_classify,
+            subject=email_file.subject,
+            from_addresses=email_file.from_addresses,
+            text=text,
+            sender_history=sender_history,
         )
+        if pre_classify_result is not None:
+            logger.info(
+                "Email %s is pre-classified as not a transaction by %s signal (%s), skip LLM",
+                email_file.id,
+                pre_classify_result.signal.value,
+                pre_classify_result.detail,
+            )
+            yield PreClassifyNotTransaction(
+                email_file=email_file,
+                signal=pre_classify_result.signal,
+                detail=pre_classify_result.detail,
+            )
+            row = dict(valid=False)
+            yield FinishExtractingRow(
+                email_file=email_file,
+                row=row,
+            )
+            if duplicate_detector is not None:
+                duplicate_detector.set_row(email_file.id, row)
+            save_row(row)
+            return
 
     # TODO: get template from action or default value
     template = DEFAULT_PROMPT_TEMPLATE
     if action.extract.template is not None:
         template = action.extract.template
 
+    template_cache_config = action.extract.template_cache
+    template_cache = None
+    template_cache_file = None
+    template_key = None
+    prefilled_values = {}
+    if template_cache_config is not None:
+        if template_caches is None:
+            template_caches = {}
+        html = get_email_html(parsed_email)
+        fingerprint = html_fingerprint(html) if html is not None else None
+        if fingerprint is not None:
+            template_cache_file = resolve_workdir_path(
+                workdir_path, template_cache_config.cache_file
+            )
+            if shard is not None:
+                template_cache_file = shard.output_path(template_cache_file)
+            template_cache = template_caches.get(template_cache_file)
+            if template_cache is None:
+                # other threads sharing the caches could be loading the same file
+                template_cache = template_caches.setdefault(
+                    template_cache_file, TemplateCache.load(template_cache_file)
+                )
+            template_key = make_template_key(email_file.from_addresses, fingerprint)
+            prefilled_values = template_cache.extract(
+                key=template_key,
+                text=text,
+                columns=columns,
+                min_samples=template_cache_config.min_samples,
+            )
+            if prefilled_values:
+                hits = template_cache.record_hit(template_key)
+                if (
+                    template_cache_config.spot_check_interval is not None
+                    and hits % template_cache_config.spot_check_interval == 0
+                ):
+                    logger.info(
+                        "Spot check learned template %s with LLM for email %s",
+                        template_key,
+                        email_file.id,
+                    )
+                    prefilled_values = {}
+                else:
+                    yield TemplateCacheHit(
+                        email_file=email_file,
+                        template_key=template_key,
+                        columns=list(prefilled_values.keys()),
+                    )
+
+    journal = None
+    if action.extract.journal is not None:
+        if journals is None:
+            journals = {}
+        journal_file = resolve_workdir_path(workdir_path, action.extract.journal)
+        if shard is not None:
+            journal_file = shard.output_path(journal_file)
+        journal = journals.get(journal_file)
+        if journal is None:
+            journal = ExtractJournal(journal_file)
+            journals[journal_file] = journal
+
+    extract_columns = columns
+    if backfill_columns:
+        extract_columns = backfill_columns
+    token_budget = action.extract.token_budget
+    if (
+        token_budget is not None
+        and token_budget.run_tokens is not None
+        and token_accounting is not None
+        and token_accounting.run.total_tokens >= token_budget.run_tokens
+    ):
+        logger.warning(
+            "Run token budget %s exceeded with %s tokens used, stop before email %s",
+            token_budget.run_tokens,
+            token_accounting.run.total_tokens,
+            email_file.id,
+        )
+        # rows written so far are kept, the next run picks up from this email
+        token_accounting.exhausted = True
+        yield TokenBudgetExceeded(
+            email_file=email_file,
+            scope=TokenBudgetScope.run,
+            usage=dataclasses.replace(token_accounting.run),
+            budget=token_budget.run_tokens,
+        )
+        return
+    email_budget_exceeded = False
+    rule_values = extract_columns_by_rules(
+        columns=extract_columns,
+        text=text,
+        headers=email_file.headers,
+        match_vars=match_vars,
+    )
+
     row = {}
-    columns = DEFAULT_COLUMNS
+    llm_values = {}
     # TODO: we can run all columns at once to speed up if we need to
-    for column in columns:
+    for column in extract_columns:
         logger.info(
             'Extracting "%s" (%s type) column value ...',
             column.name,
             column.type.value,
         )
         yield StartExtractingColumn(email_file=email_file, column=column)
-        response_model_cls = build_row_model(
-            output_columns=[column],
-        )
-
-        prompt = template_env.from_string(template).render(
-            json_schema=response_model_cls.model_json_schema(),
-            content=text,
-            column=column,
-        )
-        logger.debug(
-            "Thinking about extracting data for email %s with prompt:\n%s",
-            email_file.id,
-            prompt,
-        )
-        messages = [ollama.Message(role="user", content=prompt)]
-        yield StartThinking(email_file=email_file, column=column, prompt=prompt)
-        think_generator = GeneratorResult(
-            think(model=llm_model, messages=messages, stream=True)
-        )
-        for part in think_generator:
-            yield UpdateThinking(
-                email_file=email_file, column=column, piece=part.message.content
-            )
-        yield FinishThinking(
-            email_file=email_file, column=column, thinking=think_generator.value.content
-        )
-
-        extracted_value = None
-        code_block_json_objs = list(extract_json_block(think_generator.value.content))
-        for block_json_obj in code_block_json_objs[::-1]:
-            if column.name in block_json_obj:
-                extracted_value = block_json_obj[column.name]
+        with child_span(
+            trace_span,
+            "extract_column",
+            attributes={
+                "beanhub_inbox.column.name": column.name,
+                "beanhub_inbox.column.type": column.type.value,
+                "beanhub_inbox.content_length": len(text),
+            },
+        ) as column_span:
+            if column.name in rule_values:
+                source = "rule"
+                extracted_value = rule_values[column.name]
                 logger.info(
-                    'Extracted "%s" value %r from thinking output',
+                    'Extracted "%s" value %r with rules',
                     column.name,
                     extracted_value,
                 )
-                break
-
-        if extracted_value is None:
-            result = extract(
-                model=llm_model,
-                messages=messages,
-                response_model_cls=response_model_cls,
-            )
-
-            json_obj = result.model_dump(mode="json")
-            extracted_value = json_obj.get(column.name)
-            logger.info(
-                'Extracted "%s" value %r with structured output',
-                column.name,
-                extracted_value,
-            )
-
+            elif column.name in prefilled_values:
+                source = "template_cache"
+                extracted_value = prefilled_values[column.name]
+                logger.info(
+                    'Extracted "%s" value %r with learned template',
+                    column.name,
+                    extracted_value,
+                )
+            else:
+                config_hash = None
+                replayed = False
+                if journal is not None:
+                    config_hash = make_column_config_hash(
+                        llm_model=llm_model, template=template, column=column
+                    )
+                    replayed, extracted_value = journal.get(
+                        email_id=email_file.id,
+                        column=column.name,
+                        config_hash=config_hash,
+                    )
+                if replayed:
+                    source = "journal"
+                    logger.info(
+                        'Replayed "%s" value %r from journal %s',
+                        column.name,
+                        extracted_value,
+                        journal.journal_file,
+                    )
+                    yield ReplayJournalColumn(
+                        email_file=email_file,
+                        column=column,
+                        journal_file=journal.journal_file,
+                    )
+                else:
+                    source = "llm"
+                    column_generator = GeneratorResult(
+                        extract_column_value(
+                            template_env=template_env,
+                            email_file=email_file,
+                            column=column,
+                            template=template,
+                            text=text,
+                            llm_model=llm_model,
+                            llm_limiter=llm_limiter,
+                            latency_config=latency_config,
+                            email_deadline=email_deadline,
+                            hedge=hedge,
+                            token_accounting=token_accounting,
+                            skip_thinking=email_budget_exceeded,
+                            thinking_updates=thinking_updates,
+                            metrics=metrics,
+                            trace_span=column_span,
+                        )
+                    )
+                    timed_out = False
+                    for event in column_generator:
+                        if (
+                            isinstance(event, LLMDeadlineExceeded)
+                            and event.stage == DeadlineStage.extract
+                        ):
+                            timed_out = True
+                        yield event
+                    extracted_value = column_generator.value
+                    if (
+                        not email_budget_exceeded
+                        and token_budget is not None
+                        and token_budget.email_tokens is not None
+                        and token_accounting is not None
+                    ):
+                        email_usage = token_accounting.email_usage(email_file.id)
+                        if email_usage.total_tokens >= token_budget.email_tokens:
+                            logger.warning(
+                                "Email %s token budget %s exceeded with %s tokens used, skip thinking for the remaining columns",
+                                email_file.id,
+                                token_budget.email_tokens,
+                                email_usage.total_tokens,
+                            )
+                            email_budget_exceeded = True
+                            yield TokenBudgetExceeded(
+                                email_file=email_file,
+                                scope=TokenBudgetScope.email,
+                                usage=dataclasses.replace(email_usage),
+                                budget=token_budget.email_tokens,
+                            )
+                    if journal is not None and not timed_out:
+                        journal.record(
+                            email_id=email_file.id,
+                            column=column.name,
+                            config_hash=config_hash,
+                            value=extracted_value,
+                        )
+                llm_values[column.name] = extracted_value
+
+            if column_span is not None:
+                column_span.set_attribute("beanhub_inbox.column.source", source)
         yield FinishExtractingColumn(
             email_file=email_file,
             column=column,
@@ -501,6 +1551,10 @@ def perform_extract_action(
         )
 
         row[column.name] = extracted_value
+        if column.name == "valid" and sender_history is not None:
+            valid = parse_valid_value(extracted_value)
+            if valid is not None:
+                sender_history.record(email_file.from_addresses, valid=valid)
         if column.name == "valid" and not extracted_value:
             # TODO: find a way to make it possible to define which column is the "valid"
             logger.info(
@@ -509,6 +1563,52 @@ def perform_extract_action(
             )
             break
 
+    if template_cache is not None and llm_values:
+        drifted_columns = template_cache.learn(
+            key=template_key,
+            text=text,
+            values=llm_values,
+            min_samples=template_cache_config.min_samples,
+        )
+        if drifted_columns:
+            logger.warning(
+                "Learned template %s drifted for columns %s with email %s",
+                template_key,
+                drifted_columns,
+                email_file.id,
+            )
+            yield TemplateCacheDrift(
+                email_file=email_file,
+                template_key=template_key,
+                columns=drifted_columns,
+            )
+        template_cache.save(template_cache_file)
+
+    if backfill_columns:
+        logger.info(
+            "Update email %s row data %s in CSV file %s",
+            email_file.id,
+            row,
+            output_csv,
+        )
+        yield FinishExtractingRow(
+            email_file=email_file,
+            row=existing_values | row,
+        )
+        if parquet_output is not None:
+            # no-op for rows already in the Parquet files, as they are immutable
+            parquet_output.add_row(dict(id=email_file.id) | existing_values | row)
+        if existing_csv != output_csv:
+            # the row is only in the merged output CSV file, write the whole row into
+            # the shard, which replaces the merged one when merging
+            save_row(existing_values | row)
+        elif sqlite_output is not None:
+            # only update the backfilled columns
+            sqlite_output.upsert_row(dict(id=email_file.id) | row)
+        else:
+            csv_backfill.update_row(email_file.id, row)
+        return
+
     logger.info(
         "Write email %s row data %s to CSV file %s",
         email_file.id,
@@ -519,23 +1619,9 @@ def perform_extract_action(
         email_file=email_file,
         row=row,
     )
-    if output_csv.exists():
-        # TODO: lock file
-        with output_csv.open("at+", newline="") as fo:
-            writer = csv.DictWriter(
-                fo, fieldnames=["id", *(column.name for column in columns)]
-            )
-            # TODO: sort by id column?
-            writer.writerow(dict(id=email_file.id) | row)
-    else:
-        # TODO: lock file
-        output_csv.parent.mkdir(parents=True, exist_ok=True)
-        with output_csv.open("wt", newline="") as fo:
-            writer = csv.DictWriter(
-                fo, fieldnames=["id", *(column.name for column in columns)]
-            )
-            writer.writeheader()
-            writer.writerow(dict(id=email_file.id) | row)
+    if duplicate_detector is not None:
+        duplicate_detector.set_row(email_file.id, row)
+    save_row(row)
 
 
 def process_imports(
@@ -543,9 +1629,66 @@ def process_imports(
     input_dir: pathlib.Path,
     llm_model: str,
     workdir_path: pathlib.Path,
+    filepaths: typing.Iterable[pathlib.Path] | None = None,
+    sender_history: SenderHistory | None = None,
+    duplicate_detectors: dict[pathlib.Path, DuplicateDetector] | None = None,
+    shard: Shard | None = None,
+    llm_limiter: AdaptiveLimiter | None = None,
+    token_accounting: TokenAccounting | None = None,
+    parse_workers: int | None = None,
+    # attachments larger than this are skipped when parsing, to bound the memory
+    # usage
+    max_part_size: int | None = None,
+    thinking_updates: ThinkingUpdateConfig | None = None,
+    metrics: "PipelineMetrics | None" = None,
+    tracer: Tracer | None = None,
+    # journals given by the caller are shared with other runs, they are only closed
+    # here and the caller decides when to remove them
+    journals: dict[pathlib.Path, ExtractJournal] | None = None,
+    # lock output files when writing, for multiple processes sharing them
+    lock_outputs: bool = False,
+    # template caches given by the caller are shared with other runs, such as threads
+    # of the same process learning templates at the same time
+    template_caches: dict[pathlib.Path, TemplateCache] | None = None,
+    # called between emails whenever the rows of all the processed emails are written
+    # to the outputs instead of buffered in memory, such as for completing work queue
+    # items
+    on_rows_written: typing.Callable[[], None] | None = None,
 ) -> typing.Generator[ProcessImportEvent, None, None]:
     template_env = make_environment()
+    if token_accounting is None:
+        token_accounting = TokenAccounting()
     omit_token = uuid.uuid4().hex
+    if sender_history is None:
+        sender_history = SenderHistory()
+    if duplicate_detectors is None:
+        duplicate_detectors = {}
+    if template_caches is None:
+        template_caches = {}
+    csv_backfills: dict[pathlib.Path, CSVBackfill] = {}
+    sqlite_outputs: dict[tuple[pathlib.Path, str], SQLiteOutput] = {}
+    remove_journals = journals is None
+    if journals is None:
+        journals = {}
+    hedges: dict[str, Hedge] = {}
+    parquet_outputs: dict[pathlib.Path, "ParquetOutput"] = {}
+    completed = False
+    email_in_flight = False
+    emails = None
+
+    def observe(
+        events: typing.Iterable[ProcessImportEvent],
+    ) -> typing.Iterable[ProcessImportEvent]:
+        if metrics is None:
+            return events
+        return metrics.observe_events(events)
+
+    def has_pending_rows() -> bool:
+        return any(
+            csv_backfill.has_pending_rows for csv_backfill in csv_backfills.values()
+        ) or any(
+            sqlite_output.has_pending_rows for sqlite_output in sqlite_outputs.values()
+        )
 
     expanded_input_configs = list(
         expand_input_loops(
@@ -553,81 +1696,175 @@ def process_imports(
         ),
     )
 
-    # sort filepaths for deterministic behavior across platforms
-    # TODO: this might be a bit slow if the input dir has a tons of files...
-    filepaths = sorted(walk_dir_files(input_dir))
-    for filepath in filepaths:
-        matched_input_config = None
-        for input_config_index, rendered_input_config in enumerate(
-            expanded_input_configs
-        ):
-            input_config = rendered_input_config.input_config
-            if match_file(input_config.match, filepath):
-                matched_input_config = input_config
-                logger.info("Matched input config %s", input_config_index)
-                break
-        if matched_input_config is None:
-            # Not interested in this file, skip
-            continue
-
-        rel_filepath = filepath.relative_to(input_dir)
-        with filepath.open("rb") as fo:
-            parsed_email: email.message.EmailMessage = email.message_from_binary_file(
-                fo, policy=email.policy.EmailPolicy()
-            )
-        email_file = build_email_file(filepath=rel_filepath, parsed_email=parsed_email)
-        yield StartProcessingEmail(email_file=email_file)
-
-        matched_import_config = None
-        matched_import_config_index = None
-        for index, import_config in enumerate(inbox_doc.imports):
-            if import_config.match is None:
-                matched_import_config = import_config
-                matched_import_config_index = index
-                break
-            else:
-                email_matched, _ = match_email_file(
-                    email_file=email_file,
-                    rule=import_config.match,
+    try:
+        # sort filepaths for deterministic behavior across platforms, iterators are
+        # consumed lazily in the given order instead, such as files claimed from a
+        # work queue one at a time
+        if filepaths is None:
+            # TODO: this might be a bit slow if the input dir has a tons of files...
+            ordered_filepaths = sorted(walk_dir_files(input_dir))
+        elif isinstance(filepaths, typing.Iterator):
+            ordered_filepaths = filepaths
+        else:
+            ordered_filepaths = sorted(filepaths)
+
+        def iter_input_filepaths() -> typing.Generator[pathlib.Path, None, None]:
+            for filepath in ordered_filepaths:
+                if shard is not None and not shard.contains(
+                    filepath.relative_to(input_dir)
+                ):
+                    continue
+                if not filepath.is_file():
+                    # could be removed after the change was picked up in watch mode
+                    continue
+                matched_input_config = match_input_config(
+                    expanded_input_configs, filepath
                 )
-                if email_matched:
-                    matched_import_config = import_config
-                    matched_import_config_index = index
-                break
-        if matched_import_config is None:
-            logger.info(
-                "No import rule match for email %s at %s, skip",
-                email_file.id,
-                email_file.filepath,
+                if matched_input_config is None:
+                    # Not interested in this file, skip
+                    continue
+                yield filepath
+
+        if parse_workers is None:
+            emails = parse_emails(
+                iter_input_filepaths(),
+                input_dir=input_dir,
+                max_part_size=max_part_size,
             )
-            yield NoMatch(email_file=email_file)
-            continue
+        else:
+            # parsing emails and extracting the text are CPU bound, do it in other
+            # processes while the main process is waiting for LLM
+            emails = parse_emails_in_pool(
+                iter_input_filepaths(),
+                input_dir=input_dir,
+                workers=parse_workers,
+                max_part_size=max_part_size,
+            )
+        while True:
+            if on_rows_written is not None and not has_pending_rows():
+                on_rows_written()
+            # time spent here is waiting for the workers in case of parsing in pool
+            parse_started_at = time.perf_counter()
+            parse_started_ns = tracer.clock() if tracer is not None else None
+            email_in_flight = True
+            parsed = next(emails, None)
+            if parsed is None:
+                email_in_flight = False
+                break
+            parse_ended_ns = tracer.clock() if tracer is not None else None
+            if metrics is not None:
+                metrics.observe_stage("parse", time.perf_counter() - parse_started_at)
+            email_file, parsed_email = parsed
+            with tracer_span(
+                tracer,
+                "process_email",
+                attributes={
+                    "beanhub_inbox.email.id": email_file.id,
+                    "beanhub_inbox.email.filepath": email_file.filepath,
+                },
+                start_time=parse_started_ns,
+            ) as email_span:
+                if email_span is not None:
+                    tracer.start_span(
+                        "parse_email", parent=email_span, start_time=parse_started_ns
+                    ).end(parse_ended_ns)
+                yield from observe([StartProcessingEmail(email_file=email_file)])
+
+                import_match = match_import_config(inbox_doc.imports, email_file)
+                if import_match is None:
+                    logger.info(
+                        "No import rule match for email %s at %s, skip",
+                        email_file.id,
+                        email_file.filepath,
+                    )
+                    yield from observe([NoMatch(email_file=email_file)])
+                    continue
+                matched_import_config_index, matched_import_config, match_vars = (
+                    import_match
+                )
+                if email_span is not None:
+                    email_span.set_attributes(
+                        {
+                            "beanhub_inbox.import_rule.index": matched_import_config_index,
+                            "beanhub_inbox.import_rule.name": matched_import_config.name,
+                        }
+                    )
 
-        logger.info(
-            "Match email %s at %s with import rule %s",
-            email_file.id,
-            email_file.filepath,
-            matched_import_config.name
-            if matched_import_config.name is not None
-            else matched_import_config_index,
-        )
-        yield MatchImportRule(
-            email_file=email_file,
-            import_rule_index=matched_import_config_index,
-            import_config=matched_import_config,
-        )
-        for action in matched_import_config.actions:
-            if isinstance(action, ExtractImportAction):
-                yield from perform_extract_action(
-                    template_env=template_env,
-                    email_file=email_file,
-                    parsed_email=parsed_email,
-                    action=action,
-                    llm_model=llm_model,
-                    workdir_path=workdir_path,
+                logger.info(
+                    "Match email %s at %s with import rule %s",
+                    email_file.id,
+                    email_file.filepath,
+                    matched_import_config.name
+                    if matched_import_config.name is not None
+                    else matched_import_config_index,
                 )
-            elif isinstance(action, IgnoreImportAction):
-                logger.info("Ignore email %s", email_file.id)
-                yield IgnoreEmail(email_file=email_file)
+                yield from observe(
+                    [
+                        MatchImportRule(
+                            email_file=email_file,
+                            import_rule_index=matched_import_config_index,
+                            import_config=matched_import_config,
+                        )
+                    ]
+                )
+                for action in matched_import_config.actions:
+                    if isinstance(action, ExtractImportAction):
+                        yield from observe(
+                            perform_extract_action(
+                                template_env=template_env,
+                                email_file=email_file,
+                                parsed_email=parsed_email,
+                                action=action,
+                                llm_model=llm_model,
+                                workdir_path=workdir_path,
+                                sender_history=sender_history,
+                                template_caches=template_caches,
+                                match_vars=match_vars,
+                                duplicate_detectors=duplicate_detectors,
+                                csv_backfills=csv_backfills,
+                                sqlite_outputs=sqlite_outputs,
+                                journals=journals,
+                                parquet_outputs=parquet_outputs,
+                                shard=shard,
+                                llm_limiter=llm_limiter,
+                                hedges=hedges,
+                                token_accounting=token_accounting,
+                                thinking_updates=thinking_updates,
+                                metrics=metrics,
+                                trace_span=email_span,
+                                lock_outputs=lock_outputs,
+                            )
+                        )
+                    elif isinstance(action, IgnoreImportAction):
+                        logger.info("Ignore email %s", email_file.id)
+                        yield from observe([IgnoreEmail(email_file=email_file)])
+                    else:
+                        raise ValueError(f"Unexpected action type {type(action)}")
+                if token_accounting.exhausted:
+                    email_in_flight = False
+                    # leave the journal for resuming in the next run
+                    return
+        completed = True
+    finally:
+        if emails is not None:
+            emails.close()
+        # backfilled rows are only written here, flush them even if the processing
+        # is interrupted to avoid losing the extracted values
+        for csv_backfill in csv_backfills.values():
+            csv_backfill.flush()
+        for sqlite_output in sqlite_outputs.values():
+            for output_csv in sqlite_output.export_csv_files:
+                sqlite_output.export_csv(output_csv, lock=lock_outputs)
+            sqlite_output.close()
+        if on_rows_written is not None and not email_in_flight:
+            on_rows_written()
+        for parquet_output in parquet_outputs.values():
+            parquet_output.close()
+        for duplicate_detector in duplicate_detectors.values():
+            duplicate_detector.close()
+        for journal in journals.values():
+            if completed and remove_journals:
+                # all the rows are written, no need to replay anymore
+                journal.remove()
             else:
-                raise ValueError(f"Unexpected action type {type(action)}")
+                journal.close()
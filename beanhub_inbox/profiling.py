@@ -0,0 +1,348 @@
+import collections
+import contextlib
+import dataclasses
+import json
+import pathlib
+import pstats
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+import typing
+
+import ollama
+
+from .event_log import read_events
+from .llm import DECIMAL_REGEX
+
+DEFAULT_STUB_THINKING = (
+    "Let me read the email content and think about the value step by step. "
+)
+# deeper frames are dropped, to bound the cost of each sample
+MAX_STACK_DEPTH = 128
+IMPORT_TIME_LINE_REGEX = re.compile(
+    r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<name>\s*\S+)$"
+)
+
+
+@dataclasses.dataclass
+class ReplayEntry:
+    column: str
+    thinking: str | None = None
+    value: typing.Any = None
+    has_value: bool = False
+
+
+def load_replay(event_log: pathlib.Path) -> dict[str, ReplayEntry]:
+    # Builds LLM responses keyed by prompts from an event log written by EventSink,
+    # thinking output comes from FinishThinking and structured output from the
+    # final value of the column
+    entries: dict[str, ReplayEntry] = {}
+    prompts: dict[tuple[str, str], str] = {}
+    for record in read_events(event_log):
+        key = (record["email_id"], record.get("column"))
+        if record["type"] == "StartThinking":
+            prompts[key] = record["prompt"]
+            entries[record["prompt"]] = ReplayEntry(column=record["column"])
+            continue
+        prompt = prompts.get(key)
+        if prompt is None:
+            continue
+        if record["type"] == "FinishThinking":
+            entries[prompt].thinking = record["thinking"]
+        elif record["type"] == "FinishExtractingColumn":
+            entries[prompt].value = record["value"]
+            entries[prompt].has_value = True
+    return entries
+
+
+def make_stub_value(schema: dict) -> typing.Any:
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        if not options:
+            return None
+        schema = options[0]
+    value_type = schema.get("type")
+    if value_type == "boolean":
+        # other columns are skipped for invalid emails, so always make them valid
+        return True
+    elif value_type in ("integer", "number"):
+        return 0
+    elif value_type == "string":
+        value_format = schema.get("format")
+        if value_format == "date":
+            return "1970-01-01"
+        elif value_format == "date-time":
+            return "1970-01-01T00:00:00"
+        pattern = schema.get("pattern")
+        if pattern == DECIMAL_REGEX:
+            return "0.00"
+        elif pattern is not None:
+            return None
+        return "stub"
+    return None
+
+
+class StubLLM:
+    # Stands in for ollama.chat with canned responses, or responses replayed from an
+    # event log, so that runs can be profiled without a LLM server. Thinking output
+    # is streamed in chunks to go through the same code path as real responses
+    def __init__(
+        self,
+        thinking_chars: int = 512,
+        chunk_chars: int = 16,
+        token_delay: float = 0.0,
+        replay: dict[str, ReplayEntry] | None = None,
+    ):
+        self.thinking_chars = thinking_chars
+        self.chunk_chars = chunk_chars
+        self.token_delay = token_delay
+        self.replay = replay if replay is not None else {}
+        self.calls = 0
+        self.replayed_calls = 0
+        repeat = thinking_chars // len(DEFAULT_STUB_THINKING) + 1
+        self.default_thinking = (DEFAULT_STUB_THINKING * repeat)[:thinking_chars]
+
+    def _respond(self, prompt: str, format: dict | None) -> str:
+        entry = self.replay.get(prompt)
+        if format is None:
+            if entry is not None and entry.thinking is not None:
+                self.replayed_calls += 1
+                return entry.thinking
+            return self.default_thinking
+        if entry is not None and entry.has_value:
+            self.replayed_calls += 1
+            return json.dumps({entry.column: entry.value})
+        return json.dumps(
+            {
+                name: make_stub_value(schema)
+                for name, schema in format.get("properties", {}).items()
+            }
+        )
+
+    def _stream(
+        self, content: str, prompt_tokens: int
+    ) -> typing.Generator[ollama.ChatResponse, None, None]:
+        chunks = [
+            content[index : index + self.chunk_chars]
+            for index in range(0, len(content), self.chunk_chars)
+        ] or [""]
+        for index, chunk in enumerate(chunks):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            last = index == len(chunks) - 1
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content=chunk),
+                done=last,
+                prompt_eval_count=prompt_tokens if last else None,
+                eval_count=len(chunks) if last else None,
+            )
+
+    def __call__(
+        self,
+        model: str,
+        messages: list[ollama.Message],
+        format: dict | None = None,
+        stream: bool = False,
+        **kwargs,
+    ) -> ollama.ChatResponse | typing.Iterator[ollama.ChatResponse]:
+        self.calls += 1
+        prompt = messages[-1].content if messages else ""
+        content = self._respond(prompt, format)
+        # rough estimation like the planner does
+        prompt_tokens = len(prompt) // 4
+        if stream:
+            return self._stream(content, prompt_tokens)
+        return ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content=content),
+            done=True,
+            prompt_eval_count=prompt_tokens,
+            eval_count=len(content) // 4,
+        )
+
+
+@contextlib.contextmanager
+def use_stub_llm(stub: StubLLM) -> typing.Generator[StubLLM, None, None]:
+    original_chat = ollama.chat
+    ollama.chat = stub
+    try:
+        yield stub
+    finally:
+        ollama.chat = original_chat
+
+
+def format_frame(code: types.CodeType) -> str:
+    filename = pathlib.PurePath(code.co_filename).name
+    # semicolons separate frames in the collapsed stack format
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+class StackSampler:
+    # Samples the stack of a thread periodically, the result can be turned into a
+    # flame graph with the collapsed stack format. The overhead doesn't depend on the
+    # number of function calls like cProfile
+    def __init__(self, interval: float = 0.005, thread_id: int | None = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks: collections.Counter[tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(format_frame(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[tuple(stack)] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "StackSampler":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def collapsed(self) -> dict[str, float]:
+        return {";".join(stack): count for stack, count in self.stacks.items()}
+
+    def format_stats(self, limit: int = 30) -> str:
+        own: collections.Counter[str] = collections.Counter()
+        total: collections.Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            # recursive functions are only counted once for each sample
+            for frame in set(stack):
+                total[frame] += count
+        lines = [
+            f"{self.samples} samples with {self.interval * 1000:.1f}ms interval",
+            "",
+            "Own%\tTotal%\tFunction",
+        ]
+        samples = max(self.samples, 1)
+        for frame, count in own.most_common(limit):
+            lines.append(
+                f"{count / samples * 100:.1f}\t{total[frame] / samples * 100:.1f}\t{frame}"
+            )
+        return "\n".join(lines)
+
+
+def collapse_pstats(stats: pstats.Stats, min_seconds: float = 1e-6) -> dict[str, float]:
+    # cProfile only records callers of each function instead of full stacks, so
+    # the stacks are rebuilt by splitting the time of each function among its
+    # callers proportionally, like other converters of cProfile output do
+    entries = stats.stats
+    callees: dict[tuple, dict[tuple, float]] = collections.defaultdict(dict)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+
+    def label(func: tuple) -> str:
+        filename, lineno, name = func
+        if filename == "~":
+            # built-in functions
+            return name.replace(";", ":")
+        return f"{name} ({pathlib.PurePath(filename).name}:{lineno})".replace(";", ":")
+
+    result: dict[str, float] = collections.defaultdict(float)
+
+    def visit(func: tuple, path: list[str], seen: set[tuple], ratio: float):
+        _, _, own_time, _, _ = entries[func]
+        if own_time * ratio >= min_seconds:
+            result[";".join(path)] += own_time * ratio
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, {}).items():
+            if callee in seen or callee not in entries:
+                continue
+            callee_time = entries[callee][3]
+            if callee_time <= 0 or edge_time * ratio < min_seconds:
+                continue
+            seen.add(callee)
+            visit(
+                callee,
+                [*path, label(callee)],
+                seen,
+                ratio * min(edge_time / callee_time, 1.0),
+            )
+            seen.remove(callee)
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            visit(func, [label(func)], {func}, 1.0)
+    return dict(result)
+
+
+def write_collapsed(stacks: dict[str, float], path: pathlib.Path, scale: float = 1):
+    # flamegraph.pl and speedscope expect integer counts, time is written in
+    # microseconds for cProfile
+    with path.open("wt") as fo:
+        for stack, value in sorted(stacks.items()):
+            count = round(value * scale)
+            if count <= 0:
+                continue
+            fo.write(f"{stack} {count}\n")
+
+
+@dataclasses.dataclass(frozen=True)
+class ImportTime:
+    module: str
+    # nesting level in the import tree, 0 for the imported module itself
+    level: int
+    self_us: int
+    cumulative_us: int
+
+
+def measure_import_time(module: str) -> list[ImportTime]:
+    # Imports the module in a fresh interpreter with -X importtime, as modules
+    # already imported by the current process are not imported again
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE_REGEX.match(line)
+        if match is None:
+            continue
+        name = match.group("name")
+        entries.append(
+            ImportTime(
+                module=name.strip(),
+                level=(len(name) - len(name.lstrip())) // 2,
+                self_us=int(match.group("self")),
+                cumulative_us=int(match.group("cumulative")),
+            )
+        )
+    return entries
+
+
+def find_import_time(entries: list[ImportTime], module: str) -> ImportTime:
+    for entry in entries:
+        if entry.module == module and entry.level == 0:
+            return entry
+    raise ValueError(f"Module {module} is not imported")
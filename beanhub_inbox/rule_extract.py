@@ -0,0 +1,99 @@
+import functools
+import re
+import typing
+
+import pydantic
+
+from .data_types import ColumnExtractor
+from .data_types import OutputColumn
+from .data_types import OutputColumnType
+from .llm import build_row_model
+from .matchers import match_str
+from .utils import get_header
+
+
+def run_column_extractor(
+    extractor: ColumnExtractor,
+    column_name: str,
+    text: str,
+    headers: typing.Mapping[str, str],
+) -> str | None:
+    if extractor.regex is not None:
+        match = re.search(extractor.regex, text, flags=re.MULTILINE)
+        if match is None:
+            return None
+        if extractor.value is not None:
+            return extractor.value
+        group_dict = match.groupdict()
+        if column_name in group_dict:
+            return group_dict[column_name]
+        return match.group(0)
+    # extractors have either regex or header, as validated by the model
+    header_value = get_header(headers, extractor.header)
+    if header_value is None:
+        return None
+    if extractor.match is None:
+        return extractor.value if extractor.value is not None else header_value
+    matched, group_dict = match_str(extractor.match, header_value)
+    if not matched:
+        return None
+    if extractor.value is not None:
+        return extractor.value
+    return group_dict.get(column_name, header_value)
+
+
+@functools.lru_cache(maxsize=256)
+def build_column_model(
+    name: str, column_type: OutputColumnType, pattern: str | None, required: bool
+) -> typing.Type[pydantic.BaseModel]:
+    # the description does not change the validation, leave it out of the cache key
+    column = OutputColumn(
+        name=name, type=column_type, description="", pattern=pattern, required=required
+    )
+    return build_row_model(output_columns=[column])
+
+
+def convert_column_value(
+    column: OutputColumn, value: typing.Any
+) -> tuple[bool, typing.Any]:
+    # Validate and convert the value the same way as LLM structured output
+    model_cls = build_column_model(
+        name=column.name,
+        column_type=column.type,
+        pattern=column.pattern,
+        required=column.required,
+    )
+    try:
+        result = model_cls.model_validate({column.name: value})
+    except pydantic.ValidationError:
+        return False, None
+    return True, result.model_dump(mode="json")[column.name]
+
+
+def extract_columns_by_rules(
+    columns: list[OutputColumn],
+    text: str,
+    headers: typing.Mapping[str, str],
+    match_vars: dict | None = None,
+) -> dict[str, typing.Any]:
+    def iter_candidates(column: OutputColumn) -> typing.Generator[str, None, None]:
+        if match_vars is not None and match_vars.get(column.name) is not None:
+            yield match_vars[column.name]
+        for extractor in column.extractors or []:
+            value = run_column_extractor(
+                extractor=extractor,
+                column_name=column.name,
+                text=text,
+                headers=headers,
+            )
+            if value is not None:
+                yield value
+
+    values = {}
+    for column in columns:
+        for candidate in iter_candidates(column):
+            converted, value = convert_column_value(column, candidate)
+            if converted:
+                values[column.name] = value
+                break
+    return values
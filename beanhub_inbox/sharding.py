@@ -0,0 +1,87 @@
+import csv
+import dataclasses
+import hashlib
+import os
+import pathlib
+
+
+def shard_of(rel_filepath: pathlib.PurePath, shard_count: int) -> int:
+    # A stable hash instead of Python's hash(), which is randomized per process
+    digest = hashlib.sha1(rel_filepath.as_posix().encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+def make_shard_path(path: pathlib.Path, index: int, count: int) -> pathlib.Path:
+    return path.with_name(f"{path.stem}.shard-{index}-of-{count}{path.suffix}")
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    def __post_init__(self):
+        if self.count < 1:
+            raise ValueError(f"Shard count {self.count} should be at least 1")
+        if not (0 <= self.index < self.count):
+            raise ValueError(
+                f"Shard index {self.index} should be in range [0, {self.count})"
+            )
+
+    def contains(self, rel_filepath: pathlib.PurePath) -> bool:
+        return shard_of(rel_filepath, self.count) == self.index
+
+    def output_path(self, path: pathlib.Path) -> pathlib.Path:
+        return make_shard_path(path, index=self.index, count=self.count)
+
+
+def merge_shard_csvs(
+    output_csv: pathlib.Path, shard_count: int, remove_shards: bool = False
+) -> int:
+    # Merges rows from the existing output CSV file and all the shard CSV files into
+    # the output CSV file sorted by id. The first value seen for each column of an id
+    # wins, so values already merged are never replaced by the shards, while empty or
+    # missing columns are filled with the values backfilled by the shards
+    csv_files = [
+        output_csv,
+        *(
+            make_shard_path(output_csv, index=index, count=shard_count)
+            for index in range(shard_count)
+        ),
+    ]
+    fieldnames: list[str] = []
+    rows: dict[str, dict[str, str]] = {}
+    for csv_file in csv_files:
+        if not csv_file.exists():
+            continue
+        with csv_file.open("rt") as fo:
+            reader = csv.DictReader(fo)
+            if reader.fieldnames is None:
+                continue
+            if "id" not in reader.fieldnames:
+                raise ValueError(f"No id column found in the csv file at {csv_file}")
+            fieldnames.extend(
+                name for name in reader.fieldnames if name not in fieldnames
+            )
+            for row in reader:
+                merged_row = rows.get(row["id"])
+                if merged_row is None:
+                    rows[row["id"]] = row
+                    continue
+                for name, value in row.items():
+                    if value and not merged_row.get(name):
+                        merged_row[name] = value
+    if not fieldnames:
+        return 0
+    output_csv.parent.mkdir(parents=True, exist_ok=True)
+    tmp_csv = output_csv.with_name(f".{output_csv.name}.merge")
+    with tmp_csv.open("wt", newline="") as fo:
+        writer = csv.DictWriter(fo, fieldnames=fieldnames)
+        writer.writeheader()
+        for email_id in sorted(rows):
+            writer.writerow(rows[email_id])
+    os.replace(tmp_csv, output_csv)
+    if remove_shards:
+        for csv_file in csv_files[1:]:
+            csv_file.unlink(missing_ok=True)
+    return len(rows)
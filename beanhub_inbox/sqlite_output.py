@@ -0,0 +1,181 @@
+import contextlib
+import csv
+import os
+import pathlib
+import sqlite3
+import typing
+import uuid
+
+from .utils import file_lock
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def to_sql_value(value: typing.Any) -> str:
+    # store values the same way as CSV module writes them, so that the exported CSV
+    # file is identical to the one written directly
+    if value is None:
+        return ""
+    return str(value)
+
+
+class SQLiteOutput:
+    def __init__(
+        self,
+        database: pathlib.Path,
+        table: str,
+        fieldnames: list[str],
+        batch_size: int = 1,
+        timeout: float = 30.0,
+    ):
+        self.database = database
+        self.table = table
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+        # id -> values of rows not written to the database yet
+        self._pending_rows: dict[str, dict[str, str]] = {}
+        # output CSV files to export rows into when finishing the processing
+        self.export_csv_files: set[pathlib.Path] = set()
+        database.parent.mkdir(parents=True, exist_ok=True)
+        # we manage transactions ourselves
+        self.conn = sqlite3.connect(database, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} "
+            "(id TEXT PRIMARY KEY NOT NULL)"
+        )
+        existing_columns = frozenset(
+            row[1]
+            for row in self.conn.execute(
+                f"PRAGMA table_info({quote_identifier(table)})"
+            )
+        )
+        for name in fieldnames:
+            if name in existing_columns:
+                continue
+            self.conn.execute(
+                f"ALTER TABLE {quote_identifier(table)} ADD COLUMN {quote_identifier(name)} TEXT"
+            )
+
+    def is_empty(self) -> bool:
+        cursor = self.conn.execute(
+            f"SELECT 1 FROM {quote_identifier(self.table)} LIMIT 1"
+        )
+        return cursor.fetchone() is None
+
+    def import_csv(self, output_csv: pathlib.Path):
+        with output_csv.open("rt") as fo:
+            reader = csv.DictReader(fo)
+            if "id" not in reader.fieldnames:
+                raise ValueError(
+                    f"No id column found in the existing output csv file at {output_csv}"
+                )
+            # all the rows are imported in one transaction
+            for row in reader:
+                self._buffer_row(
+                    {key: value for key, value in row.items() if key in self.fieldnames}
+                )
+        self.commit()
+
+    def find_row(self, email_id: str) -> dict[str, str] | None:
+        cursor = self.conn.execute(
+            f"SELECT * FROM {quote_identifier(self.table)} WHERE id = ?",
+            (email_id,),
+        )
+        row = cursor.fetchone()
+        pending_row = self._pending_rows.get(email_id)
+        if row is None and pending_row is None:
+            return None
+        result = {}
+        if row is not None:
+            names = [item[0] for item in cursor.description]
+            # NULL means the column was never written, just like missing CSV column
+            result = {
+                name: value for name, value in zip(names, row) if value is not None
+            }
+        if pending_row is not None:
+            result |= pending_row
+        return result
+
+    @property
+    def has_pending_rows(self) -> bool:
+        return bool(self._pending_rows)
+
+    def upsert_row(self, row: dict):
+        # Rows arrive between LLM calls, so they are written in a short transaction
+        # for each batch instead of holding the write lock of an open transaction
+        self._buffer_row(row)
+        if len(self._pending_rows) >= self.batch_size:
+            self.commit()
+
+    def _buffer_row(self, row: dict):
+        if "id" not in row:
+            raise ValueError("Row needs an id value")
+        values = {
+            name: value if name == "id" else to_sql_value(value)
+            for name, value in row.items()
+        }
+        pending_row = self._pending_rows.get(row["id"])
+        if pending_row is None:
+            self._pending_rows[row["id"]] = values
+        else:
+            # only the given columns are updated, just like the upsert statement
+            pending_row.update(values)
+
+    def commit(self):
+        if not self._pending_rows:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for row in self._pending_rows.values():
+                names = list(row.keys())
+                columns = ", ".join(map(quote_identifier, names))
+                placeholders = ", ".join("?" for _ in names)
+                updates = ", ".join(
+                    f"{quote_identifier(name)} = excluded.{quote_identifier(name)}"
+                    for name in names
+                    if name != "id"
+                )
+                self.conn.execute(
+                    f"INSERT INTO {quote_identifier(self.table)} ({columns}) "
+                    f"VALUES ({placeholders})"
+                    + (
+                        f" ON CONFLICT(id) DO UPDATE SET {updates}"
+                        if updates
+                        else " ON CONFLICT(id) DO NOTHING"
+                    ),
+                    list(row.values()),
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self._pending_rows = {}
+
+    def export_csv(self, output_csv: pathlib.Path, lock: bool = False):
+        # lock is needed when multiple workers are exporting to the same file, the
+        # unique tmp file keeps each export complete either way
+        self.commit()
+        output_csv.parent.mkdir(parents=True, exist_ok=True)
+        tmp_csv = output_csv.with_name(f".{output_csv.name}.{uuid.uuid4().hex}.export")
+        columns = ", ".join(map(quote_identifier, self.fieldnames))
+        with file_lock(output_csv) if lock else contextlib.nullcontext():
+            cursor = self.conn.execute(
+                f"SELECT {columns} FROM {quote_identifier(self.table)} ORDER BY id"
+            )
+            try:
+                with tmp_csv.open("wt", newline="") as fo:
+                    writer = csv.writer(fo)
+                    writer.writerow(self.fieldnames)
+                    for row in cursor:
+                        writer.writerow("" if value is None else value for value in row)
+                os.replace(tmp_csv, output_csv)
+            finally:
+                tmp_csv.unlink(missing_ok=True)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import pathlib
+import re
+import threading
+import typing
+import uuid
+
+from .data_types import OutputColumn
+from .data_types import OutputColumnType
+from .pre_classify import normalize_address
+from .rule_extract import convert_column_value
+
+CACHE_FILE_VERSION = 1
+
+
+def html_fingerprint(html: str) -> str | None:
+    from lxml import etree
+
+    parser = etree.HTMLParser()
+    tree = etree.fromstring(html, parser)
+    if tree is None:
+        return None
+    hasher = hashlib.sha256()
+    for element in tree.iter():
+        # skip comments and processing instructions
+        if not isinstance(element.tag, str):
+            continue
+        # only structure goes into fingerprint, text content and attribute values
+        # other than class are volatile across emails from the same template
+        hasher.update(element.tag.encode("utf8"))
+        class_name = element.get("class")
+        if class_name:
+            hasher.update(b".")
+            hasher.update(" ".join(sorted(class_name.split())).encode("utf8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def make_template_key(from_addresses: list[str], fingerprint: str) -> str:
+    senders = ",".join(sorted(map(normalize_address, from_addresses)))
+    return hashlib.sha256(f"{senders}\0{fingerprint}".encode("utf8")).hexdigest()
+
+
+def apply_extractor(extractor: dict, text: str) -> tuple[bool, typing.Any]:
+    if "const" in extractor:
+        return True, extractor["const"]
+    match = re.search(extractor["regex"], text, flags=re.MULTILINE)
+    if match is None:
+        return False, None
+    return True, match.group("value")
+
+
+def derive_extractor(text: str, value: typing.Any) -> dict:
+    if not isinstance(value, str) or not value or "\n" in value:
+        return dict(const=value)
+    index = text.find(value)
+    if index == -1:
+        return dict(const=value)
+    line_start = text.rfind("\n", 0, index) + 1
+    line_end = text.find("\n", index + len(value))
+    if line_end == -1:
+        line_end = len(text)
+    prefix = text[line_start:index]
+    suffix = text[index + len(value) : line_end]
+    if prefix.strip():
+        anchor = re.escape(prefix)
+    elif line_start > 0:
+        # value is at the beginning of the line, anchor with the previous line instead
+        prev_line_start = text.rfind("\n", 0, line_start - 1) + 1
+        prev_line = text[prev_line_start : line_start - 1]
+        if not prev_line.strip():
+            return dict(const=value)
+        anchor = re.escape(prev_line) + "\\n" + re.escape(prefix)
+    else:
+        return dict(const=value)
+    extractor = dict(regex=f"^{anchor}(?P<value>.+?){re.escape(suffix)}$")
+    # make sure the anchor doesn't pick up other text appearing earlier
+    if apply_extractor(extractor, text) != (True, value):
+        return dict(const=value)
+    return extractor
+
+
+class TemplateCache:
+    # Shared by the threads processing emails in the same process, so that templates
+    # learned by all of them are saved instead of the ones of the last thread saving
+    def __init__(self, templates: dict[str, dict] | None = None):
+        # template key -> dict(hits=..., columns={name: extractor with samples count})
+        self.templates: dict[str, dict] = templates if templates is not None else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, cache_file: pathlib.Path) -> "TemplateCache":
+        if not cache_file.exists():
+            return cls()
+        with cache_file.open("rt") as fo:
+            payload = json.load(fo)
+        if payload.get("version") != CACHE_FILE_VERSION:
+            return cls()
+        return cls(templates=payload["templates"])
+
+    def save(self, cache_file: pathlib.Path):
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # unique tmp file for workers saving the same cache at the same time
+        tmp_file = cache_file.with_name(f".{cache_file.name}.{uuid.uuid4().hex}.tmp")
+        with self._lock, tmp_file.open("wt") as fo:
+            json.dump(dict(version=CACHE_FILE_VERSION, templates=self.templates), fo)
+        os.replace(tmp_file, cache_file)
+
+    def extract(
+        self, key: str, text: str, columns: list[OutputColumn], min_samples: int
+    ) -> dict[str, typing.Any]:
+        with self._lock:
+            template = self.templates.get(key)
+            if template is None:
+                return {}
+            extractors = dict(template["columns"])
+        values = {}
+        for column in columns:
+            extractor = extractors.get(column.name)
+            if extractor is None or extractor["samples"] < min_samples:
+                continue
+            # a value not found in the text could just be shared by a few emails by
+            # chance, such as the same date, so only bool columns like valid can
+            # reuse a constant value from the same template
+            if "const" in extractor and column.type != OutputColumnType.bool:
+                continue
+            matched, value = apply_extractor(extractor, text)
+            if not matched:
+                continue
+            converted, value = convert_column_value(column, value)
+            if not converted:
+                continue
+            values[column.name] = value
+        return values
+
+    def record_hit(self, key: str) -> int:
+        with self._lock:
+            template = self.templates[key]
+            template["hits"] += 1
+            return template["hits"]
+
+    def learn(
+        self, key: str, text: str, values: dict[str, typing.Any], min_samples: int
+    ) -> list[str]:
+        with self._lock:
+            template = self.templates.setdefault(key, dict(hits=0, columns={}))
+            columns = template["columns"]
+            drifted_columns = []
+            for column_name, value in values.items():
+                extractor = columns.get(column_name)
+                if extractor is not None:
+                    if apply_extractor(extractor, text) == (True, value):
+                        extractor["samples"] += 1
+                        continue
+                    if extractor["samples"] >= min_samples:
+                        drifted_columns.append(column_name)
+                columns[column_name] = derive_extractor(text, value) | dict(samples=1)
+            return drifted_columns
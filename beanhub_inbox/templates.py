@@ -1,13 +1,17 @@
 import pathlib
+import typing
 
-from jinja2.sandbox import SandboxedEnvironment
+if typing.TYPE_CHECKING:
+    from jinja2.sandbox import SandboxedEnvironment
 
 
 def as_posix_path(path: pathlib.Path) -> str:
     return pathlib.Path(path).as_posix()
 
 
-def make_environment():
+def make_environment() -> "SandboxedEnvironment":
+    from jinja2.sandbox import SandboxedEnvironment
+
     env = SandboxedEnvironment()
     env.filters["as_posix_path"] = as_posix_path
     return env
@@ -0,0 +1,55 @@
+import dataclasses
+import enum
+import threading
+import typing
+
+if typing.TYPE_CHECKING:
+    import ollama
+
+
+@enum.unique
+class TokenBudgetScope(str, enum.Enum):
+    email = "email"
+    run = "run"
+
+
+@dataclasses.dataclass
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "TokenUsage"):
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+
+    def add_response(self, response: "ollama.ChatResponse"):
+        # Ollama only reports the counts with the last chunk of a streaming response
+        if response.prompt_eval_count is not None:
+            self.prompt_tokens += response.prompt_eval_count
+        if response.eval_count is not None:
+            self.completion_tokens += response.eval_count
+
+
+class TokenAccounting:
+    # Token usage of a run, broken down by email and column
+    def __init__(self):
+        self.run = TokenUsage()
+        self.emails: dict[str, TokenUsage] = {}
+        self.columns: dict[str, TokenUsage] = {}
+        # set when the run budget is exceeded, so that the remaining emails are left
+        # for the next run
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def record(self, email_id: str, column: str, usage: TokenUsage):
+        with self._lock:
+            self.run.add(usage)
+            self.emails.setdefault(email_id, TokenUsage()).add(usage)
+            self.columns.setdefault(column, TokenUsage()).add(usage)
+
+    def email_usage(self, email_id: str) -> TokenUsage:
+        return self.emails.get(email_id, TokenUsage())
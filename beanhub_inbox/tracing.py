@@ -0,0 +1,297 @@
+import contextlib
+import dataclasses
+import enum
+import json
+import os
+import pathlib
+import threading
+import time
+import typing
+
+AttributeValue = str | bool | int | float
+SCOPE_NAME = "beanhub_inbox"
+
+
+@enum.unique
+class SpanKind(enum.IntEnum):
+    # values of SpanKind in OTLP
+    internal = 1
+    client = 3
+
+
+@enum.unique
+class SpanStatusCode(enum.IntEnum):
+    # values of Status.StatusCode in OTLP
+    unset = 0
+    ok = 1
+    error = 2
+
+
+@dataclasses.dataclass
+class SpanEvent:
+    name: str
+    time: int
+    attributes: dict[str, AttributeValue] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass(eq=False)
+class Span:
+    tracer: "Tracer" = dataclasses.field(repr=False)
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: str | None
+    kind: SpanKind
+    # nanoseconds since epoch as in OTLP
+    start_time: int
+    end_time: int | None = None
+    attributes: dict[str, AttributeValue] = dataclasses.field(default_factory=dict)
+    events: list[SpanEvent] = dataclasses.field(default_factory=list)
+    status_code: SpanStatusCode = SpanStatusCode.unset
+    status_message: str | None = None
+
+    def set_attribute(self, key: str, value: AttributeValue | None):
+        # None values are dropped like OpenTelemetry does
+        if value is None:
+            return
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes: typing.Mapping[str, AttributeValue | None]):
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def add_event(
+        self,
+        name: str,
+        attributes: typing.Mapping[str, AttributeValue] | None = None,
+        timestamp: int | None = None,
+    ):
+        self.events.append(
+            SpanEvent(
+                name=name,
+                time=timestamp if timestamp is not None else self.tracer.clock(),
+                attributes=dict(attributes or {}),
+            )
+        )
+
+    def set_error(self, exc: BaseException):
+        self.status_code = SpanStatusCode.error
+        self.status_message = repr(exc)
+        self.add_event(
+            "exception",
+            {
+                "exception.type": type(exc).__name__,
+                "exception.message": str(exc),
+            },
+        )
+
+    def end(self, end_time: int | None = None):
+        if self.end_time is not None:
+            return
+        self.end_time = end_time if end_time is not None else self.tracer.clock()
+        self.tracer.export(self)
+
+    @property
+    def duration(self) -> float | None:
+        if self.end_time is None:
+            return None
+        return (self.end_time - self.start_time) / 1e9
+
+
+class SpanExporter(typing.Protocol):
+    def export(self, span: Span): ...
+
+    def close(self): ...
+
+
+class InMemorySpanExporter:
+    def __init__(self):
+        self.spans: list[Span] = []
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def close(self):
+        pass
+
+
+def encode_attribute_value(value: AttributeValue) -> dict:
+    # bool is a subclass of int, check it first
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    elif isinstance(value, int):
+        # 64 bits integers are strings in OTLP JSON
+        return dict(intValue=str(value))
+    elif isinstance(value, float):
+        return dict(doubleValue=value)
+    return dict(stringValue=str(value))
+
+
+def encode_attributes(attributes: typing.Mapping[str, AttributeValue]) -> list[dict]:
+    return [
+        dict(key=key, value=encode_attribute_value(value))
+        for key, value in attributes.items()
+    ]
+
+
+def encode_span(span: Span) -> dict:
+    record = dict(
+        traceId=span.trace_id,
+        spanId=span.span_id,
+        name=span.name,
+        kind=int(span.kind),
+        startTimeUnixNano=str(span.start_time),
+        endTimeUnixNano=str(span.end_time),
+        attributes=encode_attributes(span.attributes),
+        events=[
+            dict(
+                timeUnixNano=str(event.time),
+                name=event.name,
+                attributes=encode_attributes(event.attributes),
+            )
+            for event in span.events
+        ],
+        status=dict(code=int(span.status_code)),
+    )
+    if span.parent_span_id is not None:
+        record["parentSpanId"] = span.parent_span_id
+    if span.status_message is not None:
+        record["status"]["message"] = span.status_message
+    return record
+
+
+class JSONLinesSpanExporter:
+    # Writes each span as an OTLP/JSON ExportTraceServiceRequest per line, the file
+    # format read by the otlpjsonfile receiver of OpenTelemetry Collector, so that
+    # the traces can be forwarded to any OpenTelemetry backend
+    def __init__(self, path: pathlib.Path, service_name: str = "beanhub-inbox"):
+        self.path = path
+        self.resource = dict(
+            attributes=encode_attributes({"service.name": service_name})
+        )
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._fo = path.open("at")
+
+    def export(self, span: Span):
+        line = json.dumps(
+            dict(
+                resourceSpans=[
+                    dict(
+                        resource=self.resource,
+                        scopeSpans=[
+                            dict(scope=dict(name=SCOPE_NAME), spans=[encode_span(span)])
+                        ],
+                    )
+                ]
+            ),
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        with self._lock:
+            self._fo.write(line + "\n")
+            if span.parent_span_id is None:
+                # flush for each trace, so that it's readable while still running
+                self._fo.flush()
+
+    def close(self):
+        with self._lock:
+            self._fo.close()
+
+
+class Tracer:
+    def __init__(
+        self,
+        exporter: SpanExporter,
+        clock: typing.Callable[[], int] = time.time_ns,
+    ):
+        self.exporter = exporter
+        self.clock = clock
+
+    def start_span(
+        self,
+        name: str,
+        parent: Span | None = None,
+        attributes: typing.Mapping[str, AttributeValue | None] | None = None,
+        kind: SpanKind = SpanKind.internal,
+        start_time: int | None = None,
+    ) -> Span:
+        span = Span(
+            tracer=self,
+            name=name,
+            # a new trace for each root span
+            trace_id=parent.trace_id if parent is not None else os.urandom(16).hex(),
+            span_id=os.urandom(8).hex(),
+            parent_span_id=parent.span_id if parent is not None else None,
+            kind=kind,
+            start_time=start_time if start_time is not None else self.clock(),
+        )
+        if attributes is not None:
+            span.set_attributes(attributes)
+        return span
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        parent: Span | None = None,
+        attributes: typing.Mapping[str, AttributeValue | None] | None = None,
+        kind: SpanKind = SpanKind.internal,
+        start_time: int | None = None,
+    ) -> typing.Generator[Span, None, None]:
+        span = self.start_span(
+            name, parent=parent, attributes=attributes, kind=kind, start_time=start_time
+        )
+        try:
+            yield span
+        except GeneratorExit:
+            # the consumer stopped iterating the events, not an error of the span
+            raise
+        except BaseException as exc:
+            span.set_error(exc)
+            raise
+        finally:
+            span.end()
+
+    def export(self, span: Span):
+        self.exporter.export(span)
+
+    def close(self):
+        self.exporter.close()
+
+
+def start_child_span(
+    parent: Span | None,
+    name: str,
+    attributes: typing.Mapping[str, AttributeValue | None] | None = None,
+    kind: SpanKind = SpanKind.internal,
+) -> Span | None:
+    # tracing is disabled without a parent span
+    if parent is None:
+        return None
+    return parent.tracer.start_span(
+        name, parent=parent, attributes=attributes, kind=kind
+    )
+
+
+def child_span(
+    parent: Span | None,
+    name: str,
+    attributes: typing.Mapping[str, AttributeValue | None] | None = None,
+    kind: SpanKind = SpanKind.internal,
+) -> typing.ContextManager[Span | None]:
+    if parent is None:
+        return contextlib.nullcontext()
+    return parent.tracer.span(name, parent=parent, attributes=attributes, kind=kind)
+
+
+def tracer_span(
+    tracer: Tracer | None,
+    name: str,
+    attributes: typing.Mapping[str, AttributeValue | None] | None = None,
+    kind: SpanKind = SpanKind.internal,
+    start_time: int | None = None,
+) -> typing.ContextManager[Span | None]:
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, attributes=attributes, kind=kind, start_time=start_time)
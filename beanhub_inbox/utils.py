@@ -1,6 +1,12 @@
+import contextlib
+import pathlib
 import typing
 
-from email_validator import validate_email
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    fcntl = None
 
 
 T = typing.TypeVar("T")
@@ -18,6 +24,8 @@ class GeneratorResult(typing.Generic[T, S, R]):
 
 
 def parse_tags(email_address: str, domains: typing.Collection[str]) -> list[str] | None:
+    from email_validator import validate_email
+
     email_info = validate_email(email_address, check_deliverability=False)
     domain = email_info.domain.lower()
     if domain not in domains:
@@ -26,3 +34,29 @@ def parse_tags(email_address: str, domains: typing.Collection[str]) -> list[str]
     if len(parts) <= 2:
         return None
     return parts[2:]
+
+
+def get_header(headers: typing.Mapping[str, str], name: str) -> str | None:
+    value = headers.get(name)
+    if value is not None:
+        return value
+    lower_name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == lower_name:
+            return value
+    return None
+
+
+@contextlib.contextmanager
+def file_lock(path: pathlib.Path) -> typing.Generator[None, None, None]:
+    # Exclusive lock of the given file across processes, with a lock file next to it
+    lock_file = path.with_name(f".{path.name}.lock")
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with lock_file.open("a") as fo:
+        if fcntl is not None:
+            fcntl.flock(fo.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fo.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,273 @@
+import ctypes.util
+import logging
+import os
+import pathlib
+import select
+import struct
+import sys
+import threading
+import time
+import typing
+
+from .concurrency import AdaptiveLimiter
+from .data_types import InboxDoc
+from .dedup import DuplicateDetector
+from .metrics import PipelineMetrics
+from .pre_classify import SenderHistory
+from .processor import process_imports
+from .processor import ProcessImportEvent
+from .processor import walk_dir_files
+from .sharding import Shard
+from .token_usage import TokenAccounting
+from .tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class Watcher(typing.Protocol):
+    def read_changes(self, timeout: float) -> set[pathlib.Path]: ...
+
+    def close(self): ...
+
+
+class InotifyWatcher:
+    # Watches the input dir recursively with Linux inotify, so that nothing is
+    # scanned while there is no new email file
+    def __init__(self, input_dir: pathlib.Path):
+        self.input_dir = input_dir
+        libc_name = ctypes.util.find_library("c")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._dirs: dict[int, pathlib.Path] = {}
+        self._add_watch_tree(input_dir)
+
+    def _add_watch(self, dir_path: pathlib.Path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dir_path), ctypes.c_uint32(WATCH_MASK)
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(dir_path))
+        self._dirs[wd] = dir_path
+
+    def _add_watch_tree(self, dir_path: pathlib.Path) -> set[pathlib.Path]:
+        # Files created in a new sub-dir before the watch is added are missed by
+        # inotify, returns them so that they are still picked up
+        filepaths = set()
+        for root, dirs, files in os.walk(dir_path):
+            root_path = pathlib.Path(root)
+            self._add_watch(root_path)
+            filepaths.update(root_path / file for file in files)
+        return filepaths
+
+    def read_changes(self, timeout: float) -> set[pathlib.Path]:
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return set()
+        changes = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Inotify event queue overflowed, rescan input dir")
+                changes.update(walk_dir_files(self.input_dir))
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            dir_path = self._dirs.get(wd)
+            if dir_path is None or not name:
+                continue
+            path = dir_path / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and path.is_dir():
+                    changes.update(self._add_watch_tree(path))
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changes.add(path)
+        return changes
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    # Fallback for platforms without inotify, finds new or modified files by
+    # comparing the mtime and size of the files in the input dir
+    def __init__(self, input_dir: pathlib.Path, interval: float = 2.0):
+        self.input_dir = input_dir
+        self.interval = interval
+        self._stats = self._scan()
+        self._last_scan = time.monotonic()
+
+    def _scan(self) -> dict[pathlib.Path, tuple[int, int]]:
+        stats = {}
+        for filepath in walk_dir_files(self.input_dir):
+            try:
+                stat = filepath.stat()
+            except FileNotFoundError:
+                continue
+            stats[filepath] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def read_changes(self, timeout: float) -> set[pathlib.Path]:
+        wait = self._last_scan + self.interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        if wait > 0:
+            time.sleep(wait)
+        stats = self._scan()
+        self._last_scan = time.monotonic()
+        changes = {
+            filepath
+            for filepath, stat in stats.items()
+            if self._stats.get(filepath) != stat
+        }
+        self._stats = stats
+        return changes
+
+    def close(self):
+        pass
+
+
+def make_watcher(
+    input_dir: pathlib.Path, poll_interval: float = 2.0, use_inotify: bool = True
+) -> Watcher:
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(input_dir)
+        except (OSError, AttributeError) as exc:
+            logger.warning(
+                "Failed to watch input dir %s with inotify, fallback to polling: %s",
+                input_dir,
+                exc,
+            )
+    return PollingWatcher(input_dir, interval=poll_interval)
+
+
+def collect_changes(
+    watcher: Watcher,
+    debounce: float = 1.0,
+    max_batch_size: int = 100,
+    max_delay: float = 10.0,
+    stop_event: threading.Event | None = None,
+    idle_timeout: float = 1.0,
+) -> set[pathlib.Path]:
+    # Wait for changes until there is no more for debounce seconds, so that a burst of
+    # new email files is processed as one batch
+    changes: set[pathlib.Path] = set()
+    first_change_at = None
+    while stop_event is None or not stop_event.is_set():
+        if first_change_at is None:
+            timeout = idle_timeout
+        else:
+            timeout = min(debounce, first_change_at + max_delay - time.monotonic())
+        new_changes = watcher.read_changes(timeout=max(timeout, 0))
+        if new_changes:
+            if first_change_at is None:
+                first_change_at = time.monotonic()
+            changes.update(new_changes)
+            if len(changes) < max_batch_size and (
+                time.monotonic() - first_change_at < max_delay
+            ):
+                continue
+        if changes:
+            break
+    return changes
+
+
+def watch_imports(
+    inbox_doc: InboxDoc,
+    input_dir: pathlib.Path,
+    llm_model: str,
+    workdir_path: pathlib.Path,
+    debounce: float = 1.0,
+    max_batch_size: int = 100,
+    max_delay: float = 10.0,
+    poll_interval: float = 2.0,
+    use_inotify: bool = True,
+    stop_event: threading.Event | None = None,
+    shard: Shard | None = None,
+    llm_limiter: AdaptiveLimiter | None = None,
+    token_accounting: TokenAccounting | None = None,
+    metrics: PipelineMetrics | None = None,
+    tracer: Tracer | None = None,
+) -> typing.Generator[ProcessImportEvent, None, None]:
+    if token_accounting is None:
+        token_accounting = TokenAccounting()
+    sender_history = SenderHistory()
+    duplicate_detectors: dict[pathlib.Path, DuplicateDetector] = {}
+    # start watching before the initial scan, so that files delivered in between
+    # are not missed
+    watcher = make_watcher(
+        input_dir, poll_interval=poll_interval, use_inotify=use_inotify
+    )
+    try:
+        yield from process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model=llm_model,
+            workdir_path=workdir_path,
+            sender_history=sender_history,
+            duplicate_detectors=duplicate_detectors,
+            llm_limiter=llm_limiter,
+            shard=shard,
+            token_accounting=token_accounting,
+            metrics=metrics,
+            tracer=tracer,
+        )
+        while stop_event is None or not stop_event.is_set():
+            if token_accounting.exhausted:
+                logger.warning("Token budget of the run exceeded, stop watching")
+                break
+            changes = collect_changes(
+                watcher,
+                debounce=debounce,
+                max_batch_size=max_batch_size,
+                max_delay=max_delay,
+                stop_event=stop_event,
+            )
+            if not changes:
+                continue
+            logger.info("Process %s changed files in input dir", len(changes))
+            yield from process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model=llm_model,
+                workdir_path=workdir_path,
+                filepaths=changes,
+                sender_history=sender_history,
+                duplicate_detectors=duplicate_detectors,
+                llm_limiter=llm_limiter,
+                shard=shard,
+                token_accounting=token_accounting,
+                metrics=metrics,
+                tracer=tracer,
+            )
+    finally:
+        watcher.close()
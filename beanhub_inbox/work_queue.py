@@ -0,0 +1,488 @@
+import dataclasses
+import enum
+import logging
+import os
+import pathlib
+import queue as queue_module
+import socket
+import sqlite3
+import threading
+import time
+import typing
+
+from .concurrency import AdaptiveLimiter
+from .data_types import ExtractImportAction
+from .data_types import InboxDoc
+from .dedup import DuplicateDetector
+from .journal import ExtractJournal
+from .metrics import PipelineMetrics
+from .pre_classify import SenderHistory
+from .processor import process_imports
+from .processor import ProcessImportEvent
+from .processor import resolve_workdir_path
+from .processor import walk_dir_files
+from .template_cache import TemplateCache
+from .token_usage import TokenAccounting
+from .tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+
+@enum.unique
+class WorkItemState(str, enum.Enum):
+    pending = "pending"
+    leased = "leased"
+    done = "done"
+    failed = "failed"
+
+
+@dataclasses.dataclass(frozen=True)
+class QueueProgress:
+    pending: int
+    leased: int
+    # leased items whose worker did not report back in time, to be reclaimed
+    expired: int
+    done: int
+    failed: int
+
+    @property
+    def total(self) -> int:
+        return self.pending + self.leased + self.done + self.failed
+
+    @property
+    def finished(self) -> bool:
+        return self.pending == 0 and self.leased == 0
+
+
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    # Email files to process stored in a SQLite database, workers claim them with
+    # leases expiring after lease_duration seconds, so that items claimed by a dead
+    # worker are picked up by others
+    def __init__(
+        self,
+        database: pathlib.Path,
+        lease_duration: float = 300.0,
+        max_attempts: int = 3,
+        worker_id: str | None = None,
+        timeout: float = 30.0,
+        clock: typing.Callable[[], float] = time.time,
+    ):
+        self.database = database
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id if worker_id is not None else make_worker_id()
+        self.clock = clock
+        database.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(database, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "filepath TEXT PRIMARY KEY NOT NULL, "
+            "state TEXT NOT NULL, "
+            "worker_id TEXT, "
+            "lease_expires_at REAL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "error TEXT"
+            ")"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires_at)"
+        )
+
+    def enqueue(self, filepaths: typing.Iterable[str]) -> int:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = self.conn.executemany(
+                "INSERT OR IGNORE INTO items (filepath, state) VALUES (?, ?)",
+                ((filepath, WorkItemState.pending.value) for filepath in filepaths),
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount
+
+    def claim(self, limit: int = 1) -> list[str]:
+        now = self.clock()
+        # BEGIN IMMEDIATE takes the write lock, so that no other worker could claim
+        # the same items in between
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            filepaths = [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT filepath FROM items "
+                    "WHERE state = ? OR (state = ? AND lease_expires_at < ?) "
+                    "ORDER BY filepath LIMIT ?",
+                    (
+                        WorkItemState.pending.value,
+                        WorkItemState.leased.value,
+                        now,
+                        limit,
+                    ),
+                )
+            ]
+            self.conn.executemany(
+                "UPDATE items SET state = ?, worker_id = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1 WHERE filepath = ?",
+                (
+                    (
+                        WorkItemState.leased.value,
+                        self.worker_id,
+                        now + self.lease_duration,
+                        filepath,
+                    )
+                    for filepath in filepaths
+                ),
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return filepaths
+
+    def _update_leased(self, filepath: str, sql: str, params: tuple) -> bool:
+        # Only the worker holding the lease can update the item, returns False if the
+        # lease has been taken by another worker after expiring
+        cursor = self.conn.execute(
+            f"UPDATE items SET {sql} WHERE filepath = ? AND state = ? AND worker_id = ?",
+            (*params, filepath, WorkItemState.leased.value, self.worker_id),
+        )
+        return cursor.rowcount > 0
+
+    def renew(self, filepath: str) -> bool:
+        return self._update_leased(
+            filepath,
+            "lease_expires_at = ?",
+            (self.clock() + self.lease_duration,),
+        )
+
+    def complete(self, filepath: str) -> bool:
+        return self._update_leased(
+            filepath,
+            "state = ?, lease_expires_at = NULL, error = NULL",
+            (WorkItemState.done.value,),
+        )
+
+    def release(self, filepath: str) -> bool:
+        # give the item back without counting it as an attempt
+        return self._update_leased(
+            filepath,
+            "state = ?, worker_id = NULL, lease_expires_at = NULL, "
+            "attempts = attempts - 1",
+            (WorkItemState.pending.value,),
+        )
+
+    def fail(self, filepath: str, error: str) -> bool:
+        # retry the item later until it fails for max_attempts times
+        return self._update_leased(
+            filepath,
+            "state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+            "lease_expires_at = NULL, error = ?",
+            (
+                self.max_attempts,
+                WorkItemState.failed.value,
+                WorkItemState.pending.value,
+                error,
+            ),
+        )
+
+    def progress(self) -> QueueProgress:
+        counts = {state: 0 for state in WorkItemState}
+        for state, count in self.conn.execute(
+            "SELECT state, COUNT(*) FROM items GROUP BY state"
+        ):
+            counts[WorkItemState(state)] = count
+        (expired,) = self.conn.execute(
+            "SELECT COUNT(*) FROM items WHERE state = ? AND lease_expires_at < ?",
+            (WorkItemState.leased.value, self.clock()),
+        ).fetchone()
+        return QueueProgress(
+            pending=counts[WorkItemState.pending],
+            leased=counts[WorkItemState.leased],
+            expired=expired,
+            done=counts[WorkItemState.done],
+            failed=counts[WorkItemState.failed],
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+def populate_queue(queue: WorkQueue, input_dir: pathlib.Path) -> int:
+    return queue.enqueue(
+        filepath.relative_to(input_dir).as_posix()
+        for filepath in sorted(walk_dir_files(input_dir))
+    )
+
+
+def find_journal_files(
+    inbox_doc: InboxDoc, workdir_path: pathlib.Path
+) -> list[pathlib.Path]:
+    return [
+        resolve_workdir_path(workdir_path, action.extract.journal)
+        for import_config in inbox_doc.imports
+        for action in import_config.actions
+        if isinstance(action, ExtractImportAction)
+        and action.extract.journal is not None
+    ]
+
+
+class ClaimedFilepaths:
+    # Feeds process_imports with email files claimed from the queue one at a time.
+    # Emails are processed in order, so the previous file is processed once the next
+    # one is requested. Processed files are only completed when process_imports
+    # reports their rows are written, as outputs could buffer rows in memory
+    def __init__(
+        self,
+        queue: WorkQueue,
+        input_dir: pathlib.Path,
+        poll_interval: float = 5.0,
+        stop_event: threading.Event | None = None,
+    ):
+        self.queue = queue
+        self.input_dir = input_dir
+        self.poll_interval = poll_interval
+        self.stop_event = stop_event
+        self.current: str | None = None
+        # processed files with rows possibly not written to the outputs yet
+        self.processed: list[str] = []
+        self.renewed_at: float | None = None
+        # all the items in the queue are finished or stop was requested
+        self.finished = False
+
+    def __iter__(self) -> "ClaimedFilepaths":
+        return self
+
+    def __next__(self) -> pathlib.Path:
+        if self.current is not None:
+            self.processed.append(self.current)
+            self.current = None
+        while self.stop_event is None or not self.stop_event.is_set():
+            filepaths = self.queue.claim()
+            if not filepaths:
+                if self.queue.progress().finished:
+                    break
+                if self.processed:
+                    # leases of the processed files keep the queue unfinished, stop
+                    # the run to write their rows before waiting for other workers
+                    raise StopIteration
+                # items leased by other workers might expire
+                time.sleep(self.poll_interval)
+                continue
+            (self.current,) = filepaths
+            self.renewed_at = self.queue.clock()
+            logger.info("Worker %s claimed %s", self.queue.worker_id, self.current)
+            return self.input_dir / self.current
+        self.finished = True
+        raise StopIteration
+
+    def renew(self):
+        # renew well before the lease expires, without writing to the database for
+        # every event
+        if self.renewed_at is None:
+            return
+        now = self.queue.clock()
+        if now - self.renewed_at < self.queue.lease_duration / 3:
+            return
+        filepaths = list(self.processed)
+        if self.current is not None:
+            filepaths.append(self.current)
+        for filepath in filepaths:
+            if not self.queue.renew(filepath):
+                logger.warning(
+                    "Lease of %s was taken by another worker, it may be processed again",
+                    filepath,
+                )
+        self.renewed_at = now
+
+    def complete_processed(self):
+        # called by process_imports between emails once the rows of the processed
+        # files are written, the current file is processed as well at that point
+        if self.current is not None:
+            self.processed.append(self.current)
+            self.current = None
+        for filepath in self.processed:
+            if not self.queue.complete(filepath):
+                logger.warning(
+                    "Lease of %s expired before finishing, it may be processed again",
+                    filepath,
+                )
+        self.processed = []
+
+    def fail(self, error: str):
+        self.queue.fail(self.current, error=error)
+        self.current = None
+
+    def release(self):
+        self.queue.release(self.current)
+        self.current = None
+
+
+def run_queue_worker(
+    queue: WorkQueue,
+    inbox_doc: InboxDoc,
+    input_dir: pathlib.Path,
+    llm_model: str,
+    workdir_path: pathlib.Path,
+    poll_interval: float = 5.0,
+    stop_event: threading.Event | None = None,
+    llm_limiter: AdaptiveLimiter | None = None,
+    token_accounting: TokenAccounting | None = None,
+    metrics: PipelineMetrics | None = None,
+    tracer: Tracer | None = None,
+    max_part_size: int | None = None,
+    template_caches: dict[pathlib.Path, TemplateCache] | None = None,
+) -> typing.Generator[ProcessImportEvent, None, None]:
+    # Keeps claiming and processing emails until all of them are finished. Claimed
+    # files are fed into one process_imports run, so that the outputs and caches are
+    # loaded once for each worker instead of each email. Output files are written
+    # with locks, so that many workers can share them
+    sender_history = SenderHistory()
+    duplicate_detectors: dict[pathlib.Path, DuplicateDetector] = {}
+    journals: dict[pathlib.Path, ExtractJournal] = {}
+    if template_caches is None:
+        template_caches = {}
+    if token_accounting is None:
+        token_accounting = TokenAccounting()
+    claimed = ClaimedFilepaths(
+        queue=queue,
+        input_dir=input_dir,
+        poll_interval=poll_interval,
+        stop_event=stop_event,
+    )
+    try:
+        while not token_accounting.exhausted:
+            try:
+                for event in process_imports(
+                    inbox_doc=inbox_doc,
+                    input_dir=input_dir,
+                    llm_model=llm_model,
+                    workdir_path=workdir_path,
+                    filepaths=claimed,
+                    sender_history=sender_history,
+                    duplicate_detectors=duplicate_detectors,
+                    llm_limiter=llm_limiter,
+                    token_accounting=token_accounting,
+                    metrics=metrics,
+                    tracer=tracer,
+                    journals=journals,
+                    lock_outputs=True,
+                    max_part_size=max_part_size,
+                    on_rows_written=claimed.complete_processed,
+                    template_caches=template_caches,
+                ):
+                    claimed.renew()
+                    yield event
+            except Exception as exc:
+                if claimed.current is None:
+                    raise
+                logger.exception("Failed to process %s", claimed.current)
+                claimed.fail(error=repr(exc))
+                # carry on with the following emails in a new run
+                continue
+            if claimed.finished:
+                break
+        if token_accounting.exhausted:
+            logger.warning(
+                "Token budget of worker %s exceeded, stop claiming", queue.worker_id
+            )
+            if claimed.current is not None:
+                # the email was not processed, leave it to other workers or the next
+                # run
+                claimed.release()
+    finally:
+        for journal in journals.values():
+            journal.close()
+        # other workers could still be extracting emails with the journals, only
+        # remove them once all the emails are done. The last worker might never open
+        # the journals, so find them from the config instead
+        if queue.progress().finished:
+            for journal_file in find_journal_files(inbox_doc, workdir_path):
+                journal_file.unlink(missing_ok=True)
+
+
+def run_queue_threads(
+    database: pathlib.Path,
+    threads: int,
+    inbox_doc: InboxDoc,
+    input_dir: pathlib.Path,
+    llm_model: str,
+    workdir_path: pathlib.Path,
+    lease_duration: float = 300.0,
+    max_attempts: int = 3,
+    poll_interval: float = 5.0,
+    llm_limiter: AdaptiveLimiter | None = None,
+    token_accounting: TokenAccounting | None = None,
+    metrics: PipelineMetrics | None = None,
+    tracer: Tracer | None = None,
+    max_part_size: int | None = None,
+) -> typing.Generator[ProcessImportEvent, None, None]:
+    # Runs queue workers in threads of this process, so that up to the given number
+    # of emails are extracted at the same time. Threads share the LLM limiter, which
+    # keeps the number of in-flight LLM requests at what the server can take. Events
+    # of all the threads are yielded in the order they arrive
+    if token_accounting is None:
+        token_accounting = TokenAccounting()
+    events: queue_module.Queue = queue_module.Queue()
+    stop_event = threading.Event()
+    # one cache for each file shared by all the threads, otherwise the thread saving
+    # last would drop the templates learned by the others
+    template_caches: dict[pathlib.Path, TemplateCache] = {}
+    done = object()
+
+    def run_thread(index: int):
+        worker_queue = WorkQueue(
+            database=database,
+            lease_duration=lease_duration,
+            max_attempts=max_attempts,
+            worker_id=f"{make_worker_id()}-{index}",
+        )
+        try:
+            for event in run_queue_worker(
+                queue=worker_queue,
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model=llm_model,
+                workdir_path=workdir_path,
+                poll_interval=poll_interval,
+                stop_event=stop_event,
+                llm_limiter=llm_limiter,
+                token_accounting=token_accounting,
+                metrics=metrics,
+                tracer=tracer,
+                max_part_size=max_part_size,
+                template_caches=template_caches,
+            ):
+                events.put(event)
+        except BaseException as exc:
+            events.put(exc)
+        finally:
+            worker_queue.close()
+            events.put(done)
+
+    worker_threads = [
+        threading.Thread(target=run_thread, args=(index,), name=f"queue-worker-{index}")
+        for index in range(threads)
+    ]
+    for thread in worker_threads:
+        thread.start()
+    try:
+        running = len(worker_threads)
+        while running:
+            item = events.get()
+            if item is done:
+                running -= 1
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # other threads stop after finishing their current emails
+        stop_event.set()
+        for thread in worker_threads:
+            thread.join()
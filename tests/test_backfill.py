@@ -0,0 +1,80 @@
+import pathlib
+
+import pytest
+
+from beanhub_inbox.backfill import CSVBackfill
+from beanhub_inbox.backfill import find_backfill_columns
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+
+COLUMNS = [
+    OutputColumn(name="valid", type=OutputColumnType.bool, description="valid"),
+    OutputColumn(
+        name="desc", type=OutputColumnType.str, description="desc", required=False
+    ),
+    OutputColumn(name="amount", type=OutputColumnType.decimal, description="amount"),
+]
+
+
+@pytest.mark.parametrize(
+    "row, expected",
+    [
+        (dict(id="a", valid="True", desc="", amount="12.34"), []),
+        (dict(id="a", valid="True", amount="12.34"), ["desc"]),
+        (dict(id="a", valid="True", desc=""), ["amount"]),
+        (dict(id="a", valid="True", desc="", amount=""), ["amount"]),
+        (dict(id="a", valid="False", desc=""), []),
+        (dict(id="a"), ["valid", "desc", "amount"]),
+    ],
+)
+def test_find_backfill_columns(row: dict, expected: list[str]):
+    assert [column.name for column in find_backfill_columns(COLUMNS, row)] == expected
+
+
+def test_csv_backfill(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text(
+        "id,valid,legacy\r\na,True,foo\r\nb,False,bar\r\nc,True,eggs\r\n"
+    )
+    backfill = CSVBackfill(
+        output_csv=output_csv, fieldnames=["id", "valid", "desc", "amount"]
+    )
+    assert backfill.find_row("b") == (3, dict(id="b", valid="False", legacy="bar"))
+    assert backfill.find_row("other") is None
+    assert backfill.dirty
+
+    backfill.update_row("a", dict(desc="Coffee"))
+    backfill.update_row("a", dict(amount="1.23"))
+    backfill.add_row(dict(id="d", valid=False))
+    backfill.flush()
+    assert output_csv.read_text() == (
+        "id,valid,desc,amount,legacy\n"
+        "a,True,Coffee,1.23,foo\n"
+        "b,False,,,bar\n"
+        "c,True,,,eggs\n"
+        "d,False,,,\n"
+    )
+    assert not backfill.dirty
+    assert not list(tmp_path.glob(".*.backfill"))
+
+
+def test_csv_backfill_new_file(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "sub" / "output.csv"
+    backfill = CSVBackfill(output_csv=output_csv, fieldnames=["id", "valid"])
+    assert not backfill.dirty
+    backfill.flush()
+    assert not output_csv.exists()
+    backfill.add_row(dict(id="a", valid=True))
+    backfill.flush()
+    assert output_csv.read_text() == "id,valid\na,True\n"
+
+
+def test_csv_backfill_empty_file(tmp_path: pathlib.Path):
+    # created by another worker which has not written the header yet
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text("")
+    backfill = CSVBackfill(output_csv=output_csv, fieldnames=["id", "valid"])
+    assert backfill.find_row("a") is None
+    backfill.add_row(dict(id="a", valid=True))
+    backfill.flush()
+    assert output_csv.read_text() == "id,valid\na,True\n"
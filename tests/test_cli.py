@@ -0,0 +1,184 @@
+import pathlib
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import MockEmailFactory
+from beanhub_inbox.cli import main
+from beanhub_inbox.event_log import read_events
+
+
+@pytest.fixture
+def inbox_dir(tmp_path: pathlib.Path) -> pathlib.Path:
+    emails_dir = tmp_path / "emails"
+    emails_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (emails_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    (tmp_path / "inbox.yaml").write_text(
+        "\n".join(
+            [
+                "inputs:",
+                '  - match: "*.eml"',
+                "imports:",
+                "  - actions:",
+                "      - extract:",
+                '          output_csv: "output.csv"',
+            ]
+        )
+    )
+    return tmp_path
+
+
+def test_import(
+    mocker: MockerFixture,
+    capsys: pytest.CaptureFixture,
+    inbox_dir: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    assert (
+        main(
+            [
+                "import",
+                "-c",
+                str(inbox_dir / "inbox.yaml"),
+                "-i",
+                str(inbox_dir / "emails"),
+                "-w",
+                str(inbox_dir),
+                "-m",
+                "deepcoder",
+                "--event-log",
+                str(inbox_dir / "events.jsonl"),
+                "--trace-file",
+                str(inbox_dir / "spans.jsonl"),
+                "--metrics-textfile",
+                str(inbox_dir / "beanhub_inbox.prom"),
+            ]
+        )
+        == 0
+    )
+    assert "Processed 2 emails, 2 matched, 2 rows extracted" in capsys.readouterr().out
+    assert len((inbox_dir / "output.csv").read_text().splitlines()) == 3
+    assert list(read_events(inbox_dir / "events.jsonl"))
+    assert (inbox_dir / "spans.jsonl").read_text()
+    assert (
+        "beanhub_inbox_emails_total 2.0"
+        in (inbox_dir / "beanhub_inbox.prom").read_text()
+    )
+
+
+def test_import_threads(
+    mocker: MockerFixture,
+    capsys: pytest.CaptureFixture,
+    inbox_dir: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    args = [
+        "import",
+        "-c",
+        str(inbox_dir / "inbox.yaml"),
+        "-i",
+        str(inbox_dir / "emails"),
+        "-w",
+        str(inbox_dir),
+        "-m",
+        "deepcoder",
+        "--threads",
+        "2",
+    ]
+    assert main(args) == 0
+    assert "Processed 2 emails, 2 matched, 2 rows extracted" in capsys.readouterr().out
+    assert len((inbox_dir / "output.csv").read_text().splitlines()) == 3
+    with pytest.raises(SystemExit):
+        main(args + ["--parse-workers", "2"])
+
+
+def test_bench(capsys: pytest.CaptureFixture, inbox_dir: pathlib.Path):
+    assert (
+        main(
+            [
+                "bench",
+                "-c",
+                str(inbox_dir / "inbox.yaml"),
+                "-i",
+                str(inbox_dir / "emails"),
+                "-n",
+                "2",
+            ]
+        )
+        == 0
+    )
+    output = capsys.readouterr().out
+    assert "Run 1: 2 emails, 2 matched, 2 rows extracted" in output
+    assert "Run 2: 2 emails, 2 matched, 2 rows extracted" in output
+    assert "\nwrite\t4\t" in output
+    # outputs are written to temporary folders
+    assert not (inbox_dir / "output.csv").exists()
+
+
+@pytest.mark.parametrize("profiler", ["cprofile", "sampling"])
+def test_profile(capsys: pytest.CaptureFixture, inbox_dir: pathlib.Path, profiler: str):
+    output_dir = inbox_dir / "profile"
+    assert (
+        main(
+            [
+                "profile",
+                "-c",
+                str(inbox_dir / "inbox.yaml"),
+                "-i",
+                str(inbox_dir / "emails"),
+                "-o",
+                str(output_dir),
+                "--profiler",
+                profiler,
+                "--interval",
+                "0.001",
+            ]
+        )
+        == 0
+    )
+    assert "Processed 2 emails" in capsys.readouterr().out
+    assert (output_dir / "profile.txt").exists()
+    assert (output_dir / "profile.prof").exists() == (profiler == "cprofile")
+    if profiler == "cprofile":
+        lines = (output_dir / "profile.collapsed").read_text().splitlines()
+        assert any("process_imports" in line for line in lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+
+
+@pytest.mark.parametrize("budget, expected", [(60_000.0, 0), (0.001, 1)])
+def test_import_time(capsys: pytest.CaptureFixture, budget: float, expected: int):
+    assert (
+        main(
+            [
+                "import-time",
+                "--module",
+                "beanhub_inbox.llm",
+                "-n",
+                "1",
+                "--budget",
+                str(budget),
+            ]
+        )
+        == expected
+    )
+    output = capsys.readouterr().out
+    assert "Imported beanhub_inbox.llm in " in output
+    assert ("exceeds the budget" in output) == bool(expected)
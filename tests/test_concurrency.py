@@ -0,0 +1,140 @@
+import threading
+
+import pytest
+
+from beanhub_inbox.concurrency import AdaptiveLimiter
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(min_limit=0),
+        dict(initial_limit=4, max_limit=2),
+        dict(min_limit=2, initial_limit=1),
+    ],
+)
+def test_adaptive_limiter_invalid(kwargs: dict):
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(**kwargs)
+
+
+def test_adaptive_limiter_increase():
+    clock = MockClock()
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=3, clock=clock)
+    limits = []
+    for _ in range(8):
+        slots = [limiter.slot() for _ in range(limiter.limit)]
+        for slot in slots:
+            slot.__enter__()
+        assert limiter.in_flight == limiter.limit
+        clock.now += 1
+        for slot in slots:
+            slot.__exit__(None, None, None)
+        limits.append(limiter.limit)
+    assert limits == [2, 2, 2, 3, 3, 3, 3, 3]
+    assert limiter.last_sample.time_to_first_token == 1
+    assert limiter.last_sample.queue_latency == 0
+
+
+def test_adaptive_limiter_not_saturated():
+    clock = MockClock()
+    limiter = AdaptiveLimiter(initial_limit=2, clock=clock)
+    for _ in range(10):
+        with limiter.slot():
+            clock.now += 1
+    # never reached the limit, so there is no evidence a higher limit helps
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_decrease():
+    clock = MockClock()
+    limiter = AdaptiveLimiter(initial_limit=8, clock=clock)
+    with limiter.slot() as slot:
+        clock.now += 1
+        slot.first_token()
+        # long response after the first token doesn't matter
+        clock.now += 10
+    assert limiter.limit == 8
+    with limiter.slot():
+        clock.now += 5
+    assert limiter.limit == 6
+    with pytest.raises(RuntimeError):
+        with limiter.slot():
+            raise RuntimeError("timeout")
+    assert limiter.limit == 4
+    assert limiter.last_sample.time_to_first_token is None
+    for _ in range(10):
+        with pytest.raises(RuntimeError):
+            with limiter.slot():
+                raise RuntimeError("timeout")
+    assert limiter.limit == 1
+    assert limiter.in_flight == 0
+
+
+def test_adaptive_limiter_varying_latency():
+    clock = MockClock()
+    limiter = AdaptiveLimiter(initial_limit=1, max_limit=4, clock=clock)
+    # a short prompt served fast
+    with limiter.slot():
+        clock.now += 0.1
+    limits = []
+    for index in range(60):
+        slots = [limiter.slot() for _ in range(limiter.limit)]
+        for slot in slots:
+            slot.__enter__()
+        # time to first token of longer prompts varies with their size, but the
+        # server is not congested
+        clock.now += [1.0, 1.6, 1.2, 1.8][index % 4]
+        for slot in slots:
+            slot.__exit__(None, None, None)
+        limits.append(limiter.limit)
+    assert limits[-1] == 4
+
+    # all the requests are queued by the server
+    with limiter.slot():
+        clock.now += 10
+    assert limiter.limit == 3
+
+
+def test_adaptive_limiter_interrupted():
+    limiter = AdaptiveLimiter(initial_limit=2)
+
+    def generate():
+        with limiter.slot():
+            yield 1
+            yield 2
+
+    generator = generate()
+    next(generator)
+    assert limiter.in_flight == 1
+    generator.close()
+    assert limiter.in_flight == 0
+    assert limiter.limit == 2
+
+
+def test_adaptive_limiter_blocking():
+    limiter = AdaptiveLimiter(initial_limit=1)
+    entered = threading.Event()
+    slot = limiter.slot()
+    slot.__enter__()
+
+    def run():
+        with limiter.slot():
+            entered.set()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert not entered.wait(0.1)
+    slot.__exit__(None, None, None)
+    assert entered.wait(5)
+    thread.join()
+    assert limiter.last_sample is not None
+    assert limiter.in_flight == 0
@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from beanhub_inbox.deadline import Deadline
+from beanhub_inbox.deadline import DeadlineExceeded
+from beanhub_inbox.deadline import LatencyTracker
+from beanhub_inbox.deadline import stream_with_deadline
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_deadline():
+    clock = MockClock()
+    deadline = Deadline(10, clock=clock)
+    assert deadline.remaining() == 10
+    assert not deadline.expired
+    clock.now = 11
+    assert deadline.remaining() == 0
+    assert deadline.expired
+    unlimited = Deadline(None, clock=clock)
+    assert unlimited.remaining() is None
+    assert not unlimited.expired
+
+
+def test_deadline_earliest():
+    clock = MockClock()
+    first = Deadline(5, clock=clock)
+    second = Deadline(10, clock=clock)
+    assert Deadline.earliest(second, None, first) is first
+    assert Deadline.earliest(Deadline(None, clock=clock), None) is None
+
+
+@pytest.mark.parametrize(
+    "samples, percentile, expected",
+    [
+        ([], 0.95, None),
+        ([1.0] * 4, 0.95, None),
+        (list(range(1, 101)), 0.95, 95),
+        (list(range(1, 101)), 0.5, 50),
+        (list(range(100, 0, -1)), 0.99, 99),
+    ],
+)
+def test_latency_tracker(
+    samples: list[float], percentile: float, expected: float | None
+):
+    tracker = LatencyTracker(percentile=percentile, min_samples=5)
+    for sample in samples:
+        tracker.record(sample)
+    assert tracker.threshold() == expected
+
+
+def make_stream(items: list, blocker: threading.Event | None = None):
+    def factory():
+        if blocker is not None:
+            blocker.wait(5)
+        yield from items
+
+    return factory
+
+
+def test_stream_with_deadline():
+    assert list(stream_with_deadline([make_stream([1, 2, 3])])) == [1, 2, 3]
+    assert list(stream_with_deadline([make_stream([1, 2])], deadline=Deadline(5))) == [
+        1,
+        2,
+    ]
+
+
+def test_stream_with_deadline_exceeded():
+    blocker = threading.Event()
+    started_at = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        list(
+            stream_with_deadline(
+                [make_stream([1], blocker=blocker)], deadline=Deadline(0.1)
+            )
+        )
+    assert time.monotonic() - started_at < 2
+    blocker.set()
+
+
+def test_stream_with_deadline_hedge():
+    blocker = threading.Event()
+    assert list(
+        stream_with_deadline(
+            [make_stream([1, 2], blocker=blocker), make_stream(["a", "b"])],
+            hedge_after=0.05,
+        )
+    ) == ["a", "b"]
+    blocker.set()
+    # hedged request is not sent when the first one is fast
+    calls = []
+
+    def hedge_factory():
+        calls.append(True)
+        return ["a"]
+
+    assert list(
+        stream_with_deadline([make_stream([1, 2]), hedge_factory], hedge_after=5)
+    ) == [1, 2]
+    assert calls == []
+
+
+def test_stream_with_deadline_failover():
+    def failing_factory():
+        raise ConnectionError("boom")
+
+    assert list(
+        stream_with_deadline([failing_factory, make_stream([1])], hedge_after=5)
+    ) == [1]
+    with pytest.raises(ConnectionError):
+        list(stream_with_deadline([failing_factory]))
@@ -0,0 +1,171 @@
+import pathlib
+
+import pytest
+
+from beanhub_inbox.dedup import body_hash
+from beanhub_inbox.dedup import DuplicateDetector
+from beanhub_inbox.dedup import DuplicateMatch
+from beanhub_inbox.dedup import DuplicateSignal
+from beanhub_inbox.dedup import hamming_distance
+from beanhub_inbox.dedup import normalize_body_text
+from beanhub_inbox.dedup import simhash
+
+RECEIPT = """\
+Thanks for your order!
+Order number: 1234
+Total: $12.34
+Paid with Visa ending in 4242
+Questions? Contact support at support@shop.com
+We hope to see you again soon
+"""
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Hello   World\n\n  Foo ", "hello world\nfoo"),
+        ("> Hello\n>> World", "hello\nworld"),
+        ("", ""),
+    ],
+)
+def test_normalize_body_text(text: str, expected: str):
+    assert normalize_body_text(text) == expected
+
+
+def test_body_hash():
+    assert body_hash(RECEIPT) == body_hash(
+        "\n".join(f"> {line.upper()}" for line in RECEIPT.splitlines())
+    )
+    assert body_hash(RECEIPT) != body_hash(RECEIPT.replace("12.34", "56.78"))
+
+
+def test_simhash():
+    assert simhash(RECEIPT) == simhash(RECEIPT.upper())
+    near_duplicate = RECEIPT.replace("We hope", "Hope")
+    assert hamming_distance(simhash(RECEIPT), simhash(near_duplicate)) < 16
+    other = "Your weekly newsletter is here with lots of interesting articles to read"
+    assert hamming_distance(simhash(RECEIPT), simhash(other)) > 16
+
+
+@pytest.mark.parametrize(
+    "kwargs, emails, expected",
+    [
+        pytest.param(
+            dict(),
+            [("a", "<msg-a>", RECEIPT), ("b", "<msg-a>", "other content")],
+            [None, DuplicateMatch(signal=DuplicateSignal.message_id, email_id="a")],
+            id="message-id",
+        ),
+        pytest.param(
+            dict(message_id=False),
+            [("a", "<msg-a>", RECEIPT), ("b", "<msg-a>", "other content")],
+            [None, None],
+            id="message-id-disabled",
+        ),
+        pytest.param(
+            dict(),
+            [("a", "<msg-a>", RECEIPT), ("b", "<msg-b>", f"> {RECEIPT}")],
+            [None, DuplicateMatch(signal=DuplicateSignal.body_hash, email_id="a")],
+            id="body-hash",
+        ),
+        pytest.param(
+            dict(),
+            [("a", None, RECEIPT), ("a", None, RECEIPT)],
+            [None, None],
+            id="same-email",
+        ),
+        pytest.param(
+            dict(),
+            [
+                ("a", "<msg-a>", RECEIPT),
+                ("b", "<msg-b>", RECEIPT.replace("We hope", "Hope")),
+            ],
+            [None, None],
+            id="near-duplicate-disabled",
+        ),
+        pytest.param(
+            dict(simhash_distance=12),
+            [
+                ("a", "<msg-a>", RECEIPT),
+                ("b", "<msg-b>", "Totally different newsletter content here"),
+                ("c", "<msg-c>", RECEIPT.replace("We hope", "Hope")),
+            ],
+            [None, None, DuplicateMatch(signal=DuplicateSignal.simhash, email_id="a")],
+            id="near-duplicate",
+        ),
+    ],
+)
+def test_duplicate_detector(
+    kwargs: dict,
+    emails: list[tuple[str, str | None, str]],
+    expected: list[DuplicateMatch | None],
+):
+    detector = DuplicateDetector(**kwargs)
+    assert [
+        detector.check(email_id=email_id, message_id=message_id, text=text)
+        for email_id, message_id, text in emails
+    ] == expected
+
+
+def test_duplicate_detector_rows():
+    detector = DuplicateDetector()
+    assert detector.get_row("a") is None
+    detector.set_row("a", dict(valid=True))
+    assert detector.get_row("a") == dict(valid=True)
+
+
+def test_duplicate_detector_signatures_file(tmp_path: pathlib.Path):
+    signatures_file = tmp_path / "signatures.jsonl"
+    detector = DuplicateDetector(signatures_file=signatures_file)
+    assert detector.check(email_id="a", message_id="<a@mock>", text=RECEIPT) is None
+    assert detector.check(email_id="b", message_id=None, text="other") is None
+    detector.close()
+    with signatures_file.open("at") as fo:
+        fo.write('{"email_id": "c", "mess')
+
+    detector = DuplicateDetector(signatures_file=signatures_file)
+    assert detector.has_signature("a")
+    assert detector.has_signature("b")
+    assert not detector.has_signature("c")
+    assert detector.check(
+        email_id="d", message_id="<a@mock>", text="another"
+    ) == DuplicateMatch(signal=DuplicateSignal.message_id, email_id="a")
+    assert detector.check(email_id="e", message_id=None, text=RECEIPT) == (
+        DuplicateMatch(signal=DuplicateSignal.body_hash, email_id="a")
+    )
+    detector.close()
+
+    detector = DuplicateDetector(signatures_file=signatures_file)
+    # duplicates are not extracted again, but they are not the first seen email
+    assert detector.has_signature("e")
+    assert detector.check(email_id="f", message_id=None, text=RECEIPT) == (
+        DuplicateMatch(signal=DuplicateSignal.body_hash, email_id="a")
+    )
+    detector.close()
+
+    # signatures without the simhash need the text again
+    detector = DuplicateDetector(simhash_distance=3, signatures_file=signatures_file)
+    assert not detector.has_signature("a")
+
+
+def test_duplicate_detector_shared_signatures_file(tmp_path: pathlib.Path):
+    signatures_file = tmp_path / "signatures.jsonl"
+    # such as queue workers sharing the same output
+    detector0 = DuplicateDetector(signatures_file=signatures_file)
+    detector1 = DuplicateDetector(signatures_file=signatures_file)
+    assert detector0.check(email_id="a", message_id=None, text=RECEIPT) is None
+    assert detector1.has_signature("a")
+    assert detector1.check(email_id="b", message_id=None, text=RECEIPT) == (
+        DuplicateMatch(signal=DuplicateSignal.body_hash, email_id="a")
+    )
+    # a line being written by another worker is not read until it's finished
+    with signatures_file.open("at") as fo:
+        fo.write('{"email_id": "c", "message_id": "<c@mock>"')
+    assert not detector0.has_signature("c")
+    with signatures_file.open("at") as fo:
+        fo.write(', "body_hash": null, "simhash": null}\n')
+    assert detector0.check(
+        email_id="d", message_id="<c@mock>", text="other"
+    ) == DuplicateMatch(signal=DuplicateSignal.message_id, email_id="c")
+    detector0.close()
+    detector1.close()
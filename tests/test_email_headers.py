@@ -0,0 +1,54 @@
+import email.parser
+import email.policy
+import pickle
+
+from beanhub_inbox.email_headers import EmailHeaders
+from beanhub_inbox.utils import get_header
+
+RAW_EMAIL = b"""\
+Received: from a by b for inbox@example.com; Mon, 1 Jan 2024 00:00:00 +0000
+Received: from c by d for other@example.com; Mon, 1 Jan 2024 00:00:00 +0000
+From: Mock <mock@example.com>
+Subject: =?utf-8?q?Hello_world?=
+Message-ID: <mock@example.com>
+
+body
+"""
+
+
+def parse_headers() -> EmailHeaders:
+    msg = email.parser.BytesParser(policy=email.policy.EmailPolicy()).parsebytes(
+        RAW_EMAIL
+    )
+    return EmailHeaders.from_message(msg)
+
+
+def test_email_headers():
+    headers = parse_headers()
+    assert list(headers) == ["Received", "From", "Subject", "Message-ID"]
+    assert len(headers) == 4
+    assert "subject" in headers
+    assert "Cc" not in headers
+    assert headers["subject"] == "Hello world"
+    assert headers.get("Cc") is None
+    assert headers["Received"].startswith("from a by b")
+    assert len(headers.get_all("received")) == 2
+    assert headers.get_all("Cc") == []
+    assert get_header(headers, "message-id") == "<mock@example.com>"
+
+
+def test_email_headers_lazy():
+    headers = parse_headers()
+    assert headers._decoded == {}
+    assert headers["From"] == "Mock <mock@example.com>"
+    # only the accessed header is decoded
+    assert list(headers._decoded.keys()) == [2]
+
+
+def test_email_headers_pickle():
+    headers = parse_headers()
+    headers["Subject"]
+    loaded = pickle.loads(pickle.dumps(headers))
+    assert loaded._decoded == {}
+    assert dict(loaded) == dict(headers)
+    assert loaded.get_all("Received") == headers.get_all("Received")
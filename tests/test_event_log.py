@@ -0,0 +1,150 @@
+import pathlib
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import EmailFileFactory
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.deadline import DeadlineStage
+from beanhub_inbox.event_log import BINARY_MAGIC
+from beanhub_inbox.event_log import EventLogFormat
+from beanhub_inbox.event_log import EventSink
+from beanhub_inbox.event_log import read_events
+from beanhub_inbox.event_log import serialize_event
+from beanhub_inbox.event_log import tee_events
+from beanhub_inbox.llm import DEFAULT_COLUMNS
+from beanhub_inbox.llm import LLMCall
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.processor import LLMDeadlineExceeded
+from beanhub_inbox.processor import LLMTokenUsage
+from beanhub_inbox.processor import process_imports
+from beanhub_inbox.processor import StartProcessingEmail
+from beanhub_inbox.token_usage import TokenUsage
+
+
+def test_serialize_event():
+    email_file = EmailFileFactory(id="mock", subject="MOCK_SUBJECT")
+    assert serialize_event(StartProcessingEmail(email_file=email_file), 1.5) == dict(
+        type="StartProcessingEmail",
+        ts=1.5,
+        email_id="mock",
+        email_file=dict(
+            id="mock",
+            filepath=email_file.filepath,
+            subject="MOCK_SUBJECT",
+            from_addresses=email_file.from_addresses,
+            recipients=email_file.recipients,
+            tags=None,
+        ),
+    )
+    assert serialize_event(
+        LLMDeadlineExceeded(
+            email_file=email_file,
+            column=DEFAULT_COLUMNS[0],
+            stage=DeadlineStage.think,
+        ),
+        2.0,
+    ) == dict(
+        type="LLMDeadlineExceeded",
+        ts=2.0,
+        email_id="mock",
+        column="valid",
+        stage="think",
+    )
+    assert serialize_event(
+        LLMTokenUsage(
+            email_file=email_file,
+            column=DEFAULT_COLUMNS[0],
+            call=LLMCall.think,
+            usage=TokenUsage(prompt_tokens=10, completion_tokens=5),
+        ),
+        3.0,
+    ) == dict(
+        type="LLMTokenUsage",
+        ts=3.0,
+        email_id="mock",
+        column="valid",
+        call="think",
+        usage=dict(prompt_tokens=10, completion_tokens=5),
+    )
+
+
+@pytest.mark.parametrize("log_format", list(EventLogFormat))
+def test_event_sink(
+    mocker: MockerFixture, tmp_path: pathlib.Path, log_format: EventLogFormat
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    log_path = tmp_path / "logs" / f"events.{log_format.value}"
+    with EventSink(log_path, log_format=log_format) as sink:
+        events = list(
+            tee_events(
+                process_imports(
+                    inbox_doc=inbox_doc,
+                    input_dir=input_dir,
+                    llm_model="deepcoder",
+                    workdir_path=tmp_path,
+                ),
+                sink,
+            )
+        )
+    if log_format == EventLogFormat.binary:
+        assert log_path.read_bytes().startswith(BINARY_MAGIC)
+    records = list(read_events(log_path))
+    assert [(record["type"], record["email_id"]) for record in records] == [
+        (type(event).__name__, event.email_file.id) for event in events
+    ]
+    assert [
+        record["row"] for record in records if record["type"] == "FinishExtractingRow"
+    ] == [event.row for event in events if isinstance(event, FinishExtractingRow)]
+    timestamps = [record["ts"] for record in records]
+    assert timestamps == sorted(timestamps)
+
+    # appending to an existing log
+    with EventSink(log_path, log_format=log_format) as sink:
+        sink.write(events[0])
+    assert len(list(read_events(log_path))) == len(records) + 1
+
+
+def test_event_sink_closed(tmp_path: pathlib.Path):
+    sink = EventSink(tmp_path / "events.jsonl")
+    sink.close()
+    sink.close()
+    with pytest.raises(ValueError):
+        sink.write(StartProcessingEmail(email_file=EmailFileFactory()))
+
+
+def test_read_events_truncated(tmp_path: pathlib.Path):
+    log_path = tmp_path / "events.bin"
+    with EventSink(log_path, log_format=EventLogFormat.binary) as sink:
+        sink.write(StartProcessingEmail(email_file=EmailFileFactory()))
+    log_path.write_bytes(log_path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        list(read_events(log_path))
@@ -0,0 +1,58 @@
+import pathlib
+
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.journal import ExtractJournal
+from beanhub_inbox.journal import make_column_config_hash
+
+
+def test_make_column_config_hash():
+    column = OutputColumn(name="valid", type=OutputColumnType.bool, description="v")
+    config_hash = make_column_config_hash(
+        llm_model="deepcoder", template="prompt", column=column
+    )
+    assert config_hash == make_column_config_hash(
+        llm_model="deepcoder", template="prompt", column=column.model_copy()
+    )
+    assert config_hash != make_column_config_hash(
+        llm_model="other", template="prompt", column=column
+    )
+    assert config_hash != make_column_config_hash(
+        llm_model="deepcoder", template="other prompt", column=column
+    )
+    assert config_hash != make_column_config_hash(
+        llm_model="deepcoder",
+        template="prompt",
+        column=column.model_copy(update=dict(description="other")),
+    )
+
+
+def test_extract_journal(tmp_path: pathlib.Path):
+    journal_file = tmp_path / "journal" / "extract.jsonl"
+    journal = ExtractJournal(journal_file)
+    assert len(journal) == 0
+    assert journal.get("a", "valid", "hash") == (False, None)
+
+    journal.record("a", "valid", "hash", True)
+    journal.record("a", "amount", "hash", None)
+    assert journal.get("a", "valid", "hash") == (True, True)
+    assert journal.get("a", "amount", "hash") == (True, None)
+    assert journal.get("a", "valid", "other-hash") == (False, None)
+    journal.close()
+
+    # simulate crash in the middle of writing a line
+    with journal_file.open("at") as fo:
+        fo.write('{"email_id": "b", "col')
+
+    journal = ExtractJournal(journal_file)
+    assert len(journal) == 2
+    assert journal.get("a", "valid", "hash") == (True, True)
+    journal.record("b", "valid", "hash", False)
+    journal.close()
+
+    journal = ExtractJournal(journal_file)
+    assert len(journal) == 3
+    assert journal.get("b", "valid", "hash") == (True, False)
+    journal.remove()
+    assert not journal_file.exists()
+    assert len(journal) == 0
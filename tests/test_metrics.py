@@ -0,0 +1,228 @@
+import json
+import pathlib
+import re
+import threading
+import urllib.error
+import urllib.request
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.metrics import CONTENT_TYPE
+from beanhub_inbox.metrics import MetricsRegistry
+from beanhub_inbox.metrics import PipelineMetrics
+from beanhub_inbox.metrics import start_http_server
+from beanhub_inbox.metrics import start_textfile_writer
+from beanhub_inbox.metrics import write_textfile
+from beanhub_inbox.processor import process_imports
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    counter = registry.counter("mock_requests", "Number of requests", ["method"])
+    counter.inc(method="GET")
+    counter.inc(2, method='P"O\nST')
+    gauge = registry.gauge("mock_in_flight", "In-flight requests")
+    gauge.set(3)
+    histogram = registry.histogram(
+        "mock_latency_seconds", "Latency", ["stage"], buckets=[0.1, 1.0]
+    )
+    histogram.observe(0.05, stage="parse")
+    histogram.observe(0.5, stage="parse")
+    histogram.observe(5.0, stage="parse")
+    assert registry.render() == "\n".join(
+        [
+            "# HELP mock_requests_total Number of requests",
+            "# TYPE mock_requests_total counter",
+            'mock_requests_total{method="GET"} 1.0',
+            'mock_requests_total{method="P\\"O\\nST"} 2.0',
+            "# HELP mock_in_flight In-flight requests",
+            "# TYPE mock_in_flight gauge",
+            "mock_in_flight 3.0",
+            "# HELP mock_latency_seconds Latency",
+            "# TYPE mock_latency_seconds histogram",
+            'mock_latency_seconds_bucket{stage="parse",le="0.1"} 1',
+            'mock_latency_seconds_bucket{stage="parse",le="1.0"} 2',
+            'mock_latency_seconds_bucket{stage="parse",le="+Inf"} 3',
+            'mock_latency_seconds_sum{stage="parse"} 5.55',
+            'mock_latency_seconds_count{stage="parse"} 3',
+            "",
+        ]
+    )
+
+
+def test_registry_errors():
+    registry = MetricsRegistry()
+    counter = registry.counter("mock", "Mock", ["method"])
+    assert registry.counter("mock", "Mock", ["method"]) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("mock", "Mock", ["method"])
+    with pytest.raises(ValueError):
+        counter.inc(other="GET")
+    with pytest.raises(ValueError):
+        counter.inc(-1, method="GET")
+
+
+def test_pipeline_metrics(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="Let me think")
+        )
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```'),
+            prompt_eval_count=10,
+            eval_count=5,
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1", "other"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                name="mock",
+                match=dict(filepath="mock.*"),
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ],
+            )
+        ],
+    )
+    metrics = PipelineMetrics()
+
+    def run():
+        return list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+                metrics=metrics,
+            )
+        )
+
+    run()
+    assert metrics.emails.get() == 3
+    assert metrics.rule_matches.get(rule="mock") == 2
+    assert metrics.no_matches.get() == 1
+    assert metrics.rows.get(kind="row") == 2
+    assert metrics.llm_tokens.get(call="think", kind="prompt") == 20
+    assert metrics.llm_tokens.get(call="think", kind="completion") == 10
+    assert metrics.llm_time_to_first_token.get_count() == 2
+    assert metrics.stage_duration.get_count(stage="parse") == 3
+    assert metrics.stage_duration.get_count(stage="text") == 2
+    assert metrics.stage_duration.get_count(stage="think") == 2
+    assert metrics.stage_duration.get_count(stage="extract") == 0
+    assert metrics.stage_duration.get_count(stage="write") == 2
+
+    run()
+    assert metrics.emails.get() == 6
+    assert metrics.skipped_emails.get(reason="row_exists") == 2
+    assert metrics.stage_duration.get_count(stage="write") == 2
+    assert "beanhub_inbox_emails_total 6.0" in metrics.registry.render()
+
+
+def test_pipeline_metrics_backfill(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        key = re.search("with only one field `(.+?)`", messages[0].content).group(1)
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content=json.dumps({key: "12.34"}))
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    (tmp_path / "output.csv").write_text("id,valid\nmock0,True\n")
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            backfill=True,
+                            columns=[
+                                OutputColumn(
+                                    name="amount",
+                                    type=OutputColumnType.decimal,
+                                    description="amount",
+                                )
+                            ],
+                        )
+                    )
+                ],
+            )
+        ],
+    )
+    metrics = PipelineMetrics()
+    list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            metrics=metrics,
+        )
+    )
+    # each row is counted once as either kind
+    assert metrics.rows.get(kind="backfill") == 1
+    assert metrics.rows.get(kind="row") == 1
+
+
+def test_write_textfile(tmp_path: pathlib.Path):
+    registry = MetricsRegistry()
+    registry.counter("mock", "Mock").inc()
+    path = tmp_path / "textfile" / "beanhub_inbox.prom"
+    write_textfile(registry, path)
+    assert path.read_text() == registry.render()
+    assert list(path.parent.iterdir()) == [path]
+
+
+def test_start_textfile_writer(tmp_path: pathlib.Path):
+    registry = MetricsRegistry()
+    counter = registry.counter("mock", "Mock")
+    path = tmp_path / "beanhub_inbox.prom"
+    stop_event = threading.Event()
+    thread = start_textfile_writer(registry, path, interval=60.0, stop_event=stop_event)
+    counter.inc()
+    stop_event.set()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert "mock_total 1.0" in path.read_text()
+
+
+def test_start_http_server():
+    registry = MetricsRegistry()
+    registry.counter("mock", "Mock").inc()
+    server = start_http_server(registry, port=0)
+    try:
+        host, port = server.server_address[:2]
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics") as resp:
+            assert resp.headers["Content-Type"] == CONTENT_TYPE
+            assert resp.read().decode("utf8") == registry.render()
+        with pytest.raises(urllib.error.HTTPError) as exc_info:
+            urllib.request.urlopen(f"http://{host}:{port}/other")
+        assert exc_info.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,150 @@
+import email.parser
+import email.policy
+import pathlib
+import tracemalloc
+
+import pytest
+
+from .factories import EmailAttachment
+from .factories import MockEmailFactory
+from beanhub_inbox.mime_stream import find_header_end
+from beanhub_inbox.mime_stream import map_file
+from beanhub_inbox.mime_stream import strip_large_parts
+from beanhub_inbox.processor import build_email_file
+from beanhub_inbox.processor import extract_email_html
+from beanhub_inbox.processor import extract_email_text
+from beanhub_inbox.processor import parse_email_file
+
+PDF_CONTENT = b"%PDF-1.4\n" + bytes(range(256)) * 4096
+
+
+def make_email_bytes(attachments: list[EmailAttachment] | None = None) -> bytes:
+    return bytes(MockEmailFactory(attachments=attachments).make_msg())
+
+
+def parse(content: bytes) -> email.message.EmailMessage:
+    return email.parser.BytesParser(policy=email.policy.EmailPolicy()).parsebytes(
+        content
+    )
+
+
+def test_strip_large_parts():
+    content = make_email_bytes(
+        attachments=[
+            EmailAttachment(
+                content=PDF_CONTENT, mime_type="application/pdf", filename="a.pdf"
+            ),
+            EmailAttachment(
+                content=b"small", mime_type="application/pdf", filename="b.pdf"
+            ),
+        ]
+    )
+    stripped, skipped_parts = strip_large_parts(content, max_part_size=64 * 1024)
+    assert len(stripped) < 64 * 1024
+    assert [(part.content_type, part.filename) for part in skipped_parts] == [
+        ("application/pdf", "a.pdf")
+    ]
+    assert skipped_parts[0].size > len(PDF_CONTENT)
+
+    original_msg = parse(content)
+    stripped_msg = parse(stripped)
+    assert dict(stripped_msg) == dict(original_msg)
+    assert extract_email_html(stripped_msg) == extract_email_html(original_msg)
+    attachments = list(stripped_msg.iter_attachments())
+    assert [attachment.get_filename() for attachment in attachments] == [
+        "a.pdf",
+        "b.pdf",
+    ]
+    assert attachments[0].get_content() == b""
+    assert attachments[1].get_content() == b"small"
+
+
+def test_parse_email_file_max_part_size(tmp_path: pathlib.Path):
+    filepath = tmp_path / "mock.eml"
+    filepath.write_bytes(
+        make_email_bytes(
+            attachments=[
+                EmailAttachment(
+                    content=PDF_CONTENT * 4,
+                    mime_type="application/pdf",
+                    filename="a.pdf",
+                ),
+            ]
+        )
+    )
+    tracemalloc.start()
+    try:
+        parsed_email = parse_email_file(filepath, max_part_size=64 * 1024)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < len(PDF_CONTENT)
+    email_file = build_email_file(pathlib.Path("mock.eml"), parsed_email)
+    assert extract_email_text(email_file, parsed_email) == extract_email_text(
+        email_file, parse_email_file(filepath)
+    )
+
+
+@pytest.mark.parametrize(
+    "content, start, expected",
+    [
+        (b"A: 1\nB: 2\n\nbody\n", 0, 11),
+        (b"A: 1\r\nB: 2\r\n\r\nbody\r\n", 0, 14),
+        (b"A: 1\r\n\r\nbody\n\nmore", 0, 8),
+        (b"\nbody", 0, 1),
+        (b"--b\n\nbody", 4, 5),
+        (b"A: 1\nB: 2\n", 0, 10),
+        (b"", 0, 0),
+    ],
+)
+def test_find_header_end(content: bytes, start: int, expected: int):
+    assert find_header_end(content, start) == expected
+
+
+def test_map_file(tmp_path: pathlib.Path):
+    filepath = tmp_path / "mock.eml"
+    filepath.write_bytes(b"")
+    with map_file(filepath) as buffer:
+        assert buffer == b""
+    filepath.write_bytes(b"Subject: hi\n\nbody\n")
+    with map_file(filepath) as buffer:
+        assert buffer[: find_header_end(buffer)] == b"Subject: hi\n\n"
+
+
+def test_strip_large_parts_crlf(tmp_path: pathlib.Path):
+    content = make_email_bytes(
+        attachments=[
+            EmailAttachment(
+                content=PDF_CONTENT, mime_type="application/pdf", filename="a.pdf"
+            ),
+        ]
+    ).replace(b"\n", b"\r\n")
+    filepath = tmp_path / "mock.eml"
+    filepath.write_bytes(content)
+    with map_file(filepath) as buffer:
+        stripped, skipped_parts = strip_large_parts(buffer, max_part_size=1024)
+    assert [part.filename for part in skipped_parts] == ["a.pdf"]
+    original_msg = parse(content)
+    stripped_msg = parse(stripped)
+    assert extract_email_html(stripped_msg) == extract_email_html(original_msg)
+
+
+def test_parse_email_file_headers_only(tmp_path: pathlib.Path):
+    filepath = tmp_path / "mock.eml"
+    filepath.write_bytes(
+        make_email_bytes(
+            attachments=[
+                EmailAttachment(
+                    content=PDF_CONTENT, mime_type="application/pdf", filename="a.pdf"
+                ),
+            ]
+        )
+    )
+    tracemalloc.start()
+    try:
+        parsed_email = parse_email_file(filepath, headers_only=True)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert peak < len(PDF_CONTENT)
+    assert dict(parsed_email) == dict(parse_email_file(filepath))
@@ -0,0 +1,141 @@
+import datetime
+import decimal
+import pathlib
+import typing
+
+import pytest
+
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.llm import DEFAULT_COLUMNS
+
+pyarrow = pytest.importorskip("pyarrow")
+pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+
+from beanhub_inbox.parquet_output import ParquetOutput  # noqa: E402
+from beanhub_inbox.parquet_output import to_arrow_value  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "column_type, value, expected",
+    [
+        (OutputColumnType.str, "foo", "foo"),
+        (OutputColumnType.str, "", None),
+        (OutputColumnType.str, None, None),
+        (OutputColumnType.int, "12", 12),
+        (OutputColumnType.int, 12, 12),
+        (OutputColumnType.decimal, "12.34", decimal.Decimal("12.34")),
+        (OutputColumnType.bool, "False", False),
+        (OutputColumnType.bool, True, True),
+        (OutputColumnType.date, "2025-04-01", datetime.date(2025, 4, 1)),
+        (
+            OutputColumnType.datetime,
+            "2025-04-01T12:34:56",
+            datetime.datetime(2025, 4, 1, 12, 34, 56, tzinfo=datetime.timezone.utc),
+        ),
+    ],
+)
+def test_to_arrow_value(
+    column_type: OutputColumnType, value: typing.Any, expected: typing.Any
+):
+    assert to_arrow_value(column_type, value) == expected
+
+
+def test_parquet_output(tmp_path: pathlib.Path):
+    path = tmp_path / "output"
+    output = ParquetOutput(path=path, columns=DEFAULT_COLUMNS, row_group_size=2)
+    assert not output.has_row("mock0")
+    output.add_row(
+        dict(
+            id="mock0",
+            valid=True,
+            desc="Coffee",
+            amount="12.34",
+            txn_date="2025-04-01",
+        )
+    )
+    output.add_row(dict(id="mock1", valid="False"))
+    output.add_row(dict(id="mock1", valid="True"))
+    output.add_row(dict(id="mock2", valid=False))
+    assert output.has_row("mock2")
+    # part file only shows up after closing
+    assert list(path.glob("*.parquet")) == []
+    output.close()
+
+    (part_file,) = path.glob("*.parquet")
+    parquet_file = pyarrow_parquet.ParquetFile(part_file)
+    assert parquet_file.metadata.num_row_groups == 2
+    table = parquet_file.read()
+    assert table.schema.field("valid").type == pyarrow.bool_()
+    assert table.schema.field("amount").type == pyarrow.decimal128(38, 10)
+    assert table.schema.field("txn_date").type == pyarrow.date32()
+    assert table.to_pylist() == [
+        dict(
+            id="mock0",
+            valid=True,
+            desc="Coffee",
+            merchant=None,
+            amount=decimal.Decimal("12.34"),
+            tax=None,
+            txn_id=None,
+            txn_date=datetime.date(2025, 4, 1),
+        ),
+        dict(
+            id="mock1",
+            valid=False,
+            desc=None,
+            merchant=None,
+            amount=None,
+            tax=None,
+            txn_id=None,
+            txn_date=None,
+        ),
+        dict(
+            id="mock2",
+            valid=False,
+            desc=None,
+            merchant=None,
+            amount=None,
+            tax=None,
+            txn_id=None,
+            txn_date=None,
+        ),
+    ]
+
+    columns = [
+        OutputColumn(name="valid", type=OutputColumnType.bool, description="Valid")
+    ]
+    output = ParquetOutput(path=path, columns=columns)
+    assert output.ids == {"mock0", "mock1", "mock2"}
+    output.add_row(dict(id="mock0", valid=False))
+    output.add_row(dict(id="mock3", valid=True))
+    output.close()
+    assert len(list(path.glob("*.parquet"))) == 2
+    output = ParquetOutput(path=path, columns=columns)
+    assert output.ids == {"mock0", "mock1", "mock2", "mock3"}
+    output.close()
+    assert len(list(path.glob("*.parquet"))) == 2
+
+
+def test_parquet_output_invalid_values(
+    tmp_path: pathlib.Path, caplog: pytest.LogCaptureFixture
+):
+    path = tmp_path / "output"
+    output = ParquetOutput(path=path, columns=DEFAULT_COLUMNS)
+    output.add_row(
+        dict(
+            id="mock0",
+            valid=True,
+            amount="$12.34",
+            tax="1" * 40,
+            txn_date="Apr 1",
+        )
+    )
+    output.close()
+    (part_file,) = path.glob("*.parquet")
+    (row,) = pyarrow_parquet.read_table(part_file).to_pylist()
+    assert row["valid"] is True
+    assert row["amount"] is None
+    assert row["tax"] is None
+    assert row["txn_date"] is None
+    assert "Invalid decimal value '$12.34' of column amount" in caplog.text
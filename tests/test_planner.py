@@ -0,0 +1,261 @@
+import json
+import pathlib
+import re
+import sqlite3
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.data_types import SQLiteOutputConfig
+from beanhub_inbox.llm import DEFAULT_COLUMNS
+from beanhub_inbox.planner import estimate_tokens
+from beanhub_inbox.planner import format_plan
+from beanhub_inbox.planner import ImportPlan
+from beanhub_inbox.planner import ImportRulePlan
+from beanhub_inbox.planner import plan_imports
+from beanhub_inbox.planner import read_sqlite_rows
+from beanhub_inbox.processor import BackfillColumns
+from beanhub_inbox.processor import CSVRowExists
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.processor import process_imports
+from beanhub_inbox.sharding import Shard
+
+
+@pytest.mark.parametrize(
+    "text, chars_per_token, expected",
+    [
+        ("", 4.0, 0),
+        ("abcd", 4.0, 1),
+        ("abcde", 4.0, 2),
+        ("abcde", 2.5, 2),
+    ],
+)
+def test_estimate_tokens(text: str, chars_per_token: float, expected: int):
+    assert estimate_tokens(text, chars_per_token=chars_per_token) == expected
+
+
+def test_plan_imports(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1", "mock2"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    (input_dir / "other.txt").write_text("other")
+    (tmp_path / "output.csv").write_text(
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\nmock0,False,,,,,,\n"
+    )
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                name="receipts",
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ],
+            )
+        ],
+    )
+    plan = plan_imports(
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        workdir_path=tmp_path,
+        think_tokens=100,
+    )
+    mock_chat.assert_not_called()
+    assert plan.files == 4
+    assert plan.matched_files == 3
+    assert plan.no_match == 0
+    rule_plan = plan.rules[0]
+    assert rule_plan.name == "receipts"
+    assert rule_plan.emails == 3
+    assert rule_plan.existing == 1
+    assert rule_plan.extract == 2
+    assert rule_plan.llm_columns == 2 * len(DEFAULT_COLUMNS)
+    assert rule_plan.completion_tokens == 100 * 2 * len(DEFAULT_COLUMNS)
+    assert rule_plan.prompt_tokens > 0
+    assert plan.extract == 2
+    assert plan.existing == 1
+    # planning never writes outputs
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\nmock0,False,,,,,,\n"
+    )
+    summary = format_plan(plan)
+    assert "Emails to extract: 2 (1 exist in outputs already)" in summary
+    assert "receipts\t3\t0\t1\t0\t2\t0\t0\t14\t" in summary
+
+
+def test_plan_imports_backfill_sqlite(tmp_path: pathlib.Path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    conn = sqlite3.connect(tmp_path / "output.sqlite")
+    conn.execute("CREATE TABLE rows (id TEXT PRIMARY KEY, valid TEXT)")
+    conn.execute("INSERT INTO rows VALUES ('mock0', 'True')")
+    conn.commit()
+    conn.close()
+    columns = [
+        OutputColumn(name="valid", type=OutputColumnType.bool, description="valid"),
+        OutputColumn(name="amount", type=OutputColumnType.decimal, description="amt"),
+    ]
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            output_sqlite=SQLiteOutputConfig(
+                                database="output.sqlite", table="rows"
+                            ),
+                            columns=columns,
+                            backfill=True,
+                        )
+                    )
+                ],
+            )
+        ],
+    )
+    plan = plan_imports(
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        workdir_path=tmp_path,
+        think_tokens=10,
+    )
+    rule_plan = plan.rules[0]
+    assert rule_plan.backfill == 1
+    assert rule_plan.extract == 1
+    # the missing amount column of mock0 and both columns of mock1
+    assert rule_plan.llm_columns == 3
+    assert read_sqlite_rows(tmp_path / "output.sqlite", "rows") == {
+        "mock0": dict(id="mock0", valid="True")
+    }
+
+
+def test_plan_imports_shard_backfill(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    values = dict(valid=True, amount="1.23")
+
+    def chat_side_effect(messages, **kwargs):
+        key = re.search("with only one field `(.+?)`", messages[0].content).group(1)
+        yield ollama.ChatResponse(
+            message=ollama.Message(
+                role="assistant", content=json.dumps({key: values[key]})
+            )
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1", "mock2"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    # rows merged from the shards by previous runs
+    (tmp_path / "output.csv").write_text("id,valid\nmock0,True\nmock1,False\n")
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            columns=[
+                                OutputColumn(
+                                    name="valid",
+                                    type=OutputColumnType.bool,
+                                    description="valid",
+                                ),
+                                OutputColumn(
+                                    name="amount",
+                                    type=OutputColumnType.decimal,
+                                    description="amount",
+                                ),
+                            ],
+                            backfill=True,
+                        )
+                    )
+                ],
+            )
+        ],
+    )
+    shards = [Shard(index=index, count=2) for index in range(2)]
+    rule_plans = [
+        plan_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            workdir_path=tmp_path,
+            shard=shard,
+        ).rules[0]
+        for shard in shards
+    ]
+    assert sum(rule_plan.existing for rule_plan in rule_plans) == 1
+    assert sum(rule_plan.backfill for rule_plan in rule_plans) == 1
+    assert sum(rule_plan.extract for rule_plan in rule_plans) == 1
+
+    # the processor does the same as planned
+    events = [
+        event
+        for shard in shards
+        for event in process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            shard=shard,
+        )
+    ]
+    assert [
+        event.email_file.id for event in events if isinstance(event, CSVRowExists)
+    ] == ["mock1"]
+    assert [
+        event.email_file.id for event in events if isinstance(event, BackfillColumns)
+    ] == ["mock0"]
+    # backfilled rows are finished as well
+    assert [
+        event.email_file.id
+        for event in events
+        if isinstance(event, FinishExtractingRow)
+    ] == ["mock0", "mock2"]
+
+
+def test_read_sqlite_rows_missing(tmp_path: pathlib.Path):
+    assert read_sqlite_rows(tmp_path / "missing.sqlite", "rows") == {}
+    sqlite3.connect(tmp_path / "empty.sqlite").close()
+    assert read_sqlite_rows(tmp_path / "empty.sqlite", "rows") == {}
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_import_plan_estimate_seconds():
+    plan = ImportPlan(
+        rules={
+            0: ImportRulePlan(
+                import_rule_index=0,
+                name=None,
+                prompt_tokens=1000,
+                completion_tokens=200,
+            ),
+            1: ImportRulePlan(
+                import_rule_index=1,
+                name=None,
+                prompt_tokens=1000,
+                completion_tokens=200,
+            ),
+        }
+    )
+    assert plan.estimate_seconds(
+        prompt_tokens_per_second=100, completion_tokens_per_second=10
+    ) == pytest.approx(60)
+    assert plan.estimate_seconds(
+        prompt_tokens_per_second=100, completion_tokens_per_second=10, concurrency=4
+    ) == pytest.approx(15)
@@ -0,0 +1,154 @@
+import pytest
+
+from beanhub_inbox.data_types import PreClassifyConfig
+from beanhub_inbox.data_types import StrSuffixMatch
+from beanhub_inbox.pre_classify import contains_amount
+from beanhub_inbox.pre_classify import pre_classify
+from beanhub_inbox.pre_classify import PreClassifyResult
+from beanhub_inbox.pre_classify import PreClassifySignal
+from beanhub_inbox.pre_classify import SenderHistory
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Total: $12.34", True),
+        ("Total: $ 1,234.00", True),
+        ("Total: 12.34 USD", True),
+        ("Amount EUR 99", True),
+        ("Paid 500€", True),
+        ("Your order has shipped", False),
+        ("Order number 12345", False),
+        ("usdollar 12", False),
+        ("", False),
+    ],
+)
+def test_contains_amount(text: str, expected: bool):
+    assert contains_amount(text) == expected
+
+
+@pytest.mark.parametrize(
+    "config, subject, from_addresses, text, history, expected",
+    [
+        pytest.param(
+            PreClassifyConfig(),
+            "Newsletter",
+            ["news@example.com"],
+            "Hello",
+            [],
+            None,
+            id="empty-config",
+        ),
+        pytest.param(
+            PreClassifyConfig(
+                skip_from_addresses=[StrSuffixMatch(suffix="@news.example.com")]
+            ),
+            "Hi",
+            ["Example News <Weekly@News.Example.com>"],
+            "Total: $12.34",
+            [],
+            PreClassifyResult(
+                signal=PreClassifySignal.from_address,
+                detail="weekly@news.example.com",
+            ),
+            id="from-address",
+        ),
+        pytest.param(
+            PreClassifyConfig(skip_from_addresses=["noreply@.+"]),
+            "Hi",
+            ["billing@example.com"],
+            "Total: $12.34",
+            [],
+            None,
+            id="from-address-not-match",
+        ),
+        pytest.param(
+            PreClassifyConfig(skip_subject_keywords=["newsletter", "Shipped"]),
+            "Your order has been shipped",
+            ["shop@example.com"],
+            "Total: $12.34",
+            [],
+            PreClassifyResult(
+                signal=PreClassifySignal.subject_keyword,
+                detail="Shipped",
+            ),
+            id="subject-keyword",
+        ),
+        pytest.param(
+            PreClassifyConfig(require_amount=True),
+            "Your order has been shipped",
+            ["shop@example.com"],
+            "Tracking number 1Z999",
+            [],
+            PreClassifyResult(
+                signal=PreClassifySignal.no_amount,
+                detail="No currency amount found in the content",
+            ),
+            id="no-amount",
+        ),
+        pytest.param(
+            PreClassifyConfig(require_amount=True),
+            "Your receipt",
+            ["shop@example.com"],
+            "Total: $12.34",
+            [],
+            None,
+            id="amount",
+        ),
+        pytest.param(
+            PreClassifyConfig(sender_history_threshold=2),
+            "Hi",
+            ["Promo <promo@example.com>"],
+            "Total: $12.34",
+            [(["promo@example.com"], False), (["promo@example.com"], False)],
+            PreClassifyResult(
+                signal=PreClassifySignal.sender_history,
+                detail="promo@example.com sent 2 non-transaction emails",
+            ),
+            id="sender-history",
+        ),
+        pytest.param(
+            PreClassifyConfig(sender_history_threshold=2),
+            "Hi",
+            ["promo@example.com"],
+            "Total: $12.34",
+            [(["promo@example.com"], False)],
+            None,
+            id="sender-history-below-threshold",
+        ),
+        pytest.param(
+            PreClassifyConfig(sender_history_threshold=2),
+            "Hi",
+            ["shop@example.com"],
+            "Total: $12.34",
+            [
+                (["shop@example.com"], False),
+                (["shop@example.com"], True),
+                (["shop@example.com"], False),
+            ],
+            None,
+            id="sender-history-with-valid",
+        ),
+    ],
+)
+def test_pre_classify(
+    config: PreClassifyConfig,
+    subject: str,
+    from_addresses: list[str],
+    text: str,
+    history: list[tuple[list[str], bool]],
+    expected: PreClassifyResult | None,
+):
+    sender_history = SenderHistory()
+    for addresses, valid in history:
+        sender_history.record(addresses, valid=valid)
+    assert (
+        pre_classify(
+            config=config,
+            subject=subject,
+            from_addresses=from_addresses,
+            text=text,
+            sender_history=sender_history,
+        )
+        == expected
+    )
@@ -1,7 +1,12 @@
+import decimal
 import json
 import pathlib
+import pickle
 import re
+import subprocess
+import sys
 import textwrap
+import threading
 
 import ollama
 import pytest
@@ -9,11 +14,16 @@ import yaml
 from jinja2.sandbox import SandboxedEnvironment
 from pytest_mock import MockerFixture
 
+from .factories import EmailAttachmentFactory
 from .factories import EmailFileFactory
 from .factories import InboxEmailFactory
 from .factories import MockEmail
 from .factories import MockEmailFactory
+from beanhub_inbox import processor
+from beanhub_inbox.concurrency import AdaptiveLimiter
 from beanhub_inbox.data_types import ArchiveInboxAction
+from beanhub_inbox.data_types import ColumnExtractor
+from beanhub_inbox.data_types import DedupConfig
 from beanhub_inbox.data_types import EmailFileMatchRule
 from beanhub_inbox.data_types import ExtractConfig
 from beanhub_inbox.data_types import ExtractImportAction
@@ -26,24 +36,69 @@ from beanhub_inbox.data_types import InboxDoc
 from beanhub_inbox.data_types import InboxEmail
 from beanhub_inbox.data_types import InboxMatch
 from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.data_types import LatencyConfig
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.data_types import ParquetOutputConfig
+from beanhub_inbox.data_types import PreClassifyConfig
 from beanhub_inbox.data_types import SimpleFileMatch
+from beanhub_inbox.data_types import SQLiteOutputConfig
 from beanhub_inbox.data_types import StrContainsMatch
 from beanhub_inbox.data_types import StrExactMatch
 from beanhub_inbox.data_types import StrOneOfMatch
 from beanhub_inbox.data_types import StrPrefixMatch
 from beanhub_inbox.data_types import StrRegexMatch
 from beanhub_inbox.data_types import StrSuffixMatch
+from beanhub_inbox.data_types import TemplateCacheConfig
+from beanhub_inbox.data_types import ThinkingUpdateConfig
+from beanhub_inbox.data_types import ThinkingUpdateMode
+from beanhub_inbox.data_types import TokenBudgetConfig
+from beanhub_inbox.deadline import DeadlineStage
+from beanhub_inbox.dedup import DuplicateSignal
+from beanhub_inbox.email_headers import EmailHeaders
+from beanhub_inbox.llm import DEFAULT_COLUMNS
+from beanhub_inbox.llm import LLMCall
+from beanhub_inbox.pre_classify import PreClassifySignal
+from beanhub_inbox.processor import BackfillColumns
+from beanhub_inbox.processor import CSVRowExists
+from beanhub_inbox.processor import DuplicateEmail
+from beanhub_inbox.processor import DuplicateRowNotFound
+from beanhub_inbox.processor import EmailBody
 from beanhub_inbox.processor import EmailFile
+from beanhub_inbox.processor import extract_email_text
 from beanhub_inbox.processor import extract_html_text
 from beanhub_inbox.processor import extract_json_block
 from beanhub_inbox.processor import extract_received_for_email
+from beanhub_inbox.processor import find_csv_row
+from beanhub_inbox.processor import FinishExtractingColumn
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.processor import FinishThinking
+from beanhub_inbox.processor import get_email_text
+from beanhub_inbox.processor import LLMConcurrency
+from beanhub_inbox.processor import LLMDeadlineExceeded
+from beanhub_inbox.processor import LLMTokenUsage
 from beanhub_inbox.processor import match_email_file
 from beanhub_inbox.processor import match_file
 from beanhub_inbox.processor import match_inbox_email
 from beanhub_inbox.processor import match_str
+from beanhub_inbox.processor import parse_email_body
+from beanhub_inbox.processor import parse_email_file
 from beanhub_inbox.processor import process_imports
 from beanhub_inbox.processor import process_inbox_email
+from beanhub_inbox.processor import ProcessImportEvent
 from beanhub_inbox.processor import render_input_config_match
+from beanhub_inbox.processor import ReplayJournalColumn
+from beanhub_inbox.processor import SQLiteRowExists
+from beanhub_inbox.processor import StartThinking
+from beanhub_inbox.processor import TemplateCacheHit
+from beanhub_inbox.processor import ThinkingUpdateBuffer
+from beanhub_inbox.processor import TokenBudgetExceeded
+from beanhub_inbox.processor import UpdateThinking
+from beanhub_inbox.sharding import merge_shard_csvs
+from beanhub_inbox.sharding import Shard
+from beanhub_inbox.token_usage import TokenAccounting
+from beanhub_inbox.token_usage import TokenBudgetScope
+from beanhub_inbox.token_usage import TokenUsage
 
 
 @pytest.fixture
@@ -412,6 +467,52 @@ def test_process_inbox_email(
     )
 
 
+def test_deferred_imports():
+    # importing and routing emails in a new interpreter, as the test process has
+    # imported all the modules already
+    script = textwrap.dedent(
+        """\
+        import sys
+
+        from beanhub_inbox.data_types import IgnoreInboxAction
+        from beanhub_inbox.data_types import InboxActionType
+        from beanhub_inbox.data_types import InboxConfig
+        from beanhub_inbox.data_types import InboxEmail
+        from beanhub_inbox.data_types import InboxMatch
+        from beanhub_inbox.processor import process_inbox_email
+        from beanhub_inbox.templates import make_environment
+
+        action = process_inbox_email(
+            template_env=make_environment(),
+            inbox_email=InboxEmail(
+                id="mock-id",
+                message_id="mock-msg-id",
+                headers={},
+                subject="Mock subject",
+                from_addresses=["fangpen@launchplatform.com"],
+                recipients=["foo+tag0@example.com"],
+                tags=["tag0"],
+            ),
+            inbox_configs=[
+                InboxConfig(
+                    match=InboxMatch(tags=["tag0"]),
+                    action=IgnoreInboxAction(type=InboxActionType.ignore),
+                )
+            ],
+        )
+        assert action.type == InboxActionType.ignore
+        print("\\n".join(sorted(sys.modules)))
+        """
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    modules = frozenset(result.stdout.splitlines())
+    assert "beanhub_inbox.processor" in modules
+    for module in ["ollama", "httpx", "lxml.etree", "email_validator"]:
+        assert module not in modules
+
+
 @pytest.mark.parametrize(
     "pattern, path, expected",
     [
@@ -678,6 +779,173 @@ def test_extract_json_block(text: str, expected: list[dict]):
             ],
             id="not-match",
         ),
+        pytest.param(
+            InboxDoc(
+                inputs=[
+                    InputConfig(match="*.eml"),
+                ],
+                imports=[
+                    ImportConfig(
+                        actions=[
+                            ExtractImportAction(
+                                extract=ExtractConfig(
+                                    output_csv="output.csv",
+                                    pre_classify=PreClassifyConfig(
+                                        skip_subject_keywords=["newsletter"]
+                                    ),
+                                )
+                            )
+                        ],
+                    )
+                ],
+            ),
+            {
+                "mock.eml": MockEmailFactory(subject="Our Weekly Newsletter"),
+            },
+            dict(
+                valid=True,
+            ),
+            [
+                ("StartProcessingEmail", lambda e: e.email_file.id == "mock"),
+                ("MatchImportRule", lambda e: e.email_file.id == "mock"),
+                (
+                    "PreClassifyNotTransaction",
+                    lambda e: e.email_file.id == "mock"
+                    and e.signal == PreClassifySignal.subject_keyword
+                    and e.detail == "newsletter",
+                ),
+                (
+                    "FinishExtractingRow",
+                    lambda e: e.email_file.id == "mock" and e.row == dict(valid=False),
+                ),
+            ],
+            id="pre-classify",
+        ),
+        pytest.param(
+            InboxDoc(
+                inputs=[
+                    InputConfig(match="*.eml"),
+                ],
+                imports=[
+                    ImportConfig(
+                        match=EmailFileMatchRule(
+                            subject="Transaction alert (?P<txn_id>[0-9]+)"
+                        ),
+                        actions=[
+                            ExtractImportAction(
+                                extract=ExtractConfig(
+                                    output_csv="output.csv",
+                                    columns=[
+                                        OutputColumn(
+                                            name="valid",
+                                            type=OutputColumnType.bool,
+                                            description="valid",
+                                            extractors=[
+                                                ColumnExtractor(
+                                                    header="Subject",
+                                                    match=StrPrefixMatch(
+                                                        prefix="Transaction alert"
+                                                    ),
+                                                    value="true",
+                                                )
+                                            ],
+                                        ),
+                                        OutputColumn(
+                                            name="txn_id",
+                                            type=OutputColumnType.str,
+                                            description="txn id",
+                                        ),
+                                    ],
+                                ),
+                            )
+                        ],
+                    )
+                ],
+            ),
+            {
+                "mock.eml": MockEmailFactory(subject="Transaction alert 1234"),
+            },
+            dict(),
+            [
+                ("StartProcessingEmail", lambda e: e.email_file.id == "mock"),
+                ("MatchImportRule", lambda e: e.email_file.id == "mock"),
+                ("StartExtractingColumn", lambda e: e.column.name == "valid"),
+                (
+                    "FinishExtractingColumn",
+                    lambda e: e.column.name == "valid" and e.value is True,
+                ),
+                ("StartExtractingColumn", lambda e: e.column.name == "txn_id"),
+                (
+                    "FinishExtractingColumn",
+                    lambda e: e.column.name == "txn_id" and e.value == "1234",
+                ),
+                (
+                    "FinishExtractingRow",
+                    lambda e: e.row == dict(valid=True, txn_id="1234"),
+                ),
+            ],
+            id="rule-extract",
+        ),
+        pytest.param(
+            InboxDoc(
+                inputs=[
+                    InputConfig(match="*.eml"),
+                ],
+                imports=[
+                    ImportConfig(
+                        actions=[
+                            ExtractImportAction(
+                                extract=ExtractConfig(
+                                    output_csv="output.csv",
+                                    dedup=DedupConfig(),
+                                )
+                            )
+                        ],
+                    )
+                ],
+            ),
+            {
+                "mock0.eml": MockEmailFactory(
+                    subject="Receipt",
+                    html=EmailAttachmentFactory(
+                        content=b"<p>Total: $12.34</p>", mime_type="text/html"
+                    ),
+                ),
+                "mock1.eml": MockEmailFactory(
+                    subject="Fwd: Receipt",
+                    html=EmailAttachmentFactory(
+                        content=b"<blockquote>Total: $12.34</blockquote>",
+                        mime_type="text/html",
+                    ),
+                ),
+            },
+            dict(
+                valid=False,
+            ),
+            [
+                ("StartProcessingEmail", lambda e: e.email_file.id == "mock0"),
+                ("MatchImportRule", lambda e: e.email_file.id == "mock0"),
+                ("StartExtractingColumn", lambda e: e.email_file.id == "mock0"),
+                ("StartThinking", lambda e: e.email_file.id == "mock0"),
+                ("UpdateThinking", lambda e: e.email_file.id == "mock0"),
+                ("FinishThinking", lambda e: e.email_file.id == "mock0"),
+                ("FinishExtractingColumn", lambda e: e.email_file.id == "mock0"),
+                ("FinishExtractingRow", lambda e: e.email_file.id == "mock0"),
+                ("StartProcessingEmail", lambda e: e.email_file.id == "mock1"),
+                ("MatchImportRule", lambda e: e.email_file.id == "mock1"),
+                (
+                    "DuplicateEmail",
+                    lambda e: e.email_file.id == "mock1"
+                    and e.duplicate_of == "mock0"
+                    and e.signal == DuplicateSignal.body_hash,
+                ),
+                (
+                    "FinishExtractingRow",
+                    lambda e: e.email_file.id == "mock1" and e.row == dict(valid=False),
+                ),
+            ],
+            id="dedup",
+        ),
     ],
 )
 def test_process_imports(
@@ -722,61 +990,1260 @@ def test_process_imports(
         assert validator(event)
 
 
-@pytest.mark.parametrize(
-    "html, expected",
-    [
-        pytest.param(
-            textwrap.dedent("""\
-            <div style="font-family: Arial, sans-serif; font-size: 14px;"><br></div><div class="protonmail_quote">
-                    ------- Forwarded Message -------<br>
-                    From: DigitalOcean Support &lt;support@digitalocean.com&gt;<br>
-                    Date: On Sunday, September 1st, 2024 at 12:17 AM<br>
-                    Subject: [DigitalOcean] Your 2024-08 invoice is available<br>
-                    To: Fang-Pen Lin &lt;fangpen@launchplatform.com&gt;<br>
-                    <br>
-                    <blockquote class="protonmail_quote" type="cite">
-                        <div>Usage charges for 2024-08</div>
-                    </blockquote>
-            </div>
-            """),
-            textwrap.dedent("""\
-            ------- Forwarded Message -------
-            From: DigitalOcean Support <support@digitalocean.com>
-            Date: On Sunday, September 1st, 2024 at 12:17 AM
-            Subject: [DigitalOcean] Your 2024-08 invoice is available
-            To: Fang-Pen Lin <fangpen@launchplatform.com>
-            Usage charges for 2024-08"""),
-            id="basic",
-        ),
-        pytest.param(
-            textwrap.dedent("""\
-            first line
-            <style>
-            h1 { color: red; }
-            </style>
-            second line
-            <div>
-                third line
-            </div>
-            """),
-            "first line\nsecond line\nthird line",
-            id="style",
-        ),
-        pytest.param(
-            textwrap.dedent("""\
-            first line
-            <script>
-            console.log('hi')
-            </script>
-            second line
-            <div>
-                third line
-            </div>
-            """),
-            "first line\nsecond line\nthird line",
-            id="script",
-        ),
-    ],
-)
-def test_extract_html_text(html: str, expected: str):
-    assert extract_html_text(html) == expected
+def test_process_imports_template_cache(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        msg = messages[0]
+        key = re.search("with only one field `(.+?)`", msg.content).group(1)
+        values = dict(
+            valid=True,
+            amount=re.search(r"Total: \$(\S+)", msg.content).group(1),
+        )
+        yield ollama.ChatResponse(
+            message=ollama.Message(
+                role="assistant", content=json.dumps({key: values.get(key)})
+            )
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name, amount in [("mock0", "12.34"), ("mock1", "56.78")]:
+        mock_email = MockEmailFactory(
+            from_addresses=["billing@shop.com"],
+            html=EmailAttachmentFactory(
+                content=f"<div><p>Receipt</p><p>Total: ${amount}</p></div>".encode(),
+                mime_type="text/html",
+            ),
+        )
+        (input_dir / f"{name}.eml").write_text(str(mock_email.make_msg()))
+
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            template_cache=TemplateCacheConfig(
+                                cache_file="templates.json",
+                                min_samples=1,
+                                spot_check_interval=None,
+                            ),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    llm_call_count = mock_chat.call_count
+    assert llm_call_count > 0
+    assert (tmp_path / "templates.json").exists()
+
+    mock1_events = [event for event in events if event.email_file.id == "mock1"]
+    (hit_event,) = [
+        event for event in mock1_events if isinstance(event, TemplateCacheHit)
+    ]
+    assert hit_event.columns == ["valid", "amount"]
+    # other columns are None as constant values, which still go to LLM
+    thinking_columns = [
+        event.column.name for event in mock1_events if isinstance(event, StartThinking)
+    ]
+    assert thinking_columns
+    assert "valid" not in thinking_columns
+    assert "amount" not in thinking_columns
+    rows = [event.row for event in events if isinstance(event, FinishExtractingRow)]
+    assert [row["amount"] for row in rows] == ["12.34", "56.78"]
+    assert [row["valid"] for row in rows] == [True, True]
+
+
+def test_process_imports_backfill(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    values = dict(valid=True, desc="Tea", amount="12.34")
+
+    def chat_side_effect(messages, **kwargs):
+        msg = messages[0]
+        key = re.search("with only one field `(.+?)`", msg.content).group(1)
+        yield ollama.ChatResponse(
+            message=ollama.Message(
+                role="assistant", content=json.dumps({key: values[key]})
+            )
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock", "new"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text("id,valid,desc\nmock,True,Coffee\n")
+
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            backfill=True,
+                            columns=[
+                                OutputColumn(
+                                    name="valid",
+                                    type=OutputColumnType.bool,
+                                    description="valid",
+                                ),
+                                OutputColumn(
+                                    name="desc",
+                                    type=OutputColumnType.str,
+                                    description="desc",
+                                    required=False,
+                                ),
+                                OutputColumn(
+                                    name="amount",
+                                    type=OutputColumnType.decimal,
+                                    description="amount",
+                                ),
+                            ],
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    backfill_events = [event for event in events if isinstance(event, BackfillColumns)]
+    assert len(backfill_events) == 1
+    assert backfill_events[0].email_file.id == "mock"
+    assert backfill_events[0].columns == ["amount"]
+    assert [
+        event.column.name
+        for event in events
+        if isinstance(event, FinishExtractingColumn) and event.email_file.id == "mock"
+    ] == ["amount"]
+    rows = {
+        event.email_file.id: event.row
+        for event in events
+        if isinstance(event, FinishExtractingRow)
+    }
+    assert rows == dict(
+        mock=dict(valid="True", desc="Coffee", amount="12.34"),
+        new=dict(valid=True, desc="Tea", amount="12.34"),
+    )
+    assert output_csv.read_text() == (
+        "id,valid,desc,amount\nmock,True,Coffee,12.34\nnew,True,Tea,12.34\n"
+    )
+
+
+def test_process_imports_journal(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv", journal="journal.jsonl"
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    journal_file = tmp_path / "journal.jsonl"
+
+    # interrupt the processing right after extracting the column value
+    events = process_imports(
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        llm_model="deepcoder",
+        workdir_path=tmp_path,
+    )
+    for event in events:
+        if isinstance(event, FinishExtractingColumn):
+            break
+    events.close()
+    assert mock_chat.call_count == 1
+    assert not (tmp_path / "output.csv").exists()
+    assert journal_file.exists()
+
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    replay_events = [
+        event for event in events if isinstance(event, ReplayJournalColumn)
+    ]
+    assert [event.email_file.id for event in replay_events] == ["mock0"]
+    # only the second email needs LLM
+    assert mock_chat.call_count == 2
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\n"
+        "mock0,False,,,,,,\n"
+        "mock1,False,,,,,,\n"
+    )
+    assert not journal_file.exists()
+    # output files are only locked for multiple workers
+    assert not (tmp_path / ".output.csv.lock").exists()
+
+
+def test_process_imports_sqlite(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock1", "mock0"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            output_sqlite=SQLiteOutputConfig(database="output.db"),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    expected_csv = (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\n"
+        "mock0,False,,,,,,\n"
+        "mock1,False,,,,,,\n"
+    )
+
+    list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    assert mock_chat.call_count == 2
+    assert (tmp_path / "output.db").exists()
+    assert (tmp_path / "output.csv").read_text() == expected_csv
+
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    assert mock_chat.call_count == 2
+    assert sorted(
+        event.email_file.id for event in events if isinstance(event, SQLiteRowExists)
+    ) == ["mock0", "mock1"]
+    assert (tmp_path / "output.csv").read_text() == expected_csv
+
+
+def test_process_imports_parquet(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    (tmp_path / "output.csv").write_text(
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\n"
+        "mock0,True,Coffee,Starbucks,12.34,,,2025-04-01\n"
+    )
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            output_parquet=ParquetOutputConfig(path="output"),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    for _ in range(2):
+        list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+            )
+        )
+    assert mock_chat.call_count == 1
+    rows = pyarrow_parquet.read_table(tmp_path / "output").to_pylist()
+    assert sorted((row["id"], row["valid"], row["amount"]) for row in rows) == [
+        ("mock0", True, decimal.Decimal("12.34")),
+        ("mock1", False, None),
+    ]
+
+
+def test_process_imports_shard(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for index in range(10):
+        (input_dir / f"mock{index}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    single_dir = tmp_path / "single"
+    single_dir.mkdir()
+    list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=single_dir,
+        )
+    )
+    assert mock_chat.call_count == 10
+    merge_shard_csvs(single_dir / "output.csv", shard_count=1)
+
+    shard_dir = tmp_path / "shard"
+    shard_dir.mkdir()
+    shard_ids = []
+    for index in range(3):
+        events = list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=shard_dir,
+                shard=Shard(index=index, count=3),
+            )
+        )
+        shard_ids.append(
+            [
+                event.email_file.id
+                for event in events
+                if isinstance(event, FinishExtractingRow)
+            ]
+        )
+    assert mock_chat.call_count == 20
+    assert sorted(sum(shard_ids, [])) == sorted(f"mock{index}" for index in range(10))
+    assert all(shard_ids)
+    merge_shard_csvs(shard_dir / "output.csv", shard_count=3, remove_shards=True)
+    assert (shard_dir / "output.csv").read_text() == (
+        single_dir / "output.csv"
+    ).read_text()
+
+    # rows already merged are not extracted again
+    for index in range(3):
+        list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=shard_dir,
+                shard=Shard(index=index, count=3),
+            )
+        )
+    assert mock_chat.call_count == 20
+
+
+def test_process_imports_dedup_rerun(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    get_email_text_spy = mocker.spy(processor, "get_email_text")
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(
+            str(
+                MockEmailFactory(
+                    html=EmailAttachmentFactory(
+                        content=f"<p>Receipt {name}</p>".encode(),
+                        mime_type="text/html",
+                    )
+                ).make_msg()
+            )
+        )
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            dedup=DedupConfig(),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+
+    def run() -> list[ProcessImportEvent]:
+        get_email_text_spy.reset_mock()
+        return list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+            )
+        )
+
+    run()
+    assert get_email_text_spy.call_count == 2
+    assert (tmp_path / ".output.csv.signatures.jsonl").exists()
+
+    (input_dir / "mock2.eml").write_text(
+        str(
+            MockEmailFactory(
+                html=EmailAttachmentFactory(
+                    content=b"<p>Receipt mock0</p>", mime_type="text/html"
+                )
+            ).make_msg()
+        )
+    )
+    events = run()
+    # existing emails are not parsed again for their signatures
+    assert get_email_text_spy.call_count == 1
+    duplicates = [event for event in events if isinstance(event, DuplicateEmail)]
+    assert len(duplicates) == 1
+    assert duplicates[0].email_file.id == "mock2"
+    assert duplicates[0].duplicate_of == "mock0"
+    assert duplicates[0].signal == DuplicateSignal.body_hash
+
+    # emails extracted before enabling dedup are parsed once
+    (tmp_path / ".output.csv.signatures.jsonl").unlink()
+    run()
+    assert get_email_text_spy.call_count == 3
+    run()
+    assert get_email_text_spy.call_count == 0
+
+
+def test_process_imports_dedup_row_in_output(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1", "mock2"]:
+        (input_dir / f"{name}.eml").write_text(
+            str(
+                MockEmailFactory(
+                    html=EmailAttachmentFactory(
+                        content=b"<p>Receipt</p>", mime_type="text/html"
+                    ),
+                ).make_msg()
+            )
+        )
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            dedup=DedupConfig(),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+
+    def run(name: str) -> list[ProcessImportEvent]:
+        # each run only sees one email, like workers sharing the output
+        return list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+                filepaths=[input_dir / f"{name}.eml"],
+            )
+        )
+
+    run("mock0")
+    events = run("mock1")
+    assert [
+        (event.email_file.id, event.duplicate_of)
+        for event in events
+        if isinstance(event, DuplicateEmail)
+    ] == [("mock1", "mock0")]
+    finish_events = [
+        event for event in events if isinstance(event, FinishExtractingRow)
+    ]
+    assert len(finish_events) == 1
+    assert finish_events[0].email_file.id == "mock1"
+    assert finish_events[0].row == dict(
+        valid="False", desc="", merchant="", amount="", tax="", txn_id="", txn_date=""
+    )
+    assert mock_chat.call_count == 1
+    assert (tmp_path / "output.csv").read_text().splitlines()[1:] == [
+        "mock0,False,,,,,,",
+        "mock1,False,,,,,,",
+    ]
+
+    # the row of the first email is gone from the output
+    (tmp_path / "output.csv").unlink()
+    events = run("mock2")
+    assert [
+        (event.email_file.id, event.duplicate_of)
+        for event in events
+        if isinstance(event, DuplicateRowNotFound)
+    ] == [("mock2", "mock0")]
+    assert not any(isinstance(event, FinishExtractingRow) for event in events)
+
+
+def test_process_imports_shard_backfill(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    values = dict(valid=True, desc="Tea", amount="12.34")
+
+    def chat_side_effect(messages, **kwargs):
+        msg = messages[0]
+        key = re.search("with only one field `(.+?)`", msg.content).group(1)
+        yield ollama.ChatResponse(
+            message=ollama.Message(
+                role="assistant", content=json.dumps({key: values[key]})
+            )
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for index in range(4):
+        (input_dir / f"mock{index}.eml").write_text(str(MockEmailFactory().make_msg()))
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text(
+        "id,valid,desc\n"
+        "mock0,True,Coffee\n"
+        "mock1,True,Cake\n"
+        "mock2,False,\n"
+        "mock3,True,Juice\n"
+    )
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            backfill=True,
+                            columns=[
+                                OutputColumn(
+                                    name="valid",
+                                    type=OutputColumnType.bool,
+                                    description="valid",
+                                ),
+                                OutputColumn(
+                                    name="desc",
+                                    type=OutputColumnType.str,
+                                    description="desc",
+                                    required=False,
+                                ),
+                                OutputColumn(
+                                    name="amount",
+                                    type=OutputColumnType.decimal,
+                                    description="amount",
+                                ),
+                            ],
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+
+    def run_shards() -> list[ProcessImportEvent]:
+        events = []
+        for index in range(2):
+            events.extend(
+                process_imports(
+                    inbox_doc=inbox_doc,
+                    input_dir=input_dir,
+                    llm_model="deepcoder",
+                    workdir_path=tmp_path,
+                    shard=Shard(index=index, count=2),
+                )
+            )
+        return events
+
+    events = run_shards()
+    # only the missing column of the valid emails is extracted
+    assert sorted(
+        event.email_file.id
+        for event in events
+        if isinstance(event, FinishExtractingColumn)
+    ) == ["mock0", "mock1", "mock3"]
+    assert all(
+        event.column.name == "amount"
+        for event in events
+        if isinstance(event, FinishExtractingColumn)
+    )
+    llm_call_count = mock_chat.call_count
+    merge_shard_csvs(output_csv, shard_count=2, remove_shards=True)
+    assert output_csv.read_text() == (
+        "id,valid,desc,amount\n"
+        "mock0,True,Coffee,12.34\n"
+        "mock1,True,Cake,12.34\n"
+        "mock2,False,,\n"
+        "mock3,True,Juice,12.34\n"
+    )
+
+    # all the merged rows are complete now
+    events = run_shards()
+    assert mock_chat.call_count == llm_call_count
+    assert sorted(
+        event.email_file.id for event in events if isinstance(event, CSVRowExists)
+    ) == ["mock0", "mock1", "mock2", "mock3"]
+
+
+def test_process_imports_llm_limiter(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        if "format" in kwargs:
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content='{"valid": false}')
+            )
+            return
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="I don't know")
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock0.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    llm_limiter = AdaptiveLimiter(initial_limit=2)
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            llm_limiter=llm_limiter,
+        )
+    )
+    concurrency_events = [
+        event for event in events if isinstance(event, LLMConcurrency)
+    ]
+    # one for thinking and one for structured output
+    assert len(concurrency_events) == 2
+    assert concurrency_events[0].limit == 2
+    for event in concurrency_events:
+        assert event.column.name == "valid"
+        assert event.in_flight == 0
+        assert event.time_to_first_token is not None
+    assert llm_limiter.in_flight == 0
+
+
+def test_process_imports_deadline(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    blocker = threading.Event()
+    think_options = []
+
+    def chat_side_effect(messages, **kwargs):
+        if "format" in kwargs:
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content='{"valid": false}')
+            )
+            return
+        think_options.append(kwargs["options"])
+        # stuck thinking
+        blocker.wait(5)
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="Thinking...")
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock0.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            journal="journal.jsonl",
+                            latency=LatencyConfig(
+                                call_timeout=0.1, think_num_predict=1024
+                            ),
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    try:
+        events = list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+            )
+        )
+    finally:
+        blocker.set()
+    assert [
+        event.stage for event in events if isinstance(event, LLMDeadlineExceeded)
+    ] == [DeadlineStage.think]
+    assert not any(isinstance(event, FinishThinking) for event in events)
+    assert think_options == [dict(temperature=0, num_predict=1024)]
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\nmock0,False,,,,,,\n"
+    )
+
+
+def test_process_imports_parse_workers(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for i in range(5):
+        (input_dir / f"mock{i}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+    results = []
+    for parse_workers in [None, 2]:
+        workdir_path = tmp_path / f"workdir-{parse_workers}"
+        workdir_path.mkdir()
+        events = list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=workdir_path,
+                parse_workers=parse_workers,
+            )
+        )
+        results.append(
+            (
+                [(type(event), event.email_file.id) for event in events],
+                (workdir_path / "output.csv").read_text(),
+            )
+        )
+    assert results[0] == results[1]
+
+
+def test_parse_email_body(tmp_path: pathlib.Path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    msg = MockEmailFactory(subject="MOCK_SUBJECT").make_msg()
+    (input_dir / "mock.eml").write_text(str(msg))
+    email_file, email_body = parse_email_body(input_dir / "mock.eml", input_dir)
+    assert email_file.id == "mock"
+    assert email_file.subject == "MOCK_SUBJECT"
+    assert type(email_file.subject) is str
+    assert isinstance(email_file.headers, EmailHeaders)
+    assert not hasattr(email_file, "__dict__")
+    assert email_body.error is None
+    assert email_body.text == extract_email_text(
+        email_file, parse_email_file(input_dir / "mock.eml")
+    )
+    assert pickle.loads(pickle.dumps((email_file, email_body))) == (
+        email_file,
+        email_body,
+    )
+
+
+def test_get_email_text_error():
+    email_file = EmailFile(
+        id="mock",
+        filepath="mock.eml",
+        subject="",
+        from_addresses=[],
+        recipients=[],
+        headers={},
+        tags=None,
+    )
+    with pytest.raises(ValueError, match="not supported"):
+        get_email_text(
+            email_file,
+            EmailBody(error="Email content with embedded image is not supported yet"),
+        )
+    assert get_email_text(email_file, EmailBody(text="hello")) == "hello"
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.mark.parametrize(
+    "config, pieces, expected",
+    [
+        (ThinkingUpdateConfig(), ["a", "b", "c"], ["a", "b", "c"]),
+        (
+            ThinkingUpdateConfig(mode=ThinkingUpdateMode.disabled),
+            ["a", "b", "c"],
+            [],
+        ),
+        (
+            ThinkingUpdateConfig(
+                mode=ThinkingUpdateMode.coalesced, max_chars=3, interval=None
+            ),
+            ["a", "bc", "d", "efg", "h"],
+            ["abc", "defg", "h"],
+        ),
+    ],
+)
+def test_thinking_update_buffer(
+    config: ThinkingUpdateConfig, pieces: list[str], expected: list[str]
+):
+    update_buffer = ThinkingUpdateBuffer(config)
+    updates = [update_buffer.add(piece) for piece in pieces]
+    updates.append(update_buffer.flush())
+    assert [update for update in updates if update is not None] == expected
+
+
+def test_thinking_update_buffer_interval():
+    clock = MockClock()
+    update_buffer = ThinkingUpdateBuffer(
+        ThinkingUpdateConfig(
+            mode=ThinkingUpdateMode.coalesced, interval=1.0, max_chars=None
+        ),
+        clock=clock,
+    )
+    assert update_buffer.add("a") is None
+    clock.now += 0.5
+    assert update_buffer.add("b") is None
+    clock.now += 0.5
+    assert update_buffer.add("c") == "abc"
+    clock.now += 10
+    assert update_buffer.add("d") is None
+    assert update_buffer.flush() == "d"
+    assert update_buffer.flush() is None
+
+
+@pytest.mark.parametrize(
+    "thinking_updates, expected",
+    [
+        (None, ["Let", " me", " think", "..."]),
+        (
+            ThinkingUpdateConfig(
+                mode=ThinkingUpdateMode.coalesced, max_chars=6, interval=None
+            ),
+            ["Let me", " think", "..."],
+        ),
+        (ThinkingUpdateConfig(mode=ThinkingUpdateMode.disabled), []),
+    ],
+)
+def test_process_imports_thinking_updates(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+    thinking_updates: ThinkingUpdateConfig | None,
+    expected: list[str],
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        if "format" in kwargs:
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content='{"valid": false}')
+            )
+            return
+        for piece in ["Let", " me", " think", "..."]:
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content=piece)
+            )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock0.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            thinking_updates=thinking_updates,
+        )
+    )
+    assert [
+        event.piece for event in events if isinstance(event, UpdateThinking)
+    ] == expected
+    (finish_thinking,) = [
+        event for event in events if isinstance(event, FinishThinking)
+    ]
+    assert finish_thinking.thinking == "Let me think..."
+
+
+def make_token_counting_chat(calls: list[str]):
+    def chat_side_effect(messages, **kwargs):
+        if "format" in kwargs:
+            calls.append("extract")
+            content = '{"valid": true}'
+        else:
+            calls.append("think")
+            content = "Thinking..."
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content=content),
+            prompt_eval_count=10,
+            eval_count=5,
+        )
+
+    return chat_side_effect
+
+
+def make_token_budget_inbox_doc(token_budget: TokenBudgetConfig) -> InboxDoc:
+    return InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            journal="journal.jsonl",
+                            token_budget=token_budget,
+                        )
+                    )
+                ]
+            )
+        ],
+    )
+
+
+def test_process_imports_token_usage(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    calls = []
+    mock_chat = mocker.patch.object(ollama, "chat")
+    mock_chat.side_effect = make_token_counting_chat(calls)
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock0.eml").write_text(str(MockEmailFactory().make_msg()))
+    token_accounting = TokenAccounting()
+    events = list(
+        process_imports(
+            inbox_doc=make_token_budget_inbox_doc(TokenBudgetConfig(email_tokens=30)),
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            token_accounting=token_accounting,
+        )
+    )
+    # only the first column is extracted with thinking
+    assert calls == ["think", "extract"] + ["extract"] * (len(DEFAULT_COLUMNS) - 1)
+    assert [
+        (event.column.name, event.call)
+        for event in events
+        if isinstance(event, LLMTokenUsage)
+    ] == [("valid", LLMCall.think), ("valid", LLMCall.extract)] + [
+        (column.name, LLMCall.extract) for column in DEFAULT_COLUMNS[1:]
+    ]
+    budget_events = [
+        event for event in events if isinstance(event, TokenBudgetExceeded)
+    ]
+    assert len(budget_events) == 1
+    assert budget_events[0].scope == TokenBudgetScope.email
+    assert budget_events[0].usage == TokenUsage(prompt_tokens=20, completion_tokens=10)
+    assert token_accounting.run == TokenUsage(
+        prompt_tokens=10 * len(calls), completion_tokens=5 * len(calls)
+    )
+    assert token_accounting.email_usage("mock0") == token_accounting.run
+    assert token_accounting.columns["valid"] == TokenUsage(
+        prompt_tokens=20, completion_tokens=10
+    )
+    assert token_accounting.columns["desc"] == TokenUsage(
+        prompt_tokens=10, completion_tokens=5
+    )
+    assert not token_accounting.exhausted
+
+
+def test_process_imports_run_token_budget(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+):
+    calls = []
+    mock_chat = mocker.patch.object(ollama, "chat")
+    mock_chat.side_effect = make_token_counting_chat(calls)
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for i in range(2):
+        (input_dir / f"mock{i}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = make_token_budget_inbox_doc(TokenBudgetConfig(run_tokens=1))
+    token_accounting = TokenAccounting()
+    events = list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            token_accounting=token_accounting,
+        )
+    )
+    assert token_accounting.exhausted
+    budget_events = [
+        event for event in events if isinstance(event, TokenBudgetExceeded)
+    ]
+    assert len(budget_events) == 1
+    assert budget_events[0].scope == TokenBudgetScope.run
+    assert budget_events[0].budget == 1
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\nmock0,True,,,,,,\n"
+    )
+    # the journal is kept for resuming
+    assert (tmp_path / "journal.jsonl").exists()
+
+    # resume with a new budget
+    list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+        )
+    )
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\n"
+        "mock0,True,,,,,,\n"
+        "mock1,True,,,,,,\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "html, expected",
+    [
+        pytest.param(
+            textwrap.dedent("""\
+            <div style="font-family: Arial, sans-serif; font-size: 14px;"><br></div><div class="protonmail_quote">
+                    ------- Forwarded Message -------<br>
+                    From: DigitalOcean Support &lt;support@digitalocean.com&gt;<br>
+                    Date: On Sunday, September 1st, 2024 at 12:17 AM<br>
+                    Subject: [DigitalOcean] Your 2024-08 invoice is available<br>
+                    To: Fang-Pen Lin &lt;fangpen@launchplatform.com&gt;<br>
+                    <br>
+                    <blockquote class="protonmail_quote" type="cite">
+                        <div>Usage charges for 2024-08</div>
+                    </blockquote>
+            </div>
+            """),
+            textwrap.dedent("""\
+            ------- Forwarded Message -------
+            From: DigitalOcean Support <support@digitalocean.com>
+            Date: On Sunday, September 1st, 2024 at 12:17 AM
+            Subject: [DigitalOcean] Your 2024-08 invoice is available
+            To: Fang-Pen Lin <fangpen@launchplatform.com>
+            Usage charges for 2024-08"""),
+            id="basic",
+        ),
+        pytest.param(
+            textwrap.dedent("""\
+            first line
+            <style>
+            h1 { color: red; }
+            </style>
+            second line
+            <div>
+                third line
+            </div>
+            """),
+            "first line\nsecond line\nthird line",
+            id="style",
+        ),
+        pytest.param(
+            textwrap.dedent("""\
+            first line
+            <script>
+            console.log('hi')
+            </script>
+            second line
+            <div>
+                third line
+            </div>
+            """),
+            "first line\nsecond line\nthird line",
+            id="script",
+        ),
+    ],
+)
+def test_extract_html_text(html: str, expected: str):
+    assert extract_html_text(html) == expected
+
+
+def test_find_csv_row(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    assert find_csv_row(output_csv=output_csv, email_id="a") is None
+    # created by another worker which has not written the header yet
+    output_csv.write_text("")
+    assert find_csv_row(output_csv=output_csv, email_id="a") is None
+    output_csv.write_text("id,valid\na,True\nb,False\n")
+    assert find_csv_row(output_csv=output_csv, email_id="b") == (
+        3,
+        dict(id="b", valid="False"),
+    )
+    assert find_csv_row(output_csv=output_csv, email_id="c") is None
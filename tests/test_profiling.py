@@ -0,0 +1,201 @@
+import cProfile
+import pathlib
+import pstats
+import threading
+
+import ollama
+import pytest
+
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.event_log import EventSink
+from beanhub_inbox.event_log import tee_events
+from beanhub_inbox.llm import build_row_model
+from beanhub_inbox.llm import DEFAULT_COLUMNS
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.processor import process_imports
+from beanhub_inbox.profiling import collapse_pstats
+from beanhub_inbox.profiling import find_import_time
+from beanhub_inbox.profiling import load_replay
+from beanhub_inbox.profiling import make_stub_value
+from beanhub_inbox.profiling import measure_import_time
+from beanhub_inbox.profiling import StackSampler
+from beanhub_inbox.profiling import StubLLM
+from beanhub_inbox.profiling import use_stub_llm
+from beanhub_inbox.profiling import write_collapsed
+
+
+@pytest.mark.parametrize(
+    "schema, expected",
+    [
+        ({"type": "boolean"}, True),
+        ({"type": "integer"}, 0),
+        ({"type": "string"}, "stub"),
+        ({"type": "string", "format": "date"}, "1970-01-01"),
+        ({"anyOf": [{"type": "string"}, {"type": "null"}]}, "stub"),
+        ({"anyOf": [{"type": "null"}]}, None),
+        ({"type": "string", "pattern": "^[A-Z]+$"}, None),
+    ],
+)
+def test_make_stub_value(schema: dict, expected):
+    assert make_stub_value(schema) == expected
+
+
+def test_stub_llm():
+    stub = StubLLM(thinking_chars=40, chunk_chars=16)
+    messages = [ollama.Message(role="user", content="x" * 100)]
+    parts = list(stub(model="stub", messages=messages, stream=True))
+    assert [len(part.message.content) for part in parts] == [16, 16, 8]
+    assert parts[-1].prompt_eval_count == 25
+    assert parts[-1].eval_count == 3
+    assert parts[0].eval_count is None
+
+    response_model_cls = build_row_model(output_columns=DEFAULT_COLUMNS)
+    parts = list(
+        stub(
+            model="stub",
+            messages=messages,
+            format=response_model_cls.model_json_schema(),
+            stream=True,
+        )
+    )
+    row = response_model_cls.model_validate_json(
+        "".join(part.message.content for part in parts)
+    )
+    assert row.valid is True
+    assert str(row.amount) == "0.00"
+    assert stub.calls == 2
+
+    original_chat = ollama.chat
+    with use_stub_llm(stub):
+        assert ollama.chat is stub
+    assert ollama.chat is original_chat
+
+
+def test_replay(tmp_path: pathlib.Path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    event_log = tmp_path / "events.jsonl"
+    stub = StubLLM()
+    with use_stub_llm(stub), EventSink(event_log) as sink:
+        recorded_events = list(
+            tee_events(
+                process_imports(
+                    inbox_doc=inbox_doc,
+                    input_dir=input_dir,
+                    llm_model="stub",
+                    workdir_path=tmp_path / "recorded",
+                ),
+                sink,
+            )
+        )
+    recorded_rows = [
+        event.row for event in recorded_events if isinstance(event, FinishExtractingRow)
+    ]
+    assert len(recorded_rows) == 2
+
+    replay = load_replay(event_log)
+    assert len(replay) == stub.calls // 2
+    # change the recorded values to check they are replayed
+    for entry in replay.values():
+        if entry.column == "merchant":
+            entry.value = "REPLAYED"
+    replay_stub = StubLLM(replay=replay)
+    with use_stub_llm(replay_stub):
+        replayed_events = list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="stub",
+                workdir_path=tmp_path / "replayed",
+            )
+        )
+    assert replay_stub.replayed_calls == replay_stub.calls
+    assert [
+        event.row for event in replayed_events if isinstance(event, FinishExtractingRow)
+    ] == [row | dict(merchant="REPLAYED") for row in recorded_rows]
+
+
+def outer():
+    return inner() + inner()
+
+
+def inner():
+    return sum(range(10000))
+
+
+def test_collapse_pstats(tmp_path: pathlib.Path):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    outer()
+    profiler.disable()
+    stacks = collapse_pstats(pstats.Stats(profiler), min_seconds=0)
+    inner_stacks = [
+        stack
+        for stack in stacks
+        if stack.split(";")[-1] == "<built-in method builtins.sum>"
+    ]
+    assert inner_stacks
+    for stack in inner_stacks:
+        assert stack.split(";")[-3:-1] == [
+            f"outer (test_profiling.py:{outer.__code__.co_firstlineno})",
+            f"inner (test_profiling.py:{inner.__code__.co_firstlineno})",
+        ]
+
+    path = tmp_path / "profile.collapsed"
+    write_collapsed({"a;b": 1.5, "a": 0.0000001}, path, scale=1_000_000)
+    assert path.read_text() == "a;b 1500000\n"
+
+
+def test_stack_sampler():
+    started = threading.Event()
+    stop = threading.Event()
+
+    def busy():
+        started.set()
+        while not stop.is_set():
+            sum(range(1000))
+
+    thread = threading.Thread(target=busy)
+    thread.start()
+    started.wait()
+    try:
+        sampler = StackSampler(interval=0.001, thread_id=thread.ident)
+        for _ in range(5):
+            sampler.sample()
+    finally:
+        stop.set()
+        thread.join()
+    assert sampler.samples == 5
+    for stack in sampler.collapsed():
+        assert f"busy (test_profiling.py:{busy.__code__.co_firstlineno})" in stack
+    assert "5 samples" in sampler.format_stats()
+
+
+def test_measure_import_time():
+    entries = measure_import_time("beanhub_inbox.llm")
+    entry = find_import_time(entries, "beanhub_inbox.llm")
+    assert entry.level == 0
+    assert entry.cumulative_us >= entry.self_us > 0
+    assert any(
+        entry.module == "beanhub_inbox.token_usage" and entry.level > 0
+        for entry in entries
+    )
+    with pytest.raises(ValueError):
+        find_import_time(entries, "beanhub_inbox.processor")
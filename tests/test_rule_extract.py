@@ -0,0 +1,192 @@
+import typing
+
+import pydantic
+import pytest
+from pytest_mock import MockerFixture
+
+from beanhub_inbox import rule_extract
+from beanhub_inbox.data_types import ColumnExtractor
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.data_types import StrPrefixMatch
+from beanhub_inbox.rule_extract import convert_column_value
+from beanhub_inbox.rule_extract import extract_columns_by_rules
+from beanhub_inbox.rule_extract import run_column_extractor
+
+TEXT = """\
+Transaction alert
+Amount: $1,234.56
+Merchant: ACME Inc
+Date: 2025-04-01
+"""
+HEADERS = {
+    "Subject": "Card ending 1234 charged",
+    "X-Bank-Ref": "REF-0001",
+}
+
+
+@pytest.mark.parametrize(
+    "extractor, column_name, expected",
+    [
+        pytest.param(
+            ColumnExtractor(regex=r"^Merchant: (?P<merchant>.+)$"),
+            "merchant",
+            "ACME Inc",
+            id="regex-named-group",
+        ),
+        pytest.param(
+            ColumnExtractor(regex=r"[0-9]{4}-[0-9]{2}-[0-9]{2}"),
+            "txn_date",
+            "2025-04-01",
+            id="regex-whole-match",
+        ),
+        pytest.param(
+            ColumnExtractor(regex=r"^Refund"),
+            "merchant",
+            None,
+            id="regex-not-match",
+        ),
+        pytest.param(
+            ColumnExtractor(regex=r"^Transaction alert$", value="true"),
+            "valid",
+            "true",
+            id="regex-value",
+        ),
+        pytest.param(
+            ColumnExtractor(header="x-bank-ref"),
+            "txn_id",
+            "REF-0001",
+            id="header",
+        ),
+        pytest.param(
+            ColumnExtractor(header="X-Missing"),
+            "txn_id",
+            None,
+            id="header-missing",
+        ),
+        pytest.param(
+            ColumnExtractor(header="Subject", match="Card ending (?P<card>[0-9]+)"),
+            "card",
+            "1234",
+            id="header-match-named-group",
+        ),
+        pytest.param(
+            ColumnExtractor(
+                header="Subject", match=StrPrefixMatch(prefix="Card"), value="true"
+            ),
+            "valid",
+            "true",
+            id="header-match-value",
+        ),
+        pytest.param(
+            ColumnExtractor(header="Subject", match=StrPrefixMatch(prefix="Refund")),
+            "valid",
+            None,
+            id="header-not-match",
+        ),
+    ],
+)
+def test_run_column_extractor(
+    extractor: ColumnExtractor, column_name: str, expected: str | None
+):
+    assert (
+        run_column_extractor(
+            extractor=extractor, column_name=column_name, text=TEXT, headers=HEADERS
+        )
+        == expected
+    )
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        dict(regex="Amount", header="Subject"),
+        dict(value="true"),
+    ],
+)
+def test_column_extractor_invalid(kwargs: dict):
+    with pytest.raises(pydantic.ValidationError):
+        ColumnExtractor(**kwargs)
+
+
+@pytest.mark.parametrize(
+    "column_type, value, expected",
+    [
+        (OutputColumnType.bool, "true", (True, True)),
+        (OutputColumnType.bool, "no", (True, False)),
+        (OutputColumnType.bool, "maybe", (False, None)),
+        (OutputColumnType.decimal, "12.34", (True, "12.34")),
+        (OutputColumnType.decimal, "1,234.56", (False, None)),
+        (OutputColumnType.date, "2025-04-01", (True, "2025-04-01")),
+        (OutputColumnType.date, "April 1st", (False, None)),
+        (OutputColumnType.int, "42", (True, 42)),
+        (OutputColumnType.str, "ACME", (True, "ACME")),
+    ],
+)
+def test_convert_column_value(
+    column_type: OutputColumnType, value: str, expected: tuple[bool, typing.Any]
+):
+    column = OutputColumn(name="col", type=column_type, description="column")
+    assert convert_column_value(column, value) == expected
+
+
+def test_convert_column_value_model_cache(mocker: MockerFixture):
+    rule_extract.build_column_model.cache_clear()
+    build_row_model = mocker.spy(rule_extract, "build_row_model")
+    column = OutputColumn(
+        name="col", type=OutputColumnType.str, description="a", pattern="^A"
+    )
+    assert convert_column_value(column, "ACME") == (True, "ACME")
+    assert convert_column_value(column, "BIG") == (False, None)
+    # the description does not change the validation
+    other_description = column.model_copy(update=dict(description="b"))
+    assert convert_column_value(other_description, "ACME") == (True, "ACME")
+    assert build_row_model.call_count == 1
+    other_pattern = column.model_copy(update=dict(pattern="^B"))
+    assert convert_column_value(other_pattern, "BIG") == (True, "BIG")
+    assert build_row_model.call_count == 2
+
+
+def test_extract_columns_by_rules():
+    columns = [
+        OutputColumn(
+            name="valid",
+            type=OutputColumnType.bool,
+            description="valid",
+            extractors=[ColumnExtractor(regex="^Transaction alert$", value="true")],
+        ),
+        OutputColumn(
+            name="amount",
+            type=OutputColumnType.decimal,
+            description="amount",
+            extractors=[
+                # the first one doesn't pass the decimal validation
+                ColumnExtractor(regex=r"^Amount: \$(?P<amount>.+)$"),
+                ColumnExtractor(header="X-Amount"),
+            ],
+        ),
+        OutputColumn(
+            name="merchant",
+            type=OutputColumnType.str,
+            description="merchant",
+            extractors=[ColumnExtractor(regex="^Vendor: (?P<merchant>.+)$")],
+        ),
+        OutputColumn(
+            name="txn_id",
+            type=OutputColumnType.str,
+            description="txn id",
+            extractors=[ColumnExtractor(header="X-Bank-Ref")],
+        ),
+        OutputColumn(
+            name="desc",
+            type=OutputColumnType.str,
+            description="desc",
+        ),
+    ]
+    assert extract_columns_by_rules(
+        columns=columns,
+        text=TEXT,
+        headers=HEADERS | {"X-Amount": "1234.56"},
+        match_vars=dict(txn_id="REF-FROM-RULE", other="value"),
+    ) == dict(valid=True, amount="1234.56", txn_id="REF-FROM-RULE")
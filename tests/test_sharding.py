@@ -0,0 +1,89 @@
+import pathlib
+
+import pytest
+
+from beanhub_inbox.sharding import make_shard_path
+from beanhub_inbox.sharding import merge_shard_csvs
+from beanhub_inbox.sharding import Shard
+from beanhub_inbox.sharding import shard_of
+
+
+@pytest.mark.parametrize(
+    "rel_filepath, shard_count, expected",
+    [
+        ("a.eml", 4, 2),
+        ("sub/c.eml", 4, 3),
+        ("mock0.eml", 4, 2),
+        ("mock0.eml", 1, 0),
+    ],
+)
+def test_shard_of(rel_filepath: str, shard_count: int, expected: int):
+    assert shard_of(pathlib.PurePath(rel_filepath), shard_count) == expected
+
+
+@pytest.mark.parametrize(
+    "index, count",
+    [
+        (0, 0),
+        (-1, 2),
+        (2, 2),
+    ],
+)
+def test_shard_invalid(index: int, count: int):
+    with pytest.raises(ValueError):
+        Shard(index=index, count=count)
+
+
+@pytest.mark.parametrize(
+    "path, index, count, expected",
+    [
+        ("output.csv", 0, 2, "output.shard-0-of-2.csv"),
+        ("data/output.db", 3, 4, "data/output.shard-3-of-4.db"),
+        ("journal", 1, 2, "journal.shard-1-of-2"),
+    ],
+)
+def test_make_shard_path(path: str, index: int, count: int, expected: str):
+    assert make_shard_path(pathlib.Path(path), index=index, count=count) == (
+        pathlib.Path(expected)
+    )
+
+
+def test_merge_shard_csvs(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text("id,valid\nmock2,True\n")
+    make_shard_path(output_csv, index=0, count=3).write_text(
+        "id,valid,amount\nmock3,True,12.34\nmock2,False,\n"
+    )
+    make_shard_path(output_csv, index=2, count=3).write_text(
+        "id,valid,amount\nmock1,False,\nmock3,False,\n"
+    )
+    assert merge_shard_csvs(output_csv, shard_count=3) == 3
+    assert output_csv.read_text() == (
+        "id,valid,amount\nmock1,False,\nmock2,True,\nmock3,True,12.34\n"
+    )
+    assert make_shard_path(output_csv, index=0, count=3).exists()
+    # merging again gives the same result
+    assert merge_shard_csvs(output_csv, shard_count=3, remove_shards=True) == 3
+    assert output_csv.read_text() == (
+        "id,valid,amount\nmock1,False,\nmock2,True,\nmock3,True,12.34\n"
+    )
+    assert list(tmp_path.iterdir()) == [output_csv]
+
+
+def test_merge_shard_csvs_backfill(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text("id,valid,desc\nmock0,True,Coffee\nmock1,True,\n")
+    make_shard_path(output_csv, index=0, count=2).write_text(
+        "id,valid,desc,amount\nmock0,False,Tea,12.34\nmock1,True,Cake,56.78\n"
+    )
+    assert merge_shard_csvs(output_csv, shard_count=2) == 2
+    # merged values are kept, missing ones are filled by the shards
+    assert output_csv.read_text() == (
+        "id,valid,desc,amount\nmock0,True,Coffee,12.34\nmock1,True,Cake,56.78\n"
+    )
+
+
+def test_merge_shard_csvs_empty(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    assert merge_shard_csvs(output_csv, shard_count=2) == 0
+    assert not output_csv.exists()
@@ -0,0 +1,120 @@
+import pathlib
+import sqlite3
+
+from beanhub_inbox.sqlite_output import SQLiteOutput
+
+
+def count_rows(database: pathlib.Path) -> int:
+    conn = sqlite3.connect(database)
+    try:
+        (count,) = conn.execute("SELECT COUNT(*) FROM rows").fetchone()
+    finally:
+        conn.close()
+    return count
+
+
+def test_sqlite_output(tmp_path: pathlib.Path):
+    database = tmp_path / "db" / "output.sqlite"
+    output = SQLiteOutput(
+        database=database,
+        table="rows",
+        fieldnames=["id", "valid", "amount"],
+        batch_size=2,
+    )
+    assert output.is_empty()
+    assert output.find_row("a") is None
+    assert output.conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    output.upsert_row(dict(id="b", valid=True, amount="12.34"))
+    # visible in the same connection before committing
+    assert output.find_row("b") == dict(id="b", valid="True", amount="12.34")
+    # buffered in memory without holding the write lock
+    assert not output.conn.in_transaction
+    assert count_rows(database) == 0
+    output.upsert_row(dict(id="a", valid=False))
+    # batch is full, committed
+    assert count_rows(database) == 2
+    assert output.find_row("a") == dict(id="a", valid="False")
+    output.upsert_row(dict(id="a", amount=None))
+    assert output.find_row("a") == dict(id="a", valid="False", amount="")
+    output.upsert_row(dict(id="a"))
+    assert output.find_row("a") == dict(id="a", valid="False", amount="")
+
+    output_csv = tmp_path / "output.csv"
+    output.export_csv(output_csv)
+    assert output_csv.read_text() == "id,valid,amount\na,False,\nb,True,12.34\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["db", "output.csv"]
+    # for multiple workers exporting to the same file
+    output.export_csv(output_csv, lock=True)
+    assert output_csv.read_text() == "id,valid,amount\na,False,\nb,True,12.34\n"
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        ".output.csv.lock",
+        "db",
+        "output.csv",
+    ]
+    output.close()
+
+    # other connections can read the committed rows
+    conn = sqlite3.connect(database)
+    assert conn.execute("SELECT COUNT(*) FROM rows").fetchone() == (2,)
+    conn.close()
+
+    # new column added to the existing table
+    output = SQLiteOutput(
+        database=database, table="rows", fieldnames=["id", "valid", "amount", "tax"]
+    )
+    assert not output.is_empty()
+    assert output.find_row("b") == dict(id="b", valid="True", amount="12.34")
+    output.upsert_row(dict(id="b", tax="1.00"))
+    assert output.find_row("b") == dict(
+        id="b", valid="True", amount="12.34", tax="1.00"
+    )
+    output.close()
+
+
+def test_sqlite_output_commit_each_row(tmp_path: pathlib.Path):
+    database = tmp_path / "output.sqlite"
+    output = SQLiteOutput(
+        database=database, table="rows", fieldnames=["id", "valid", "amount"]
+    )
+    output.upsert_row(dict(id="a", valid=True))
+    # each extracted row is durable right away by default
+    assert not output.has_pending_rows
+    assert count_rows(database) == 1
+    output.upsert_row(dict(id="b", valid=False))
+    assert count_rows(database) == 2
+    output.close()
+
+
+def test_sqlite_output_import_csv(tmp_path: pathlib.Path):
+    output_csv = tmp_path / "output.csv"
+    output_csv.write_text("id,valid,legacy\na,True,foo\nb,False,bar\n")
+    output = SQLiteOutput(
+        database=tmp_path / "output.sqlite",
+        table="my rows",
+        fieldnames=["id", "valid", "desc"],
+    )
+    output.import_csv(output_csv)
+    assert not output.is_empty()
+    assert output.find_row("a") == dict(id="a", valid="True")
+    assert output.find_row("b") == dict(id="b", valid="False")
+    output.close()
+
+
+def test_sqlite_output_concurrent_writers(tmp_path: pathlib.Path):
+    database = tmp_path / "output.sqlite"
+    output0 = SQLiteOutput(
+        database=database, table="rows", fieldnames=["id", "valid"], timeout=0.1
+    )
+    output1 = SQLiteOutput(
+        database=database, table="rows", fieldnames=["id", "valid"], timeout=0.1
+    )
+    output0.upsert_row(dict(id="a", valid=True))
+    # pending rows of the other writer don't lock the database
+    output1.upsert_row(dict(id="b", valid=False))
+    output1.commit()
+    output0.upsert_row(dict(id="a", valid=False))
+    assert output0.find_row("a") == dict(id="a", valid="False")
+    output0.close()
+    output1.close()
+    assert count_rows(database) == 2
@@ -0,0 +1,173 @@
+import pathlib
+import typing
+
+import pytest
+
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.template_cache import apply_extractor
+from beanhub_inbox.template_cache import derive_extractor
+from beanhub_inbox.template_cache import html_fingerprint
+from beanhub_inbox.template_cache import make_template_key
+from beanhub_inbox.template_cache import TemplateCache
+
+
+@pytest.mark.parametrize(
+    "html0, html1, expected",
+    [
+        (
+            "<div><p>Total: $12.34</p></div>",
+            "<div><p>Total: $56.78</p></div>",
+            True,
+        ),
+        (
+            '<div class="a b"><p>Total</p></div>',
+            '<div class="b a"><p>Amount</p></div>',
+            True,
+        ),
+        (
+            "<div><p>Total: $12.34</p></div>",
+            "<div><span>Total: $12.34</span></div>",
+            False,
+        ),
+        (
+            '<div class="receipt"><p>Total</p></div>',
+            '<div class="newsletter"><p>Total</p></div>',
+            False,
+        ),
+    ],
+)
+def test_html_fingerprint(html0: str, html1: str, expected: bool):
+    assert (html_fingerprint(html0) == html_fingerprint(html1)) == expected
+
+
+def test_make_template_key():
+    assert make_template_key(
+        ["Shop <Billing@Shop.com>", "other@example.com"], "fp"
+    ) == make_template_key(["other@example.com", "billing@shop.com"], "fp")
+    assert make_template_key(["billing@shop.com"], "fp0") != make_template_key(
+        ["billing@shop.com"], "fp1"
+    )
+
+
+@pytest.mark.parametrize(
+    "text, value, expected",
+    [
+        pytest.param(
+            "Receipt\nTotal: $12.34\nThanks",
+            "12.34",
+            dict(regex=r"^Total:\ \$(?P<value>.+?)$"),
+            id="prefix",
+        ),
+        pytest.param(
+            "Receipt\nTotal: 12.34 USD\nThanks",
+            "12.34",
+            dict(regex=r"^Total:\ (?P<value>.+?)\ USD$"),
+            id="prefix-suffix",
+        ),
+        pytest.param(
+            "Receipt\nInvoice number\nINV-001\nThanks",
+            "INV-001",
+            dict(regex="^Invoice\\ number\\n(?P<value>.+?)$"),
+            id="previous-line",
+        ),
+        pytest.param(
+            "INV-001\nThanks",
+            "INV-001",
+            dict(const="INV-001"),
+            id="no-anchor",
+        ),
+        pytest.param(
+            "Receipt\nTotal: $12.34",
+            "Acme",
+            dict(const="Acme"),
+            id="not-found",
+        ),
+        pytest.param("Receipt", True, dict(const=True), id="bool"),
+        pytest.param("Receipt", None, dict(const=None), id="none"),
+    ],
+)
+def test_derive_extractor(text: str, value: typing.Any, expected: dict):
+    extractor = derive_extractor(text, value)
+    assert extractor == expected
+    assert apply_extractor(extractor, text) == (True, value)
+
+
+COLUMNS = [
+    OutputColumn(name="valid", type=OutputColumnType.bool, description="valid"),
+    OutputColumn(name="amount", type=OutputColumnType.decimal, description="amount"),
+    OutputColumn(name="date", type=OutputColumnType.date, description="date"),
+]
+
+
+def test_template_cache(tmp_path: pathlib.Path):
+    cache = TemplateCache()
+    text0 = "Receipt\nTotal: $12.34\nDate: Apr 1"
+    text1 = "Receipt\nTotal: $56.78\nDate: Apr 2"
+    text2 = "Receipt\nTotal: $90.12\nDate: Apr 3"
+
+    assert cache.extract("key", text0, COLUMNS, min_samples=2) == {}
+    assert (
+        cache.learn(
+            "key", text0, dict(valid=True, amount="12.34", date="2025-04-01"), 2
+        )
+        == []
+    )
+    # not enough samples yet
+    assert cache.extract("key", text1, COLUMNS, min_samples=2) == {}
+    assert (
+        cache.learn(
+            "key", text1, dict(valid=True, amount="56.78", date="2025-04-02"), 2
+        )
+        == []
+    )
+    # date value doesn't appear in the text, so it can never be learned
+    assert cache.extract("key", text2, COLUMNS, min_samples=2) == dict(
+        valid=True, amount="90.12"
+    )
+
+    cache_file = tmp_path / "cache" / "templates.json"
+    cache.save(cache_file)
+    loaded_cache = TemplateCache.load(cache_file)
+    assert loaded_cache.templates == cache.templates
+    assert loaded_cache.record_hit("key") == 1
+    assert loaded_cache.record_hit("key") == 2
+
+    # the template changed
+    text3 = "Receipt\nGrand total: $90.12"
+    assert loaded_cache.extract("key", text3, COLUMNS, min_samples=2) == dict(
+        valid=True
+    )
+    assert loaded_cache.learn("key", text3, dict(valid=False), 2) == ["valid"]
+    # drifted column needs to be learned again
+    assert loaded_cache.extract("key", text3, COLUMNS, min_samples=2) == {}
+
+
+def test_load_missing_file(tmp_path: pathlib.Path):
+    assert TemplateCache.load(tmp_path / "missing.json").templates == {}
+
+
+def test_template_cache_const_values():
+    cache = TemplateCache()
+    text0 = "Receipt\nTotal: $12.34\nDate: Jan 5"
+    text1 = "Receipt\nTotal: $56.78\nDate: Jan 5"
+    text2 = "Receipt\nTotal: $90.12\nDate: Mar 9"
+    for text, amount in [(text0, "12.34"), (text1, "56.78")]:
+        cache.learn("key", text, dict(valid=True, amount=amount, date="2025-01-05"), 2)
+    assert cache.templates["key"]["columns"]["date"] == dict(
+        const="2025-01-05", samples=2
+    )
+    # the date shared by previous emails by chance shouldn't be applied to others
+    assert cache.extract("key", text2, COLUMNS, min_samples=2) == dict(
+        valid=True, amount="90.12"
+    )
+
+
+def test_template_cache_invalid_value():
+    cache = TemplateCache()
+    text0 = "Receipt\nTotal: $12.34"
+    text1 = "Receipt\nTotal: $56.78"
+    text2 = "Receipt\nTotal: $N/A"
+    for text, amount in [(text0, "12.34"), (text1, "56.78")]:
+        cache.learn("key", text, dict(amount=amount), 2)
+    assert cache.extract("key", text2, COLUMNS, min_samples=2) == {}
@@ -0,0 +1,36 @@
+import ollama
+
+from beanhub_inbox.token_usage import TokenAccounting
+from beanhub_inbox.token_usage import TokenUsage
+
+
+def test_token_usage_add_response():
+    usage = TokenUsage()
+    # counts are only reported with the last chunk
+    usage.add_response(
+        ollama.ChatResponse(message=ollama.Message(role="assistant", content="a"))
+    )
+    usage.add_response(
+        ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="b"),
+            prompt_eval_count=100,
+            eval_count=20,
+        )
+    )
+    assert usage == TokenUsage(prompt_tokens=100, completion_tokens=20)
+    assert usage.total_tokens == 120
+
+
+def test_token_accounting():
+    accounting = TokenAccounting()
+    accounting.record("email0", "amount", TokenUsage(10, 1))
+    accounting.record("email0", "tax", TokenUsage(20, 2))
+    accounting.record("email1", "amount", TokenUsage(30, 3))
+    assert accounting.run == TokenUsage(60, 6)
+    assert accounting.email_usage("email0") == TokenUsage(30, 3)
+    assert accounting.email_usage("email1") == TokenUsage(30, 3)
+    assert accounting.email_usage("other") == TokenUsage()
+    assert accounting.columns == {
+        "amount": TokenUsage(40, 4),
+        "tax": TokenUsage(20, 2),
+    }
@@ -0,0 +1,255 @@
+import json
+import pathlib
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.data_types import OutputColumn
+from beanhub_inbox.data_types import OutputColumnType
+from beanhub_inbox.processor import process_imports
+from beanhub_inbox.tracing import child_span
+from beanhub_inbox.tracing import encode_span
+from beanhub_inbox.tracing import InMemorySpanExporter
+from beanhub_inbox.tracing import JSONLinesSpanExporter
+from beanhub_inbox.tracing import SpanKind
+from beanhub_inbox.tracing import SpanStatusCode
+from beanhub_inbox.tracing import Tracer
+from beanhub_inbox.tracing import tracer_span
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self) -> int:
+        self.now += 1
+        return self.now
+
+
+def test_span_tree():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter, clock=MockClock())
+    with tracer.span("root", attributes={"mock.int": 1, "mock.none": None}) as root:
+        with child_span(root, "child", kind=SpanKind.client) as child:
+            child.set_attribute("mock.bool", True)
+            child.add_event("first_token")
+        with pytest.raises(ValueError):
+            with child_span(root, "failed"):
+                raise ValueError("boom")
+    assert [span.name for span in exporter.spans] == ["child", "failed", "root"]
+    child, failed, root = exporter.spans
+    assert root.parent_span_id is None
+    assert root.attributes == {"mock.int": 1}
+    assert len(root.trace_id) == 32
+    assert child.trace_id == root.trace_id
+    assert child.parent_span_id == root.span_id
+    assert failed.status_code == SpanStatusCode.error
+    assert failed.events[0].name == "exception"
+    assert root.start_time < child.start_time < child.end_time < root.end_time
+
+    assert encode_span(child) == dict(
+        traceId=root.trace_id,
+        spanId=child.span_id,
+        parentSpanId=root.span_id,
+        name="child",
+        kind=3,
+        startTimeUnixNano=str(child.start_time),
+        endTimeUnixNano=str(child.end_time),
+        attributes=[dict(key="mock.bool", value=dict(boolValue=True))],
+        events=[
+            dict(
+                timeUnixNano=str(child.events[0].time),
+                name="first_token",
+                attributes=[],
+            )
+        ],
+        status=dict(code=0),
+    )
+
+
+def test_disabled_tracing():
+    with tracer_span(None, "root") as root:
+        assert root is None
+        with child_span(root, "child") as child:
+            assert child is None
+
+
+def test_json_lines_exporter(tmp_path: pathlib.Path):
+    path = tmp_path / "traces" / "spans.jsonl"
+    tracer = Tracer(JSONLinesSpanExporter(path, service_name="mock-service"))
+    with tracer.span("root", attributes={"mock.float": 1.5, "mock.str": "value"}):
+        pass
+    tracer.close()
+    (line,) = path.read_text().splitlines()
+    request = json.loads(line)
+    (resource_spans,) = request["resourceSpans"]
+    assert resource_spans["resource"]["attributes"] == [
+        dict(key="service.name", value=dict(stringValue="mock-service"))
+    ]
+    (scope_spans,) = resource_spans["scopeSpans"]
+    assert scope_spans["scope"] == dict(name="beanhub_inbox")
+    (span,) = scope_spans["spans"]
+    assert span["name"] == "root"
+    assert "parentSpanId" not in span
+    assert span["attributes"] == [
+        dict(key="mock.float", value=dict(doubleValue=1.5)),
+        dict(key="mock.str", value=dict(stringValue="value")),
+    ]
+
+
+def test_process_imports_tracing(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, format: dict | None = None, **kwargs):
+        if format is not None:
+            yield ollama.ChatResponse(
+                message=ollama.Message(role="assistant", content='{"desc": "MOCK"}'),
+                prompt_eval_count=7,
+                eval_count=3,
+            )
+            return
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="Let me think")
+        )
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": true}```'),
+            prompt_eval_count=10,
+            eval_count=5,
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                name="mock-rule",
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(
+                            output_csv="output.csv",
+                            columns=[
+                                OutputColumn(
+                                    name="valid",
+                                    type=OutputColumnType.bool,
+                                    description="is valid",
+                                ),
+                                OutputColumn(
+                                    name="desc",
+                                    type=OutputColumnType.str,
+                                    description="description",
+                                    pattern="^MOCK$",
+                                ),
+                            ],
+                        )
+                    )
+                ],
+            )
+        ],
+    )
+    exporter = InMemorySpanExporter()
+    list(
+        process_imports(
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            tracer=Tracer(exporter),
+        )
+    )
+    spans = {span.name: span for span in exporter.spans}
+    root = spans["process_email"]
+    assert root.parent_span_id is None
+    assert root.attributes["beanhub_inbox.email.id"] == "mock"
+    assert root.attributes["beanhub_inbox.import_rule.index"] == 0
+    assert root.attributes["beanhub_inbox.import_rule.name"] == "mock-rule"
+    for name in ["parse_email", "extract_text", "extract_column", "write_row"]:
+        assert spans[name].parent_span_id == root.span_id
+    assert spans["parse_email"].start_time == root.start_time
+    assert spans["extract_text"].attributes["beanhub_inbox.content_length"] > 0
+
+    column_spans = [span for span in exporter.spans if span.name == "extract_column"]
+    assert [span.attributes["beanhub_inbox.column.name"] for span in column_spans] == [
+        "valid",
+        "desc",
+    ]
+    assert all(
+        span.attributes["beanhub_inbox.column.source"] == "llm" for span in column_spans
+    )
+
+    think_spans = [span for span in exporter.spans if span.name == "llm.think"]
+    assert [span.parent_span_id for span in think_spans] == [
+        span.span_id for span in column_spans
+    ]
+    think_span = think_spans[0]
+    assert think_span.kind == SpanKind.client
+    assert think_span.attributes["gen_ai.request.model"] == "deepcoder"
+    assert think_span.attributes["gen_ai.usage.input_tokens"] == 10
+    assert think_span.attributes["gen_ai.usage.output_tokens"] == 5
+    assert think_span.attributes["beanhub_inbox.time_to_first_token"] >= 0
+    assert [event.name for event in think_span.events] == ["first_token"]
+
+    # the desc column falls back to structured output, as the thinking output has
+    # no value for it
+    extract_span = spans["llm.extract"]
+    assert extract_span.parent_span_id == column_spans[1].span_id
+    assert extract_span.attributes["gen_ai.usage.input_tokens"] == 7
+    assert extract_span.attributes["gen_ai.usage.output_tokens"] == 3
+    assert root.end_time >= spans["write_row"].end_time
+
+
+def test_process_imports_tracing_error(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content="Let me think")
+        )
+        raise ollama.ResponseError("model not found", status_code=404)
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    exporter = InMemorySpanExporter()
+    with pytest.raises(ollama.ResponseError):
+        list(
+            process_imports(
+                inbox_doc=inbox_doc,
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+                tracer=Tracer(exporter),
+            )
+        )
+    spans = {span.name: span for span in exporter.spans}
+    # spans explaining the failure are exported too
+    for name in ["llm.think", "extract_column", "process_email"]:
+        assert spans[name].status_code == SpanStatusCode.error
+        assert spans[name].end_time is not None
+    assert spans["llm.think"].parent_span_id == spans["extract_column"].span_id
+    assert [event.name for event in spans["llm.think"].events] == [
+        "first_token",
+        "exception",
+    ]
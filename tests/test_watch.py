@@ -0,0 +1,161 @@
+import pathlib
+import sys
+import threading
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import MockEmailFactory
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.watch import collect_changes
+from beanhub_inbox.watch import InotifyWatcher
+from beanhub_inbox.watch import PollingWatcher
+from beanhub_inbox.watch import watch_imports
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux only")
+def test_inotify_watcher(tmp_path: pathlib.Path):
+    (tmp_path / "existing.eml").write_text("existing")
+    watcher = InotifyWatcher(tmp_path)
+    try:
+        assert watcher.read_changes(timeout=0) == set()
+        (tmp_path / "new.eml").write_text("new")
+        sub_dir = tmp_path / "sub"
+        sub_dir.mkdir()
+        assert watcher.read_changes(timeout=1) == {tmp_path / "new.eml"}
+        (sub_dir / "nested.eml").write_text("nested")
+        (tmp_path / ".tmp.eml").write_text("moved")
+        (tmp_path / ".tmp.eml").rename(tmp_path / "moved.eml")
+        changes = set()
+        while True:
+            new_changes = watcher.read_changes(timeout=0.1)
+            if not new_changes:
+                break
+            changes |= new_changes
+        assert changes == {
+            sub_dir / "nested.eml",
+            tmp_path / ".tmp.eml",
+            tmp_path / "moved.eml",
+        }
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher(tmp_path: pathlib.Path):
+    (tmp_path / "existing.eml").write_text("existing")
+    watcher = PollingWatcher(tmp_path, interval=0)
+    assert watcher.read_changes(timeout=0) == set()
+    (tmp_path / "new.eml").write_text("new")
+    (tmp_path / "existing.eml").write_text("modified")
+    assert watcher.read_changes(timeout=0) == {
+        tmp_path / "new.eml",
+        tmp_path / "existing.eml",
+    }
+    assert watcher.read_changes(timeout=0) == set()
+
+
+class MockWatcher:
+    def __init__(self, batches: list[set[pathlib.Path]]):
+        self.batches = batches
+
+    def read_changes(self, timeout: float) -> set[pathlib.Path]:
+        if not self.batches:
+            return set()
+        return self.batches.pop(0)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize(
+    "batches, max_batch_size, expected",
+    [
+        (
+            [set(), {pathlib.Path("a")}, {pathlib.Path("b")}, set()],
+            100,
+            {pathlib.Path("a"), pathlib.Path("b")},
+        ),
+        (
+            [{pathlib.Path("a")}, {pathlib.Path("b")}, {pathlib.Path("c")}],
+            2,
+            {pathlib.Path("a"), pathlib.Path("b")},
+        ),
+    ],
+)
+def test_collect_changes(
+    batches: list[set[pathlib.Path]],
+    max_batch_size: int,
+    expected: set[pathlib.Path],
+):
+    assert (
+        collect_changes(MockWatcher(batches), debounce=0, max_batch_size=max_batch_size)
+        == expected
+    )
+
+
+def test_collect_changes_stop():
+    stop_event = threading.Event()
+    stop_event.set()
+    assert collect_changes(MockWatcher([]), stop_event=stop_event) == set()
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_watch_imports(
+    mocker: MockerFixture,
+    tmp_path: pathlib.Path,
+    use_inotify: bool,
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "mock0.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    stop_event = threading.Event()
+    events = watch_imports(
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        llm_model="deepcoder",
+        workdir_path=tmp_path,
+        debounce=0.1,
+        poll_interval=0.1,
+        use_inotify=use_inotify,
+        stop_event=stop_event,
+    )
+    email_ids = []
+    for event in events:
+        if not isinstance(event, FinishExtractingRow):
+            continue
+        email_ids.append(event.email_file.id)
+        if event.email_file.id == "mock0":
+            (input_dir / "mock1.eml").write_text(str(MockEmailFactory().make_msg()))
+        else:
+            stop_event.set()
+    assert email_ids == ["mock0", "mock1"]
+    assert (tmp_path / "output.csv").read_text() == (
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date\n"
+        "mock0,False,,,,,,\n"
+        "mock1,False,,,,,,\n"
+    )
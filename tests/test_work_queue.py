@@ -0,0 +1,581 @@
+import pathlib
+import sqlite3
+import threading
+import time
+
+import ollama
+import pytest
+from pytest_mock import MockerFixture
+
+from .factories import EmailAttachmentFactory
+from .factories import MockEmailFactory
+from beanhub_inbox import work_queue
+from beanhub_inbox.concurrency import AdaptiveLimiter
+from beanhub_inbox.data_types import ExtractConfig
+from beanhub_inbox.data_types import ExtractImportAction
+from beanhub_inbox.data_types import ImportConfig
+from beanhub_inbox.data_types import InboxDoc
+from beanhub_inbox.data_types import InputConfig
+from beanhub_inbox.data_types import SQLiteOutputConfig
+from beanhub_inbox.data_types import TemplateCacheConfig
+from beanhub_inbox.processor import FinishExtractingRow
+from beanhub_inbox.template_cache import TemplateCache
+from beanhub_inbox.work_queue import ClaimedFilepaths
+from beanhub_inbox.work_queue import populate_queue
+from beanhub_inbox.work_queue import QueueProgress
+from beanhub_inbox.work_queue import run_queue_threads
+from beanhub_inbox.work_queue import run_queue_worker
+from beanhub_inbox.work_queue import WorkQueue
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock() -> MockClock:
+    return MockClock()
+
+
+def make_queue(
+    tmp_path: pathlib.Path, worker_id: str, clock: MockClock, **kwargs
+) -> WorkQueue:
+    return WorkQueue(
+        database=tmp_path / "queue.db",
+        lease_duration=60,
+        worker_id=worker_id,
+        clock=clock,
+        **kwargs,
+    )
+
+
+def test_work_queue(tmp_path: pathlib.Path, clock: MockClock):
+    worker0 = make_queue(tmp_path, "worker0", clock)
+    worker1 = make_queue(tmp_path, "worker1", clock)
+    assert worker0.enqueue(["b.eml", "a.eml", "c.eml"]) == 3
+    assert worker1.enqueue(["a.eml", "d.eml"]) == 1
+    assert worker0.progress() == QueueProgress(
+        pending=4, leased=0, expired=0, done=0, failed=0
+    )
+
+    assert worker0.claim(limit=2) == ["a.eml", "b.eml"]
+    assert worker1.claim() == ["c.eml"]
+    assert worker1.progress() == QueueProgress(
+        pending=1, leased=3, expired=0, done=0, failed=0
+    )
+    # only the lease holder can complete
+    assert not worker1.complete("a.eml")
+    assert worker0.complete("a.eml")
+
+    clock.now += 30
+    assert worker0.renew("b.eml")
+    clock.now += 40
+    assert worker0.progress() == QueueProgress(
+        pending=1, leased=2, expired=1, done=1, failed=0
+    )
+    # the lease of c.eml expired, reclaim it
+    assert worker0.claim(limit=10) == ["c.eml", "d.eml"]
+    assert not worker1.complete("c.eml")
+    assert worker0.complete("b.eml")
+    assert worker0.complete("c.eml")
+    assert worker0.complete("d.eml")
+    progress = worker1.progress()
+    assert progress == QueueProgress(pending=0, leased=0, expired=0, done=4, failed=0)
+    assert progress.total == 4
+    assert progress.finished
+    assert worker1.claim() == []
+    worker0.close()
+    worker1.close()
+
+
+def test_work_queue_fail(tmp_path: pathlib.Path, clock: MockClock):
+    queue = make_queue(tmp_path, "worker0", clock, max_attempts=2)
+    queue.enqueue(["a.eml"])
+    assert queue.claim() == ["a.eml"]
+    assert queue.fail("a.eml", error="boom")
+    assert queue.progress().pending == 1
+    assert queue.claim() == ["a.eml"]
+    assert queue.fail("a.eml", error="boom")
+    assert queue.progress() == QueueProgress(
+        pending=0, leased=0, expired=0, done=0, failed=1
+    )
+    assert queue.claim() == []
+    queue.close()
+
+
+def test_work_queue_release(tmp_path: pathlib.Path, clock: MockClock):
+    queue = make_queue(tmp_path, "worker0", clock, max_attempts=1)
+    queue.enqueue(["a.eml"])
+    assert queue.claim() == ["a.eml"]
+    assert queue.release("a.eml")
+    assert queue.progress().pending == 1
+    # releasing doesn't count as an attempt
+    assert queue.claim() == ["a.eml"]
+    assert queue.fail("a.eml", error="boom")
+    assert queue.progress().failed == 1
+    queue.close()
+
+
+def test_run_queue_worker(
+    mocker: MockerFixture, tmp_path: pathlib.Path, clock: MockClock
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    process_imports_spy = mocker.spy(work_queue, "process_imports")
+
+    input_dir = tmp_path / "input"
+    (input_dir / "sub").mkdir(parents=True)
+    for name in ["mock0", "mock1", "sub/mock2"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = InboxDoc(
+        inputs=[InputConfig(match="**/*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(extract=ExtractConfig(output_csv="output.csv"))
+                ]
+            )
+        ],
+    )
+    queue = make_queue(tmp_path, "main", clock)
+    assert populate_queue(queue, input_dir) == 3
+    assert populate_queue(queue, input_dir) == 0
+
+    email_ids = []
+
+    def run_worker(worker_id: str):
+        worker_queue = make_queue(tmp_path, worker_id, clock)
+        for event in run_queue_worker(
+            queue=worker_queue,
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+        ):
+            if isinstance(event, FinishExtractingRow):
+                email_ids.append(event.email_file.id)
+        worker_queue.close()
+
+    threads = [
+        threading.Thread(target=run_worker, args=(f"worker{index}",))
+        for index in range(2)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    assert sorted(email_ids) == ["mock0", "mock1", "mock2"]
+    assert queue.progress() == QueueProgress(
+        pending=0, leased=0, expired=0, done=3, failed=0
+    )
+    queue.close()
+    assert mock_chat.call_count == 3
+    # claimed emails are processed in one run for each worker
+    assert process_imports_spy.call_count == 2
+    assert (tmp_path / ".output.csv.lock").exists()
+    assert sorted((tmp_path / "output.csv").read_text().splitlines()) == [
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date",
+        "mock0,False,,,,,,",
+        "mock1,False,,,,,,",
+        "mock2,False,,,,,,",
+    ]
+
+
+def test_claimed_filepaths(tmp_path: pathlib.Path, clock: MockClock):
+    queue = make_queue(tmp_path, "worker0", clock)
+    queue.enqueue(["a.eml", "b.eml"])
+    claimed = ClaimedFilepaths(queue=queue, input_dir=tmp_path / "input")
+    assert next(claimed) == tmp_path / "input" / "a.eml"
+    assert claimed.current == "a.eml"
+
+    # not renewed too often
+    clock.now += 10
+    claimed.renew()
+    clock.now += 45
+    claimed.renew()
+    # without renewing, the lease would be expired by now
+    clock.now += 30
+    assert queue.progress().expired == 0
+
+    # the previous file is processed once the next one is requested, but only done
+    # once its rows are written
+    assert next(claimed) == tmp_path / "input" / "b.eml"
+    assert claimed.processed == ["a.eml"]
+    assert queue.progress() == QueueProgress(
+        pending=0, leased=2, expired=0, done=0, failed=0
+    )
+    claimed.fail(error="boom")
+    assert claimed.current is None
+    assert queue.progress().pending == 1
+    # nothing else to claim after retrying, stop to write the rows of the processed
+    # files instead of waiting for their leases
+    assert list(claimed) == [tmp_path / "input" / "b.eml"]
+    assert claimed.processed == ["a.eml", "b.eml"]
+    assert not claimed.finished
+    claimed.complete_processed()
+    assert queue.progress() == QueueProgress(
+        pending=0, leased=0, expired=0, done=2, failed=0
+    )
+    assert list(claimed) == []
+    assert claimed.finished
+    queue.close()
+
+
+def make_extract_inbox_doc(**kwargs) -> InboxDoc:
+    return InboxDoc(
+        inputs=[InputConfig(match="*.eml")],
+        imports=[
+            ImportConfig(
+                actions=[
+                    ExtractImportAction(
+                        extract=ExtractConfig(output_csv="output.csv", **kwargs)
+                    )
+                ]
+            )
+        ],
+    )
+
+
+def test_run_queue_worker_failure(
+    mocker: MockerFixture, tmp_path: pathlib.Path, clock: MockClock
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    calls = []
+
+    def chat_side_effect(messages, **kwargs):
+        calls.append(messages)
+        if len(calls) == 1:
+            raise ValueError("boom")
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    queue = make_queue(tmp_path, "worker0", clock, max_attempts=1)
+    populate_queue(queue, input_dir)
+    events = list(
+        run_queue_worker(
+            queue=queue,
+            inbox_doc=make_extract_inbox_doc(),
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+        )
+    )
+    assert [
+        event.email_file.id
+        for event in events
+        if isinstance(event, FinishExtractingRow)
+    ] == ["mock1"]
+    assert queue.progress() == QueueProgress(
+        pending=0, leased=0, expired=0, done=1, failed=1
+    )
+    queue.close()
+
+
+def test_run_queue_worker_journal(
+    mocker: MockerFixture, tmp_path: pathlib.Path, clock: MockClock
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["mock0", "mock1"]:
+        (input_dir / f"{name}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = make_extract_inbox_doc(journal="journal.jsonl")
+    journal_file = tmp_path / "journal.jsonl"
+
+    other_queue = make_queue(tmp_path, "other", clock)
+    populate_queue(other_queue, input_dir)
+    # another worker is in the middle of extracting mock1
+    assert other_queue.claim(limit=2) == ["mock0.eml", "mock1.eml"]
+    assert other_queue.release("mock0.eml")
+
+    queue = make_queue(tmp_path, "worker0", clock)
+    stop_event = threading.Event()
+    for event in run_queue_worker(
+        queue=queue,
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        llm_model="deepcoder",
+        workdir_path=tmp_path,
+        poll_interval=0.01,
+        stop_event=stop_event,
+    ):
+        if isinstance(event, FinishExtractingRow):
+            stop_event.set()
+    assert journal_file.exists()
+
+    assert other_queue.complete("mock1.eml")
+    list(
+        run_queue_worker(
+            queue=queue,
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+        )
+    )
+    # all the emails are done
+    assert not journal_file.exists()
+    other_queue.close()
+    queue.close()
+
+
+def make_threads_input(tmp_path: pathlib.Path, count: int) -> pathlib.Path:
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for index in range(count):
+        (input_dir / f"mock{index}.eml").write_text(str(MockEmailFactory().make_msg()))
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    populate_queue(queue, input_dir)
+    queue.close()
+    return input_dir
+
+
+def test_run_queue_threads(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    # only passes once two LLM requests are in flight at the same time
+    barrier = threading.Barrier(2, timeout=10)
+
+    def chat_side_effect(messages, **kwargs):
+        barrier.wait()
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = make_threads_input(tmp_path, 2)
+    events = list(
+        run_queue_threads(
+            database=tmp_path / "queue.sqlite",
+            threads=2,
+            inbox_doc=make_extract_inbox_doc(),
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+            llm_limiter=AdaptiveLimiter(initial_limit=2, max_limit=2),
+        )
+    )
+    assert sorted(
+        event.email_file.id
+        for event in events
+        if isinstance(event, FinishExtractingRow)
+    ) == ["mock0", "mock1"]
+    assert not barrier.broken
+    assert sorted((tmp_path / "output.csv").read_text().splitlines()) == [
+        "id,valid,desc,merchant,amount,tax,txn_id,txn_date",
+        "mock0,False,,,,,,",
+        "mock1,False,,,,,,",
+    ]
+
+
+def test_run_queue_threads_limiter(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+
+    def chat_side_effect(messages, **kwargs):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05)
+        with lock:
+            in_flight -= 1
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = make_threads_input(tmp_path, 4)
+    events = list(
+        run_queue_threads(
+            database=tmp_path / "queue.sqlite",
+            threads=3,
+            inbox_doc=make_extract_inbox_doc(),
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+            llm_limiter=AdaptiveLimiter(max_limit=1),
+        )
+    )
+    assert (
+        len([event for event in events if isinstance(event, FinishExtractingRow)]) == 4
+    )
+    assert mock_chat.call_count == 4
+    assert max_in_flight == 1
+
+
+def test_run_queue_threads_error(mocker: MockerFixture, tmp_path: pathlib.Path):
+    mocker.patch.object(work_queue, "process_imports", side_effect=RuntimeError("boom"))
+    input_dir = make_threads_input(tmp_path, 1)
+    with pytest.raises(RuntimeError, match="boom"):
+        list(
+            run_queue_threads(
+                database=tmp_path / "queue.sqlite",
+                threads=2,
+                inbox_doc=make_extract_inbox_doc(),
+                input_dir=input_dir,
+                llm_model="deepcoder",
+                workdir_path=tmp_path,
+                poll_interval=0.01,
+            )
+        )
+
+
+def test_run_queue_worker_crash(
+    mocker: MockerFixture, tmp_path: pathlib.Path, clock: MockClock
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+
+    def chat_side_effect(messages, **kwargs):
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    email_ids = [f"mock{index}" for index in range(5)]
+    for email_id in email_ids:
+        (input_dir / f"{email_id}.eml").write_text(str(MockEmailFactory().make_msg()))
+    inbox_doc = make_extract_inbox_doc(
+        output_sqlite=SQLiteOutputConfig(database="output.db", batch_size=2)
+    )
+    queue = make_queue(tmp_path, "main", clock)
+    populate_queue(queue, input_dir)
+
+    def read_done_ids() -> set[str]:
+        return {
+            row[0].removesuffix(".eml")
+            for row in queue.conn.execute(
+                "SELECT filepath FROM items WHERE state = 'done'"
+            )
+        }
+
+    def read_row_ids() -> set[str]:
+        # what survives when the worker process is killed right now
+        if not (tmp_path / "output.db").exists():
+            return set()
+        conn = sqlite3.connect(tmp_path / "output.db")
+        try:
+            return {row[0] for row in conn.execute('SELECT id FROM "rows"')}
+        finally:
+            conn.close()
+
+    crashed_queue = make_queue(tmp_path, "crashed", clock)
+    worker = run_queue_worker(
+        queue=crashed_queue,
+        inbox_doc=inbox_doc,
+        input_dir=input_dir,
+        llm_model="deepcoder",
+        workdir_path=tmp_path,
+        poll_interval=0.01,
+    )
+    finished = 0
+    for event in worker:
+        # no file is ever done without its row written
+        assert read_done_ids() <= read_row_ids()
+        if isinstance(event, FinishExtractingRow):
+            finished += 1
+            if finished == 3:
+                break
+    # the worker dies in the middle of a batch
+    assert read_done_ids() <= read_row_ids()
+    assert read_done_ids() != set(email_ids)
+
+    # leases of the dead worker expire, and another worker picks up the files
+    clock.now += 120
+    list(
+        run_queue_worker(
+            queue=make_queue(tmp_path, "worker1", clock),
+            inbox_doc=inbox_doc,
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+        )
+    )
+    assert read_done_ids() == set(email_ids)
+    assert read_row_ids() == set(email_ids)
+    queue.close()
+
+
+def test_run_queue_threads_template_cache(
+    mocker: MockerFixture, tmp_path: pathlib.Path
+):
+    mock_chat = mocker.patch.object(ollama, "chat")
+    barrier = threading.Barrier(2, timeout=10)
+    local = threading.local()
+
+    def chat_side_effect(messages, **kwargs):
+        if not getattr(local, "called", False):
+            # both threads load the cache before any of them learns a template
+            local.called = True
+            barrier.wait()
+        yield ollama.ChatResponse(
+            message=ollama.Message(role="assistant", content='```{"valid": false}```')
+        )
+
+    mock_chat.side_effect = chat_side_effect
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for index in range(2):
+        # different senders make different templates
+        (input_dir / f"mock{index}.eml").write_text(
+            str(
+                MockEmailFactory(
+                    from_addresses=[f"billing@shop{index}.com"],
+                    html=EmailAttachmentFactory(
+                        content=b"<p>Receipt</p>", mime_type="text/html"
+                    ),
+                ).make_msg()
+            )
+        )
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    populate_queue(queue, input_dir)
+    queue.close()
+    list(
+        run_queue_threads(
+            database=tmp_path / "queue.sqlite",
+            threads=2,
+            inbox_doc=make_extract_inbox_doc(
+                template_cache=TemplateCacheConfig(cache_file="templates.json")
+            ),
+            input_dir=input_dir,
+            llm_model="deepcoder",
+            workdir_path=tmp_path,
+            poll_interval=0.01,
+            llm_limiter=AdaptiveLimiter(initial_limit=2, max_limit=2),
+        )
+    )
+    assert not barrier.broken
+    cache = TemplateCache.load(tmp_path / "templates.json")
+    assert len(cache.templates) == 2